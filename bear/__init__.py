@@ -3,19 +3,24 @@ copyright: (c) 2018 by Kourosh Parsa.
 """
 import os
 import sys
-from six import string_types
-from multiprocessing import Process, Pipe
-from threading import Thread
+from multiprocessing import Pipe, get_context
+from multiprocessing.process import BaseProcess
+from multiprocessing.connection import wait
+from threading import Thread, Timer, Event, Lock, current_thread
 import time
-import uuid
 from datetime import datetime
+from itertools import count
 import subprocess
 import traceback
 import logging
 import psutil
 import json
 from enum import Enum
-from bear import plotting
+from bear.memory import ProcessTreeSampler
+from bear.timeseries import TimeSeries, percentile
+from bear import sharedmem
+from bear.output import open_output, check_output
+from bear.sharedmem import ResultConnection, unpack_result
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -23,6 +28,21 @@ logger.setLevel(logging.INFO)
 TASK_CLONED_ATTRS = ['timeout', 'reserved_mem', 'args', 'kwargs', 'id',
                      'start_time', 'end_time', 'max_mem', 'state', 'error', 'result', 'func_name']
 DELAY = 0.1
+SAMPLE_INTERVAL = 0.05  # default seconds between memory samples of the running tasks
+MAX_MONITOR_DUTY = 0.1  # the largest fraction of a core the TaskMonitor spends sampling
+OUTPUT_CHUNK_SIZE = 65536
+# the series recorded for the tasks created with record_resources, the counters are counted from the start
+RESOURCE_COLUMNS = ['timestamp', 'mem', 'cpu_percent', 'read_bytes', 'write_bytes', 'ctx_switches', 'threads']
+CUMULATIVE_RESOURCES = ['read_bytes', 'write_bytes', 'ctx_switches']
+RESOURCE_CAPACITY = 1000  # the number of recent samples kept for a task
+RESOURCE_BUCKET_SIZE = 10  # the number of older samples aggregated together
+EXECUTORS = ['process', 'thread', 'inline']  # how the function of a task runs, see Task
+START_METHODS = ['fork', 'spawn', 'forkserver']  # how the process of a function task starts, see Task
+SYS_PATH_ENV = 'BEAR_SYS_PATH'  # passes the sys.path of preload to the forkserver, see bear._syspath
+_done_lock = Lock()
+_task_ids = count(1)
+_forkserver_modules = None  # the modules the forkserver preloaded once it started, see preload
+_EPOCH_NS = time.time_ns() - time.monotonic_ns()  # converts the time.monotonic_ns() of the tasks to the epoch
 
 
 class State(Enum):
@@ -30,41 +50,53 @@ class State(Enum):
     Started = 1
     Succeeded = 2
     Failed = 3
+    Queued = 4
+    TimedOut = 5
+    Cancelled = 6
 
 
-def callit(func, conn, *args, **kwargs):
-    """ executes a function and sends the results via a pipe """
-    res = {'error': None, 'result': None}
+FAILED_STATES = (State.Failed, State.TimedOut, State.Cancelled)
+DONE_STATES = (State.Succeeded,) + FAILED_STATES
+
+
+def _call(func, args, kwargs):
+    """ executes a function and returns a dict with the result or the error,
+    and started_ns, the time.monotonic_ns() when the function was called
+    """
+    res = {'error': None, 'result': None, 'started_ns': time.monotonic_ns()}
     try:
         res['result'] = func(*args, **kwargs)
     except Exception as ex:
         traceback_str = traceback.format_exc()
         logger.error(traceback_str)
         res['error'] = u'{}\n{}'.format(ex, traceback_str)
+    return res
+
 
+def callit(func, conn, *args, **kwargs):
+    """ executes a function and sends the results via a pipe """
+    res = _call(func, args, kwargs)
     try:
         conn.send(res)
     except BrokenPipeError:
         pass
 
     conn.close()
-    time.sleep(DELAY)  # to prevent deadlock due to not receiving the Pipe data
-
     if res['error'] is not None:
         sys.exit(1)
 
 
-def get_total_mem(pid):
+def get_total_mem(pid, mode='rss'):
     """
     pid: int, process id
-    returns the total RSS memory take from RAM used by the process and
+    mode: rss, uss or pss, see ProcessTreeSampler
+    returns the total memory take from RAM used by the process and
     all it's children
     """
-    proc = psutil.Process(pid)
-    mem = proc.memory_info().rss
-    for child in proc.children(recursive=True):
-        mem += get_total_mem(child.pid)
-    return mem
+    res = ProcessTreeSampler(mode).sample([pid])
+    if pid not in res:
+        raise psutil.NoSuchProcess(pid)
+    return res[pid]
 
 
 class Mem(object):
@@ -74,97 +106,500 @@ class Mem(object):
         self.percent_mem_used = percent_mem_used
 
 
+SYSTEM_COLUMNS = ['timestamp', 'mem_used', 'mem_percent', 'cpu_percent', 'swap_used', 'swap_percent', 'load']
+
+
 class SystemMonitor(Thread):
-    """ Thread used for monitoring system resources """
+    """ Thread used for monitoring system resources.
+    The samples are kept in a TimeSeries with the columns in SYSTEM_COLUMNS: the last capacity samples,
+    and the older ones aggregated in buckets of bucket_size samples, so its memory does not grow.
+    """
 
-    def __init__(self, interval):
-        Thread.__init__(self)
+    def __init__(self, interval, capacity=3600, bucket_size=60, bucket_capacity=1440):
+        """
+        :param interval: seconds between two samples, it can be less than a second
+        :param capacity: the number of recent samples kept
+        :param bucket_size: the number of older samples aggregated in a bucket, None to drop them
+        :param bucket_capacity: the number of buckets kept
+        """
+        Thread.__init__(self, name='bear-system-monitor')
         self.daemon = True
+        if interval <= 0:
+            raise ValueError('interval must be positive')
         self.interval = interval
-        self.data = []
-        self.stop_recording = False
+        self.series = TimeSeries(SYSTEM_COLUMNS, capacity, bucket_size, bucket_capacity)
+        self._stopped = Event()
+
+    def sample(self):
+        """ records the current usage of the system """
+        mem = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        load = psutil.getloadavg()[0] if hasattr(psutil, 'getloadavg') else 0.0
+        self.series.append((time.time(), mem.used, mem.percent, psutil.cpu_percent(),
+                            swap.used, swap.percent, load))
 
     def run(self):
-        while self.interval >= 1:
-            if not self.stop_recording:
-                mem_obj = psutil.virtual_memory()
-                obj = Mem(datetime.now(), mem_obj.used, mem_obj.percent)
-                self.data.append(obj)
-            time.sleep(self.interval)
+        psutil.cpu_percent()  # the cpu percent of the first sample is measured from here
+        next_sample = time.monotonic() + self.interval
+        while not self._stopped.wait(max(0.0, next_sample - time.monotonic())):
+            self.sample()
+            next_sample = max(next_sample + self.interval, time.monotonic())
 
+    def stop(self):
+        """ stops sampling """
+        self._stopped.set()
 
-class TaskMonitor(Thread):
-    """ Thread used for monitoring the RSS memory and state of a process """
+    @property
+    def data(self):
+        """ the recent samples as a list of Mem objects """
+        samples = self.series.recent.snapshot()
+        return [Mem(datetime.fromtimestamp(timestamp), int(used), percent) for timestamp, used, percent
+                in zip(samples['timestamp'], samples['mem_used'], samples['mem_percent'])]
+
+
+class _Watch(object):
+    """ What the TaskMonitor keeps about a running task """
 
     def __init__(self, task):
-        """ constructor """
-        Thread.__init__(self)
-        self.max_mem = 0
         self.task = task
+        self.worker = task.worker
         self.process = task.process
         self.pid = task.process.pid
-        self.daemon = True
+        self.max_mem = 0
+        self.samples = 0
+        self.res = None
+        self.exited = False
+        self.poll = False  # True when the exit of a Popen can only be detected by polling
+        self.pidfd = None
+        self.output = {}  # stream -> the object its output is written to, see bear.output
+        self.open_streams = 0
+        self.deadline = None
+        if task.timeout is not None:
+            self.deadline = time.monotonic() + task.timeout
+        self.stopped_state = None  # set when the task is killed because it timed out or was cancelled
+        self.started = time.monotonic()
+        self.baseline = None  # the counters of the process tree when the task started
+        self.last_cpu = 0.0
+        self.last_time = self.started
+        if task.record_resources:
+            task.resources = TimeSeries(RESOURCE_COLUMNS, RESOURCE_CAPACITY, RESOURCE_BUCKET_SIZE)
+
+    def is_done(self):
+        if self.worker is not None:
+            return self.res is not None
+        return self.exited and self.open_streams == 0
+
+
+def preload(modules):
+    """ starts the forkserver the tasks with the forkserver start_method fork from, once it imported the modules,
+    so their processes start with the modules loaded instead of importing them each.
+    modules: list of module names, __main__ preloads the main module. bear itself is always preloaded,
+    it must be importable by the server, e.g. installed or in the working directory, the modules are then
+    found with the sys.path of this process, see bear._syspath.
+    Call it before the first forkserver task starts, the server keeps the modules it started with,
+    a warning is logged if it already runs with other modules
+    """
+    global _forkserver_modules
+    from multiprocessing import forkserver
+    modules = ['bear._syspath', 'bear'] + [name for name in modules if name not in ('bear', 'bear._syspath')]
+    with _done_lock:
+        running = _forkserver_modules
+        if running is None:
+            _forkserver_modules = modules
+    if running is not None:
+        if running != modules:
+            logger.warning('The forkserver already runs with the modules {}, {} are not preloaded.'
+                           .format(running, modules))
+        return
+
+    get_context('forkserver').set_forkserver_preload(modules)
+    os.environ[SYS_PATH_ENV] = os.pathsep.join(sys.path)  # only the server reads it, see bear._syspath
+    try:
+        forkserver.ensure_running()
+    finally:
+        del os.environ[SYS_PATH_ENV]
 
-    def _set_task_attrs(self):
-        """ precondition:
-        if process is a Process object, is_alive() must be False
-        else (process is a Popen object), poll() must be False
-        """
-        self.task.end_time = datetime.now()
-        self.task.max_mem = self.max_mem
-        duration = (self.task.end_time - self.task.start_time).total_seconds()
-        if duration == 1:
-            duration = (self.task.end_time - self.task.start_time).microseconds / 1000000.0
-
-        if isinstance(self.process, Process):
-            res = self.task.parent_conn.recv()
-            if res['error'] is not None or self.process.exitcode not in [0, None]:
-                self.task.state = State.Failed
-                logger.info('Task {} {} failed after {} seconds.'.format(self.task.id, self.task.func_name, duration))
 
-            else:
-                self.task.state = State.Succeeded
-                logger.info(
-                    'Task {} {} succeeded after {} seconds.'.format(self.task.id, self.task.func_name, duration))
+def _forkserver_started():
+    """ notes that a task started the forkserver without the modules of preload """
+    global _forkserver_modules
+    with _done_lock:
+        if _forkserver_modules is None:
+            _forkserver_modules = []
 
-            self.task.result = res['result']
 
-            self.task.error = res['error']
+def _get_start_latency(task, res):
+    """ returns the seconds from the start of the task to the call of its function, or None """
+    started_ns = res.get('started_ns') if res else None
+    if started_ns is None or task.start_ns is None:
+        return None
+    return max(0, started_ns - task.start_ns) / 1e9
 
-        else:  # instance of Popen
-            self.task.result, self.task.error = self.process.communicate()
-            if self.process.returncode != 0:
-                self.task.state = State.Failed
-                logger.info('Task {} {} failed after {} seconds.'.format(self.task.id, self.task.func_name, duration))
 
+def kill_tree(pid):
+    """ kills a process and all its descendants """
+    try:
+        proc = psutil.Process(pid)
+        procs = proc.children(recursive=True) + [proc]
+    except psutil.NoSuchProcess:
+        return
+    for proc in procs:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def _open_pidfd(pid):
+    """ returns a file descriptor which becomes readable when the process exits,
+    or None when the platform does not support it
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+class TaskMonitor(Thread):
+    """ Thread used for monitoring the RSS memory and state of the running tasks.
+    A single monitor watches any number of tasks: it waits on the result pipes and
+    process sentinels to learn when a task is done, and samples the memory of
+    every running task once per sample_interval.
+    """
+
+    def __init__(self, sample_interval=SAMPLE_INTERVAL, memory_mode='rss'):
+        """
+        sample_interval: seconds between two memory samples of the running tasks
+        memory_mode: rss, uss or pss, how the memory of a process tree is counted, see ProcessTreeSampler
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.sample_interval = sample_interval
+        self.sampler = ProcessTreeSampler(memory_mode)
+        self.sample_count = 0
+        self.sample_time = 0.0
+        self.created_at = time.time()
+        self._watches = {}  # task id -> _Watch
+        self._waitables = {}  # object to wait on -> (_Watch, handler)
+        self._ready = []  # watches completed by a helper thread
+        self._lock = Lock()
+        self._wakeup_reader, self._wakeup_writer = Pipe(duplex=False)
+        self._wakeup_pending = False
+        self._running = False
+
+    def watch(self, task):
+        """ starts monitoring a task whose process was just started """
+        watch = _Watch(task)
+        with self._lock:
+            self._watches[task.id] = watch
+            if watch.worker is not None:
+                self._waitables[watch.worker.conn] = (watch, self._on_worker_result)
+                self._waitables[watch.process.sentinel] = (watch, self._on_worker_exit)
+
+            elif isinstance(watch.process, BaseProcess):
+                self._waitables[task.parent_conn] = (watch, self._on_result)
+                self._waitables[watch.process.sentinel] = (watch, self._on_exit)
+
+            else:  # instance of Popen
+                self._watch_popen(watch)
+
+            if not self._running:
+                self._running = True
+                self.start()
+            self._wake()
+
+    def _watch_popen(self, watch):
+        """ the lock must be held """
+        process = watch.process
+        if process.stdin is not None:
+            process.stdin.close()  # like communicate(), the command gets no input
+
+        streams = [stream for stream in (process.stdout, process.stderr) if stream is not None]
+        for stream, name in ((process.stdout, 'stdout'), (process.stderr, 'stderr')):
+            if stream is not None:
+                watch.output[stream] = open_output(watch.task.output, watch.task, name)
+        if os.name == 'nt':  # pipes cannot be waited on with the sockets
+            Thread(target=self._communicate, args=(watch,), daemon=True).start()
+            return
+
+        for stream in streams:
+            self._waitables[stream] = (watch, self._on_output)
+        watch.open_streams = len(streams)
+        watch.pidfd = _open_pidfd(watch.pid)
+        if watch.pidfd is None:
+            watch.poll = True
+        else:
+            self._waitables[watch.pidfd] = (watch, self._on_popen_exit)
+
+    def stop(self, task, state):
+        """ kills the process tree of a running task, which then ends in the given state
+        returns False if the task is not running
+        """
+        with self._lock:
+            watch = self._watches.get(task.id)
+            if watch is None:
+                return False
+            if watch.stopped_state is not None:
+                return True  # it is being killed already
+            watch.stopped_state = state
+        kill_tree(watch.pid)
+        return True
+
+    def _wake(self):
+        """ interrupts the wait of the monitor thread, the lock must be held """
+        if self._wakeup_pending or current_thread() is self:
+            return
+        self._wakeup_pending = True
+        self._wakeup_writer.send_bytes(b'')
+
+    def _on_result(self, watch, conn):
+        self._waitables.pop(conn, None)
+        try:
+            watch.res = conn.recv()
+        except (EOFError, OSError):
+            pass
+
+    def _on_exit(self, watch, sentinel):
+        del self._waitables[sentinel]
+        watch.exited = True
+        conn = watch.task.parent_conn
+        # poll is also true at the end of the pipe, which _on_result may have reached already
+        if watch.res is None and conn in self._waitables and conn.poll():
+            self._on_result(watch, conn)
+        self._waitables.pop(conn, None)
+
+    def _on_worker_result(self, watch, conn):
+        watch.res = watch.worker.receive()
+
+    def _on_worker_exit(self, watch, sentinel):
+        watch.res = watch.worker.receive()
+
+    def _on_output(self, watch, stream):
+        data = os.read(stream.fileno(), OUTPUT_CHUNK_SIZE)
+        if data:
+            try:
+                watch.output[stream].write(data)
+            except Exception:  # e.g. the disk of a spool is full, the pipe is still drained
+                logger.error(traceback.format_exc())
+        else:
+            del self._waitables[stream]
+            watch.open_streams -= 1
+
+    def _on_popen_exit(self, watch, pidfd):
+        del self._waitables[pidfd]
+        watch.process.poll()
+        watch.exited = True
+
+    def _communicate(self, watch):
+        """ reads the output of a Popen in a helper thread where pipes cannot be waited on """
+        out, err = watch.process.communicate()
+        for stream, data in ((watch.process.stdout, out), (watch.process.stderr, err)):
+            if stream is not None:
+                watch.output[stream].write(data)
+        with self._lock:
+            watch.exited = True
+            self._ready.append(watch)
+            self._wake()
+
+    def _sample(self, watches, prune=True):
+        """ records the memory of the process trees of the tasks, and the resources of the tasks which record them """
+        detailed = set(watch.pid for watch in watches if watch.task.record_resources)
+        mems, details = self.sampler.sample_details([watch.pid for watch in watches], detailed, prune=prune)
+        now = time.monotonic()
+        for watch in watches:
+            mem = mems.get(watch.pid)
+            if mem is None:
+                continue
+            watch.samples += 1
+            if mem > watch.max_mem:
+                watch.max_mem = mem
+                watch.task.max_mem = mem
+            if watch.pid in details:
+                self._record(watch, mem, details[watch.pid], now)
+
+    def _record(self, watch, mem, counters, now):
+        """ appends a sample to the resource series of a task """
+        if watch.baseline is None:
+            if watch.worker is not None:  # the worker ran other tasks, count from the first sample
+                watch.baseline = counters
+                watch.last_cpu = counters[0]
             else:
-                self.task.state = State.Succeeded
-                logger.info(
-                    'Task {} {} succeeded after {} seconds.'.format(self.task.id, self.task.func_name, duration))
+                watch.baseline = [0] * len(counters)
+        cpu_percent = max(0.0, 100.0 * (counters[0] - watch.last_cpu) / max(now - watch.last_time, 1e-6))
+        watch.last_cpu = counters[0]
+        watch.last_time = now
+        base = watch.baseline
+        watch.task.resources.append((time.time(), mem, cpu_percent, counters[1] - base[1],
+                                     counters[2] - base[2], counters[3] - base[3], counters[4]))
+
+    def get_stats(self):
+        """ returns a dict about the cost of monitoring """
+        elapsed = time.time() - self.created_at
+        return {'sample_interval': self.sample_interval,
+                'samples': self.sample_count,
+                'sample_seconds': self.sample_time,
+                'watched': len(self._watches),
+                'duty': self.sample_time / elapsed if elapsed > 0 else 0.0}
 
     def run(self):
         """ execution code """
-        while psutil.pid_exists(self.pid):
-            try:
-                if isinstance(self.process, Process):
-                    if not self.process.is_alive():
-                        break
+        next_sample = time.monotonic()
+        while True:
+            with self._lock:
+                self._wakeup_pending = False
+                waitables = list(self._waitables)
+                ready, self._ready = self._ready, []
+
+            with self._lock:
+                deadlines = [watch.deadline for watch in self._watches.values()
+                             if watch.deadline is not None and watch.stopped_state is None]
+            timeout = max(0.0, min([next_sample] + deadlines) - time.monotonic())
+            if ready:
+                timeout = 0
+            touched = {id(watch): watch for watch in ready}
+            for obj in wait(waitables + [self._wakeup_reader], timeout):
+                if obj is self._wakeup_reader:
+                    while self._wakeup_reader.poll():
+                        self._wakeup_reader.recv_bytes()
+                    continue
+                with self._lock:
+                    entry = self._waitables.get(obj)
+                    if entry is None:
+                        continue
+                    watch, handler = entry
+                    try:
+                        handler(watch, obj)
+                    except Exception:
+                        logger.error(traceback.format_exc())
+                        self._waitables.pop(obj, None)
+                    touched[id(watch)] = watch
+
+            with self._lock:
+                watches = list(self._watches.values())
+            for watch in watches:
+                if watch.poll and watch.process.poll() is not None:
+                    watch.exited = True
+                    touched[id(watch)] = watch
+
+            now = time.monotonic()
+            for watch in watches:
+                if watch.deadline is not None and now >= watch.deadline:
+                    self.stop(watch.task, State.TimedOut)
+
+            if now >= next_sample:
+                self._sample(watches)
+                cost = time.monotonic() - now
+                self.sample_count += 1
+                self.sample_time += cost
+                # never spend more than MAX_MONITOR_DUTY of a core on sampling
+                next_sample = now + max(self.sample_interval, cost / MAX_MONITOR_DUTY)
+            else:  # sample the tasks that started since the last sample
+                self._sample([watch for watch in watches if watch.samples == 0], prune=False)
+
+            for watch in touched.values():
+                if watch.is_done():
+                    self._complete(watch)
+
+    def _complete(self, watch):
+        """ stops watching a task and sets its results """
+        with self._lock:
+            self._watches.pop(watch.task.id, None)
+            for obj, entry in list(self._waitables.items()):
+                if entry[0] is watch:
+                    del self._waitables[obj]
+        if watch.pidfd is not None:
+            os.close(watch.pidfd)
+
+        try:
+            self._set_task_attrs(watch)
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            watch.task._release()
+            watch.task._finish()
+            if watch.worker is not None:
+                if watch.stopped_state is not None:
+                    watch.worker.process.join()  # it was killed, the pool replaces it
+                watch.worker.release()
+
+    def _set_task_attrs(self, watch):
+        """ precondition: the task of the watch is done """
+        task = watch.task
+        task.end_ns = time.monotonic_ns()
+        task.max_mem = watch.max_mem
+        duration = task.get_duration()
+
+        if watch.worker is not None:
+            res = _unpack(watch.res)
+            failed = res['error'] is not None
+            task.start_latency = _get_start_latency(task, res)
+            task._set_result(res['result'])
+            task.error = res['error']
+
+        elif isinstance(watch.process, BaseProcess):
+            res = _unpack(watch.res)
+            if res is None:
+                res = {'error': 'Process {} exited with exit code {} without sending a result'
+                       .format(watch.pid, watch.process.exitcode),
+                       'result': None}
+            failed = res['error'] is not None or watch.process.exitcode not in [0, None]
+            task.start_latency = _get_start_latency(task, res)
+            task._set_result(res['result'])
+            task.error = res['error']
+
+        else:  # instance of Popen
+            process = watch.process
+            process.wait()
+            task.result = watch.output[process.stdout].close() if process.stdout is not None else None
+            task.error = watch.output[process.stderr].close() if process.stderr is not None else None
+            failed = process.returncode != 0
+
+        if watch.stopped_state == State.TimedOut:
+            task.state = State.TimedOut
+            task.error = u'Task timed out after {} seconds.'.format(duration)
+            logger.info('Task {} {} timed out after {} seconds.'.format(task.id, task.func_name, duration))
+        elif watch.stopped_state == State.Cancelled:
+            task.state = State.Cancelled
+            task.error = u'Task was cancelled.'
+            logger.info('Task {} {} was cancelled after {} seconds.'.format(task.id, task.func_name, duration))
+        elif failed:
+            task.state = State.Failed
+            logger.info('Task {} {} failed after {} seconds.'.format(task.id, task.func_name, duration))
+        else:
+            task.state = State.Succeeded
+            logger.info('Task {} {} succeeded after {} seconds.'.format(task.id, task.func_name, duration))
 
-                else:  # instance of Popen
-                    if not self.process.poll():
-                        break
 
-                mem = get_total_mem(self.pid)
-                if mem > self.max_mem:
-                    self.max_mem = mem
-            except psutil.NoSuchProcess:
-                break
-            except Exception as ex:
-                break
+def _unpack(res):
+    """ returns the result dict sent by a task process, with a result sent through shared memory mapped """
+    try:
+        return unpack_result(res)
+    except Exception as ex:
+        return {'error': u'Could not read the result from shared memory: {}'.format(ex), 'result': None}
+
+
+_monitor = None
+_monitor_lock = Lock()
+_process = None
+
 
-            #time.sleep(DELAY)
+def _get_process():
+    """ returns the psutil.Process of this process """
+    global _process
+    if _process is None or _process.pid != os.getpid():
+        _process = psutil.Process()
+    return _process
 
-        self._set_task_attrs()
+
+def get_monitor():
+    """ returns the TaskMonitor shared by the tasks that are not given one """
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = TaskMonitor()
+        return _monitor
 
 
 def _get_sub_params(params, concurrency):
@@ -175,29 +610,59 @@ def _get_sub_params(params, concurrency):
     if concurrency is None or concurrency < 1 or concurrency >= len(params):
         return [params]
 
-    start = 0
-    end = concurrency
-    res = []
-    while start <= len(params):
-        res.append(params[start:end])
-        start += concurrency
-        end = min(end + concurrency, len(params))
+    return [params[start:start + concurrency] for start in range(0, len(params), concurrency)]
 
-    return res
 
+def _check_chunksize(chunksize):
+    """ raises a ValueError if chunksize is not None nor a positive int """
+    if chunksize is not None and chunksize < 1:
+        raise ValueError('chunksize must be at least 1, got {}'.format(chunksize))
+
+
+def _call_chunk(func, params, kwargs_list):
+    """ runs a function on each set of parameters
+    returns the list of results and the list of durations in seconds
+    """
+    results = []
+    durations = []
+    for args, kwargs in zip(params, kwargs_list):
+        start = time.time()
+        results.append(func(*args, **kwargs))
+        durations.append(time.time() - start)
+    return results, durations
 
-def parallel(func, params, **kwargs):
+
+def parallel(func, params, pool=None, chunksize=None, executor=None, **kwargs):
     """ runs a function with a set of parameters in parallel
     but does not wait for them to finish
     func: a function reference
     params: list of argument lists
+    pool: optional WorkerPool, if set the tasks run on its workers
+        instead of a new process per task
+    chunksize: optional int, if set each task runs the function on up to chunksize
+        sets of parameters and its result is the list of their results
+    executor: optional, process, thread or inline, see Task
+    kwargs: the keyword arguments of every call of func, or kwargs=[...] with a dict per argument list.
+        pool, chunksize and executor are options of parallel and are not passed to func, so a function
+        with a parameter of one of these names gets it through kwargs=[...], e.g. kwargs=[{'pool': 2}] * len(params)
     """
     if 'kwargs' in kwargs:
         assert isinstance(kwargs['kwargs'], list), 'kwargs Must be a list'
         assert len(kwargs['kwargs']) == len(params), 'The length of params and kwargs must match'
+    _check_chunksize(chunksize)
+    if chunksize is not None:
+        kwargs_list = kwargs['kwargs'] if 'kwargs' in kwargs else [kwargs] * len(params)
+        tasks = []
+        for start in range(0, len(params), chunksize):
+            task = ChunkTask(func, params[start:start + chunksize],
+                             kwargs_list[start:start + chunksize], pool=pool, executor=executor)
+            task.start()
+            tasks.append(task)
+        return tasks
+
     tasks = []
     for ind, param in enumerate(params):
-        task = Task(func)
+        task = Task(func, pool=pool, executor=executor)
         if 'kwargs' in kwargs:
             task.start(args=param, kwargs=kwargs['kwargs'][ind])
         else:
@@ -230,24 +695,218 @@ class TaskError(Exception):
                                         .format(task_id, func_name, args, kwargs, error))
 
 
-class Task(object):
+def _get_func_name(caller):
+    """ returns the name of a function or the encoded command """
+    if isinstance(caller, str):
+        return caller.encode('utf8')
+
+    elif caller is not None:
+        if hasattr(caller, '__qualname__'):  # python3
+            return caller.__qualname__
+
+        else:  # python2
+            return caller.func_name
+
+
+def _find_upstream(args, kwargs):
+    """ returns the Task objects which are arguments or keyword argument values.
+    The arguments are not searched any deeper, so a large argument costs nothing
+    """
+    found = []
+    seen = set()
+    for value in list(args or []) + list((kwargs or {}).values()):
+        if isinstance(value, Task) and id(value) not in seen:
+            seen.add(id(value))
+            found.append(value)
+    return found
+
+
+def _resolve_upstream(args, kwargs):
+    """ returns args and kwargs with the Task objects replaced by their result, it waits for them """
+    args = [value.wait() if isinstance(value, Task) else value for value in args or []]
+    kwargs = {key: value.wait() if isinstance(value, Task) else value for key, value in (kwargs or {}).items()}
+    return args, kwargs
+
+
+def _ns_to_datetime(ns):
+    """ converts a time.monotonic_ns() to a local datetime, or None """
+    return None if ns is None else datetime.fromtimestamp((ns + _EPOCH_NS) / 1e9)
+
+
+def _datetime_to_ns(value):
+    """ converts a datetime to a time.monotonic_ns(), or None """
+    return None if value is None else int(value.timestamp() * 1e9) - _EPOCH_NS
+
+
+class TaskRecord(object):
+    """ The stats and the result of a finished task, without its process, pipes and callbacks.
+    A pipeline keeps a TaskRecord of each finished Task, see Task.compact
+    """
+    __slots__ = ('id', 'func_name', 'group_id', 'state', 'start_ns', 'end_ns', 'max_mem', 'result', 'error',
+                 'cached', 'priority', 'queue_wait', 'start_latency', 'upstream_ids', 'resources', 'args', 'kwargs',
+                 'items', 'item_durations')
+
+    @property
+    def start_time(self):
+        """ the local datetime when the task started, it is kept as start_ns, a time.monotonic_ns() """
+        return _ns_to_datetime(self.start_ns)
+
+    @start_time.setter
+    def start_time(self, value):
+        self.start_ns = _datetime_to_ns(value)
+
+    @property
+    def end_time(self):
+        return _ns_to_datetime(self.end_ns)
+
+    @end_time.setter
+    def end_time(self, value):
+        self.end_ns = _datetime_to_ns(value)
+
+    def get_duration(self):
+        if self.end_ns is None or self.start_ns is None:
+            return None
+        return (self.end_ns - self.start_ns) / 1e9
+
+    def get_memory(self):
+        return self.max_mem
+
+    def get_item_duration(self):
+        """ returns the average duration of running the function on one set of parameters of a chunk """
+        if not self.item_durations:
+            return None
+        return sum(self.item_durations) / len(self.item_durations)
+
+    def get_resource_stats(self):
+        """ returns a dict resource -> the p50, p90, p99 and max of its samples, or the total for the
+        CUMULATIVE_RESOURCES, or None if the resources are not recorded
+        """
+        if self.resources is None:
+            return None
+        stats = {}
+        for name in RESOURCE_COLUMNS[1:]:
+            _, values = self.resources.get_column(name)
+            if not values:
+                continue
+            if name in CUMULATIVE_RESOURCES:
+                stats[name] = values[-1]
+                continue
+            _, highs = self.resources.get_column(name, agg='max')
+            values = sorted(values)
+            stats[name] = {'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9),
+                           'p99': percentile(values, 0.99), 'max': max(highs)}
+        return stats
+
+    def add_done_callback(self, callback):
+        """ calls callback(task) right away, the task is done """
+        callback(self)
+
+    def wait(self):
+        """ returns the result of the task, or raises a TaskError if it failed """
+        if self.state in FAILED_STATES:
+            raise TaskError(self.id, self.func_name, self.args, self.kwargs, self.error)
+        return self.result
+
+    def get_result(self):
+        """ waits for the task to end and returns the result """
+        return self.wait()
+
+    def _wait_done(self):
+        """ waits for the task to end, without raising if it failed """
+
+    def _stop(self, state):
+        """ returns False, the task is done """
+        return False
+
+    def get_stats(self):
+        """ returns a dict with stats about the task """
+        self._wait_done()
+        started = self.start_ns is not None and self.end_ns is not None
+        start_ts = (self.start_ns + _EPOCH_NS) / 1e9 if started else None
+        end_ts = (self.end_ns + _EPOCH_NS) / 1e9 if started else None
+        stats = {'id': self.id,
+                 'start': time.strftime('%H:%M:%S', time.localtime(start_ts)) if started else None,
+                 'end': time.strftime('%H:%M:%S', time.localtime(end_ts)) if started else None,
+                 'start_ts': start_ts,
+                 'end_ts': end_ts,
+                 'duration': self.get_duration(),
+                 'max_mem': self.max_mem,
+                 'func_name': self.func_name,
+                 'group_id': self.group_id,
+                 'state': self.state.name,
+                 'cached': self.cached,
+                 'upstream': list(self.upstream_ids),
+                 'priority': self.priority,
+                 'queue_wait': self.queue_wait,
+                 'start_latency': self.start_latency,
+                 'resources': self.get_resource_stats()}
+        if self.items is not None:  # a chunk
+            stats['items'] = self.items
+            stats['item_durations'] = self.item_durations
+        return stats
+
+
+class Task(TaskRecord):
     """ To execute a task """
+    __slots__ = ('timeout', 'reserved_mem', 'shm_threshold', 'caller', 'process', 'stdout', 'stderr', 'stdin',
+                 'output', 'executor', 'start_method', '_timer', 'parent_conn', 'child_conn', 'monitor', 'pool',
+                 'worker', '_done', '_callbacks', 'cache', '_cache_key', 'record_resources', 'queued_at', 'upstream',
+                 'journal_key', '_pending_upstream', '_waiting_for_mem', '__weakref__')
 
     def __init__(self, caller, args=[], kwargs={}, timeout=None,
                  stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                 stdin=subprocess.PIPE, group_id=None):
+                 stdin=subprocess.PIPE, group_id=None, pool=None, monitor=None,
+                 reserved_mem=None, shm_threshold=None, cache=None, record_resources=False, output=None,
+                 executor=None, start_method=None, priority=0):
         """
         caller: a function to run or a bash command in string
         args: list
         kwargs: dict
+            the Task objects in args and in the values of kwargs, not nested in other values,
+            are upstream tasks, they are replaced by their result
+            when the task starts. A pipeline starts the task once its upstream tasks succeeded.
         timeout: in seconds
         reserved_mem is in bytes. It's how much memory this task requires
             when using the Pipeline, it allows you to wait until there is enough
             memory in the operating system for the task to run successfully
         group_id: an integer to group tasks that were run with a single sync together
+        pool: optional WorkerPool, if set a function task is sent to one of its
+            persistent workers instead of starting a new process
+        monitor: optional TaskMonitor to watch the task, defaults to the one shared by all tasks
+        shm_threshold: optional int, if set a bytes, bytearray or NumPy array result of at least that many
+            bytes is sent through shared memory and the result is a view of it instead of a copy,
+            see bear.sharedmem
+        cache: optional, True or a ResultCache to memoize the result of a function,
+            a task with the same function and arguments as a cached one gets its result without running,
+            see bear.cache. It defaults to True if the function is decorated with bear.cached, False opts out
+        record_resources: if True, the memory, cpu percent, io bytes, context switches and threads
+            of the process tree are recorded at each sample in a TimeSeries, see get_resource_stats
+        output: optional, where the stdout and stderr pipes of a command go as they are read: a bear.output.Spool
+            writes them to files, which can be rotated, and the result and error are SpooledOutput with their tail
+            and a memory map of the file; a callable is called as output(task, name, line) for each line
+            on the monitor thread, and the result and error are the tail of the output.
+            By default the result and error are the whole output in bytes
+        executor: optional, how a function runs: process, the default, in a new process or on the workers of
+            the pool; thread, in a thread of this process, for I/O or code which releases the GIL;
+            inline, in the thread which starts the task, to avoid the cost of a thread or a process.
+            A thread or inline task cannot be killed: if it times out or is cancelled, it ends right away
+            but the function runs until it returns. Its memory is how much the memory of this process grew
+        start_method: optional, how the process of a function task starts: fork, spawn or forkserver,
+            defaults to the start method of multiprocessing. With forkserver, the process forks from a server
+            which can import heavy modules once, see preload. The seconds from the start of the task to the call
+            of its function are its start_latency
+        priority: int, the queued tasks of a pipeline with a higher priority start first, see Scheduler
         """
+        if executor is None:
+            executor = 'process'
+        if executor not in EXECUTORS:
+            raise ValueError('executor must be one of {}'.format(EXECUTORS))
+        if start_method is not None and start_method not in START_METHODS:
+            raise ValueError('start_method must be one of {}'.format(START_METHODS))
+        check_output(output)
         self.timeout = timeout
-        self.reserved_mem = None
+        self.reserved_mem = reserved_mem
+        self.shm_threshold = shm_threshold
         self.caller = caller
         self.args = args
         self.kwargs = kwargs
@@ -255,40 +914,43 @@ class Task(object):
         self.stdout = stdout
         self.stderr = stderr
         self.stdin = stdin
-        self.id = None
-        self.stdout = stdout
-        self.start_time = None
-        self.end_time = None
+        self.output = output
+        self.executor = executor
+        self.start_method = start_method
+        self._timer = None
+        self.id = next(_task_ids)
+        self.start_ns = None  # time.monotonic_ns(), see start_time
+        self.end_ns = None
         self.max_mem = 0
         self.state = State.Created
         self.parent_conn = None
         self.child_conn = None
         self.error = None
         self.result = None
-        self.func_name = None
-        self.monitor = None
+        self.monitor = monitor
         self.group_id = group_id
-        self.id = str(uuid.uuid4())
-
-        # set the task id and func_name:
-        if isinstance(self.caller, string_types):
-            name = self.caller.encode('utf8')
-            self.func_name = name
-
-        elif self.caller is not None:
-            if hasattr(self.caller, '__qualname__'):  # python3
-                self.func_name = self.caller.__qualname__
-
-            else:  # python2
-                self.func_name = self.caller.func_name
-
-    def get_duration(self):
-        if self.end_time is None:
-            return None
-        return (self.end_time - self.start_time).total_seconds()
-
-    def get_memory(self):
-        return self.max_mem
+        self.pool = pool
+        self.worker = None
+        self._done = Event()
+        self._callbacks = []
+        if cache is None:
+            cache = getattr(caller, '_bear_cache', None)
+        self.cache = get_cache() if cache is True else (None if cache is False else cache)
+        self.cached = None  # whether the result came from the cache
+        self._cache_key = None  # set while the task computes a result to cache
+        self.record_resources = record_resources
+        self.resources = None  # TimeSeries with the RESOURCE_COLUMNS
+        self.queued_at = None  # when a scheduler queued the task, time.monotonic()
+        self.priority = priority
+        self.queue_wait = None  # the seconds the task waited for a slot in a scheduler
+        self.start_latency = None  # the seconds from the start of the task to the call of its function
+        self.journal_key = None
+        self.items = None  # the number of parameter sets of a ChunkTask
+        self.item_durations = None
+
+        self.func_name = _get_func_name(self.caller)
+        self.upstream = _find_upstream(args, kwargs)
+        self.upstream_ids = tuple(task.id for task in self.upstream)
 
     def start(self, args=None, kwargs=None):
         if args:
@@ -297,12 +959,35 @@ class Task(object):
         if kwargs:
             self.kwargs = kwargs
 
+        if args or kwargs:  # the upstream tasks of the new arguments
+            self.upstream = _find_upstream(self.args, self.kwargs)
+            self.upstream_ids = tuple(task.id for task in self.upstream)
+
         if self.state == State.Succeeded:
+            self._finish()
             return  # skip
 
-        self.state = State.Started
-        self.start_time = datetime.now()
-        if isinstance(self.caller, string_types):
+        if self.upstream:
+            self.args, self.kwargs = _resolve_upstream(self.args, self.kwargs)
+
+        with _done_lock:
+            if self.state in DONE_STATES:
+                return  # cancelled or timed out before it started, e.g. while a scheduler was starting it
+            self._done.clear()
+            self.state = State.Started
+        if self.cache is not None and self._start_cached():
+            return
+
+        if self.executor != 'process' and callable(self.caller):
+            self._start_local()
+            return
+
+        if self.pool is not None and callable(self.caller):
+            self.pool.submit(self)  # the pool sets start_time once a worker picks it up
+            return
+
+        self.start_ns = time.monotonic_ns()
+        if isinstance(self.caller, str):
             self.process = subprocess.Popen(
                 self.caller,
                 stdout=self.stdout,
@@ -313,52 +998,256 @@ class Task(object):
 
         elif self.caller is not None:
             self.parent_conn, self.child_conn = Pipe()
-            xargs = [self.caller, self.child_conn] + list(self.args)
-            self.process = Process(target=callit, args=xargs, kwargs=self.kwargs)
+            conn = self.child_conn
+            if self.shm_threshold is not None:
+                sharedmem.prepare()
+                conn = ResultConnection(conn, self.shm_threshold)
+            xargs = [self.caller, conn] + list(self.args)
+            context = get_context(self.start_method)
+            if _forkserver_modules is None and context.get_start_method() == 'forkserver':
+                _forkserver_started()
+            self.process = context.Process(target=callit, args=xargs, kwargs=self.kwargs)
             self.process.start()
+            self.child_conn.close()  # the child has its own copy
 
         if self.process is not None:
             line = 'Task {} PID: {} is running {}{}, keywords:{}'
             line = line.format(self.id, self.process.pid,
                                self.func_name, self.args, self.kwargs)
             logger.info(line)
-            self.monitor = TaskMonitor(self)
-            self.monitor.start()
+            self._watch()
+
+    def _start_local(self):
+        """ runs the function in a thread, or in the calling thread if the executor is inline.
+        An inline task started from a done callback on a TaskMonitor thread runs in a thread,
+        the monitor would not watch the other tasks while it runs
+        """
+        self.start_ns = time.monotonic_ns()
+        inline = self.executor == 'inline' and not isinstance(current_thread(), TaskMonitor)
+        logger.info('Task {} is running {}{}, keywords:{} {}'.format(
+            self.id, self.func_name, self.args, self.kwargs, 'inline' if inline else 'in a thread'))
+        if inline:
+            self._run_local()
+            return
+
+        if self.timeout is not None:
+            self._timer = Timer(self.timeout, self._stop, [State.TimedOut])
+            self._timer.daemon = True
+            self._timer.start()
+        Thread(target=self._run_local, name='bear-task-{}'.format(self.id), daemon=True).start()
+
+    def _run_local(self):
+        """ runs the function in the current thread. The memory of the task is how much the memory
+        of this process grew, which is an estimate since its other threads allocate memory too
+        """
+        rss = _get_process().memory_info().rss
+        res = _call(self.caller, self.args, self.kwargs)
+        max_mem = max(0, _get_process().memory_info().rss - rss)
+        with _done_lock:
+            if self.state != State.Started:
+                return  # it timed out or was cancelled, its result is dropped
+            self.end_ns = time.monotonic_ns()
+            self.max_mem = max_mem
+            self.start_latency = _get_start_latency(self, res)
+            self._set_result(res['result'])
+            self.error = res['error']
+            self.state = State.Succeeded if self.error is None else State.Failed
+        if self._timer is not None:
+            self._timer.cancel()
+        logger.info('Task {} {} {} after {} seconds.'.format(
+            self.id, self.func_name, self.state.name.lower(), self.get_duration()))
+        self._finish()
+
+    def _start_cached(self):
+        """ returns True if the result is cached, or being computed by another task which it then copies """
+        key = self.cache.key(self)
+        if key is None:
+            return False
+        found, result = self.cache.get(key)
+        if not found:
+            running = self.cache.claim(key, self)
+            if running is None:
+                self.cached = False
+                self._cache_key = key
+                return False
+            self.start_ns = time.monotonic_ns()
+            running.add_done_callback(self._copy)
+            return True
+
+        self.start_ns = time.monotonic_ns()
+        self._finish_cached(result, None, State.Succeeded)
+        return True
+
+    def _copy(self, task):
+        """ finishes with the result of a task which ran the same function on the same arguments """
+        self._finish_cached(task.result, task.error, task.state)
+
+    def _finish_cached(self, result, error, state):
+        """ finishes with a result from the cache, unless the task was cancelled or timed out meanwhile """
+        with _done_lock:
+            if self.state in DONE_STATES:
+                return
+            self.result = result
+            self.error = error
+            self.state = state
+        self.cached = True
+        self.end_ns = time.monotonic_ns()
+        logger.info('Task {} {} got its result from the cache.'.format(self.id, self.func_name))
+        self._finish()
+
+    def _watch(self):
+        """ hands the started task to its TaskMonitor """
+        if self.monitor is None:
+            self.monitor = get_monitor()
+        self.monitor.watch(self)
+
+    def _set_result(self, result):
+        """ sets the result sent back by the process of the task """
+        self.result = result
+
+    def _release(self):
+        """ drops the process, the pipes and the worker of the finished task, their file descriptors are closed """
+        if self.parent_conn is not None:
+            self.parent_conn.close()
+        self.process = self.parent_conn = self.child_conn = self.worker = None
+
+    def add_done_callback(self, callback):
+        """ calls callback(task) once the task is done
+        the callback runs on the TaskMonitor thread,
+        or right away if the task is already done
+        """
+        with _done_lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self):
+        """ marks the task as done and notifies the callbacks """
+        if self._cache_key is not None:
+            self.cache.release(self._cache_key, self)  # cached before anyone sees the task done
+            self._cache_key = None
+
+        with _done_lock:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                logger.error(traceback.format_exc())
 
     def wait(self):
         """ waits for the task to finish """
         if self.state == State.Created:
             logger.warn('You have not run the task yet.')
+            return self.result
 
-        if self.state == State.Failed:
+        if self.state in FAILED_STATES:
             raise TaskError(self.id, self.func_name, self.args, self.kwargs, self.error)
 
         if self.state == State.Succeeded:
             return self.result
 
-        # otherwise state is 'Started'
-
-        self.result = self.monitor.task.result
-        if self.state == State.Failed:
+        # otherwise state is 'Started' or 'Queued'
+        self._done.wait()
+        if self.state in FAILED_STATES:
             raise TaskError(self.id, self.func_name, self.args, self.kwargs, self.error)
-
-        self.monitor.join()  # end monitoring
         return self.result
 
-    def get_result(self):
-        """ waits for the task to end and returns the result """
-        return self.wait()
+    def cancel(self):
+        """ cancels the task, its process tree is killed if it is running
+        returns False if the task had already finished
+        """
+        return self._stop(State.Cancelled)
+
+    def _stop(self, state):
+        """ ends the task in the given state, State.Cancelled or State.TimedOut """
+        if self.state in DONE_STATES:
+            return False
+
+        if self.state == State.Started and self.monitor is not None and self.monitor.stop(self, state):
+            return True  # the monitor finishes the task once its process is gone
+
+        # the task was not started, is queued in a pipeline or a pool, or runs in a thread which cannot be killed
+        with _done_lock:
+            if self.state in DONE_STATES:
+                return False
+            running = self.state == State.Started and self.executor != 'process' and self.start_ns is not None
+            self.state = state
+        self.end_ns = time.monotonic_ns()
+        if state == State.Cancelled:
+            self.error = u'Task was cancelled.'
+        elif running:
+            self.error = u'Task timed out after {} seconds.'.format(self.get_duration())
+        else:
+            self.error = u'Task timed out before it ran.'
+        if self.start_ns is None:
+            self.start_ns = self.end_ns
+        if running:
+            logger.info('Task {} {} was stopped, its thread runs until the function returns: {}'
+                        .format(self.id, self.func_name, state.name))
+        else:
+            logger.info('Task {} {} was stopped before it ran: {}'.format(self.id, self.func_name, state.name))
+        self._finish()
+        return True
+
+    def __await__(self):
+        """ awaits the result of the task from a coroutine, the task is started if it was not """
+        from bear.aio import as_future
+        return as_future(self).__await__()
+
+    def _wait_done(self):
+        if self.state in (State.Started, State.Queued):
+            self._done.wait()
 
     def get_stats(self):
-        """ returns a dict with stats about the task """
-        self.wait()
-        delta = self.end_time - self.start_time
-        return {'id': self.id,
-                'start': self.start_time.strftime("%H:%M:%S"),
-                'end': self.end_time.strftime("%H:%M:%S"),
-                'duration': delta.total_seconds(),
-                'max_mem': self.max_mem,
-                'func_name': self.func_name,
-                'group_id': self.group_id}
+        """ returns a dict with stats about the task, it waits for the task to finish """
+        return TaskRecord.get_stats(self)
+
+    def compact(self):
+        """ returns a TaskRecord of the finished task, which takes a fraction of its memory.
+        The arguments are only kept if the task failed, for its TaskError
+        """
+        record = TaskRecord()
+        for attr in TaskRecord.__slots__:
+            setattr(record, attr, getattr(self, attr))
+        if self.state not in FAILED_STATES:
+            record.args = record.kwargs = None
+        return record
+
+
+class ChunkTask(Task):
+    """ A task that runs a function on a chunk of parameter sets in a single process.
+    Its result is the list of results of each set of parameters.
+    """
+    __slots__ = ('func', 'params')
+
+    def __init__(self, func, params, kwargs_list=None, **options):
+        """
+        func: a function reference
+        params: list of argument lists
+        kwargs_list: optional list of keyword argument dicts, one per argument list
+        options: other arguments of the Task constructor
+        """
+        if kwargs_list is None:
+            kwargs_list = [{}] * len(params)
+        if options.get('cache') is None:
+            options['cache'] = getattr(func, '_bear_cache', None)
+        self.func = func
+        Task.__init__(self, _call_chunk, [func, params, kwargs_list], {}, **options)
+        self.func_name = _get_func_name(func)
+        self.params = params
+        self.items = len(params)
+
+    def _set_result(self, result):
+        if result is None:
+            self.result = None
+        else:
+            self.result, self.item_durations = result
 
 
+from bear.pool import WorkerPool  # noqa: E402 (needs the names above)
+from bear.cache import ResultCache, cached, get_cache  # noqa: E402
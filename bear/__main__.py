@@ -0,0 +1,37 @@
+"""
+The command line of bear
+usage: python -m bear worker --connect HOST:PORT [--authkey KEY] [--cores N]
+"""
+import sys
+import logging
+import argparse
+from bear.remote import Agent, RETRY_INTERVAL
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bear')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    worker = commands.add_parser('worker', help='runs the tasks of a Coordinator, see bear.remote')
+    worker.add_argument('--connect', required=True, help='HOST:PORT of the coordinator')
+    worker.add_argument('--authkey', help='the authkey of the coordinator, defaults to BEAR_AUTHKEY')
+    worker.add_argument('--cores', type=int, help='the number of tasks run at once, defaults to the number of cores')
+    worker.add_argument('--retry-interval', type=float, default=RETRY_INTERVAL,
+                        help='the seconds between two attempts to connect')
+    worker.add_argument('--max-retries', type=int,
+                        help='the number of failed attempts in a row after which the worker exits')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    host, port = args.connect.rsplit(':', 1)
+    try:
+        agent = Agent((host, int(port)), authkey=args.authkey, cores=args.cores,
+                      retry_interval=args.retry_interval, max_retries=args.max_retries)
+    except ValueError as ex:
+        parser.error(str(ex))
+    agent.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
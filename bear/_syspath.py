@@ -0,0 +1,17 @@
+"""
+Preloaded first by the forkserver of bear.preload. The server does not apply the sys.path of the process
+which starts it before it imports the preloaded modules, so the modules only found through that sys.path
+would not be preloaded. bear.preload passes it in the SYS_PATH_ENV environment variable and this module adds it.
+"""
+import os
+import sys
+from bear import SYS_PATH_ENV
+
+
+def _add_parent_path():
+    sys_path = os.environ.pop(SYS_PATH_ENV, None)
+    if sys_path:
+        sys.path.extend(path for path in sys_path.split(os.pathsep) if path not in sys.path)
+
+
+_add_parent_path()
@@ -0,0 +1,62 @@
+"""
+asyncio support: awaiting tasks and iterating over tasks as they finish from an event loop.
+The TaskMonitor thread hands the completion of a task to the loop with call_soon_threadsafe,
+so a loop can wait for any number of tasks without blocking and without a thread per task.
+"""
+import asyncio
+from queue import Queue
+from bear import State, TaskError, FAILED_STATES
+
+
+def _resolve(future, task):
+    if future.done():  # cancelled
+        return
+    if task.state in FAILED_STATES:
+        future.set_exception(TaskError(task.id, task.func_name, task.args, task.kwargs, task.error))
+    else:
+        future.set_result(task.result)
+
+
+def as_future(task, loop=None):
+    """
+    :param task: a Task object, it is started if it was not
+    :param loop: optional event loop, defaults to the running one
+    :return: an asyncio future with the result of the task, or its TaskError
+    """
+    loop = loop or asyncio.get_running_loop()
+    future = loop.create_future()
+    if task.state == State.Created:
+        task.start()
+    task.add_done_callback(lambda task: loop.call_soon_threadsafe(_resolve, future, task))
+    return future
+
+
+class CompletionIterator(object):
+    """ Iterates over tasks in the order they finish, with either for or async for """
+
+    def __init__(self, tasks):
+        """
+        :param tasks: list of Task objects which were started or queued
+        """
+        self.tasks = list(tasks)
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        done = Queue()
+        for task in self.tasks:
+            task.add_done_callback(done.put)
+        for _ in self.tasks:
+            yield done.get()
+
+    def __aiter__(self):
+        return self._aiter()
+
+    async def _aiter(self):
+        loop = asyncio.get_running_loop()
+        done = asyncio.Queue()
+        for task in self.tasks:
+            task.add_done_callback(lambda task: loop.call_soon_threadsafe(done.put_nowait, task))
+        for _ in self.tasks:
+            yield await done.get()
@@ -0,0 +1,247 @@
+"""
+This module memoizes the results of tasks, so a task which runs a function on the same arguments
+as a task which succeeded before gets its result without starting a process.
+
+A result is keyed by a hash of the source of the function, or its bytecode if the source is not
+available, and of its pickled arguments, so editing the function invalidates its results.
+Results are kept in memory, in least recently used order, and optionally in a directory on disk
+which is bounded in bytes. The disk tier is written by a thread, so the monitor thread never waits
+for pickling and writing a result. Only use it for functions whose result only depends on their arguments.
+"""
+import os
+import time
+import pickle
+import atexit
+import hashlib
+import traceback
+from collections import OrderedDict
+from queue import Queue
+from threading import Thread, Lock
+from bear import logger, State
+
+MAX_ENTRIES = 1024  # default number of results kept in memory
+MAX_BYTES = 1024 ** 3  # default size of the results kept on disk
+EVICT_RATIO = 0.9  # the disk tier is trimmed to that fraction of max_bytes when it is full
+_func_hashes = {}  # function -> hash of its code
+_default_cache = None
+
+
+def _hash_func(func):
+    """ returns a hash of the source of a function, or of its bytecode, or of its name """
+    digest = _func_hashes.get(func)
+    if digest is not None:
+        return digest
+
+    import inspect  # only imported by the tasks which are cached
+    name = '{}.{}'.format(getattr(func, '__module__', None), getattr(func, '__qualname__', func))
+    try:
+        code = inspect.getsource(func).encode('utf-8')
+    except (TypeError, OSError):
+        code = getattr(func, '__code__', None)
+        code = b'' if code is None else code.co_code + repr(code.co_consts).encode('utf-8')
+    digest = hashlib.sha256(name.encode('utf-8') + b'\0' + code).hexdigest()
+    _func_hashes[func] = digest
+    return digest
+
+
+class ResultCache(object):
+    """ A two tier cache of task results, in memory and on disk """
+
+    def __init__(self, max_entries=MAX_ENTRIES, path=None, max_bytes=MAX_BYTES, ttl=None):
+        """
+        :param max_entries: the number of results kept in memory, the least recently used ones are dropped
+        :param path: optional directory where results are also pickled, so they outlive the process
+        :param max_bytes: the size of the results kept in path, the least recently used ones are deleted
+        :param ttl: optional, seconds after which a result expires
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> (time stored, result)
+        self._running = {}  # key -> the task computing the result
+        self._lock = Lock()
+        self._disk_bytes = 0
+        self._queue = None  # (key, result) to write to the disk tier
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+            self._queue = Queue()
+            thread = Thread(target=self._run, name='bear-cache')
+            thread.daemon = True
+            thread.start()
+            atexit.register(self.flush)
+
+    def key(self, task):
+        """ returns the key of the result of a task, or None if its arguments cannot be pickled """
+        func = getattr(task, 'func', task.caller)
+        code = _hash_func(func) if callable(func) else func
+        try:
+            data = pickle.dumps((type(task).__name__, code, task.args, task.kwargs), protocol=4)
+        except Exception:
+            return None
+        return hashlib.sha256(data).hexdigest()
+
+    def _expired(self, stored):
+        return self.ttl is not None and time.time() - stored > self.ttl
+
+    def get(self, key):
+        """ returns (True, result) if the result of the key is cached, otherwise (False, None) """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+
+        found, result = self._read(key)
+        with self._lock:
+            if found:
+                self.hits += 1
+                self._remember(key, result)
+            else:
+                self.misses += 1
+        return found, result
+
+    def _read(self, key):
+        if self.path is None:
+            return False, None
+        path = os.path.join(self.path, key)
+        try:
+            stored = os.path.getmtime(path)
+            if self._expired(stored):
+                return False, None
+            with open(path, 'rb') as handle:
+                result = pickle.load(handle)
+            os.utime(path, (time.time(), stored))  # the access time orders the eviction
+            return True, result
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+
+    def _remember(self, key, result):
+        """ keeps a result in memory, the lock must be held """
+        self._memory[key] = (time.time(), result)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key, result):
+        """ caches the result of a key, it is written to the disk tier by a thread """
+        with self._lock:
+            self._remember(key, result)
+        if self._queue is not None:
+            self._queue.put((key, result))
+
+    def _run(self):
+        while True:
+            key, result = self._queue.get()
+            try:
+                self._write(key, result)
+            except Exception:
+                logger.error(traceback.format_exc())
+            finally:
+                self._queue.task_done()
+
+    def flush(self):
+        """ waits until the queued results are written to the disk tier, it is called at exit """
+        if self._queue is not None:
+            self._queue.join()
+
+    def _write(self, key, result):
+        if isinstance(result, memoryview):
+            result = result.tobytes()  # e.g. a result received through shared memory
+        data = pickle.dumps(result, protocol=4)
+        if len(data) > self.max_bytes:
+            return
+        path = os.path.join(self.path, key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as handle:
+            handle.write(data)
+        try:
+            replaced = os.path.getsize(path)  # the result of the key was stored before
+        except OSError:
+            replaced = 0
+        os.replace(temp_path, path)
+        with self._lock:
+            self._disk_bytes += len(data) - replaced
+            if self._disk_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """ deletes the least recently used results until the disk tier is under its limit,
+        the lock must be held
+        """
+        entries = sorted((entry for entry in os.scandir(self.path) if entry.is_file()),
+                         key=lambda entry: entry.stat().st_atime)
+        self._disk_bytes = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._disk_bytes <= self.max_bytes * EVICT_RATIO:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                self._disk_bytes -= size
+            except OSError:
+                pass
+
+    def claim(self, key, task):
+        """ returns the task which is computing the result of the key,
+        or None in which case the task is the one computing it
+        """
+        with self._lock:
+            running = self._running.get(key)
+            if running is None:
+                self._running[key] = task
+            else:  # the task gets the result of the running one, get counted it as a miss
+                self.misses -= 1
+                self.hits += 1
+            return running
+
+    def release(self, key, task):
+        """ caches the result of a finished task which claimed the key """
+        with self._lock:
+            if self._running.get(key) is task:
+                del self._running[key]
+        if task.state == State.Succeeded:
+            self.put(key, task.result)
+
+    def clear(self):
+        """ drops the results kept in memory and on disk """
+        self.flush()
+        with self._lock:
+            self._memory.clear()
+            if self.path is not None:
+                for entry in os.scandir(self.path):
+                    os.remove(entry.path)
+                self._disk_bytes = 0
+
+    def get_stats(self):
+        """ returns a dict with the hits, the misses and the size of the cache """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._memory),
+                    'disk_bytes': self._disk_bytes}
+
+
+def get_cache():
+    """ returns the cache used by the tasks created with cache=True, it is kept in ~/.bear/cache """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache(path=os.path.join(os.path.expanduser('~'), '.bear', 'cache'))
+    return _default_cache
+
+
+def cached(func=None, cache=None):
+    """ decorates a function so that its tasks are memoized, with @cached or @cached(cache=ResultCache(...))
+    :param func: the function
+    :param cache: optional ResultCache, defaults to the one returned by get_cache
+    The function itself is returned, so it can still be pickled and sent to a process.
+    """
+    def decorate(func):
+        func._bear_cache = cache or True
+        return func
+
+    if func is None:
+        return decorate
+    return decorate(func)
@@ -0,0 +1,209 @@
+"""
+This module checkpoints the tasks of a pipeline so that a pipeline which is run again
+restores the tasks which already succeeded instead of running them again.
+
+A task is identified by the qualified name of its function, or its command,
+and a hash of its arguments. Each finished task appends a line with its TASK_CLONED_ATTRS
+to an append-only journal and its result is stored in a file named after the hash of its content,
+so identical results are stored once. The journal is written and synced to disk by a thread,
+in batches, so the tasks and the monitor thread never wait for the disk.
+"""
+import os
+import json
+import time
+import pickle
+import atexit
+import hashlib
+import traceback
+from io import BytesIO
+from queue import Queue, Empty
+from datetime import datetime
+from threading import Thread
+from bear import logger, State, Task, TASK_CLONED_ATTRS
+
+SYNC_INTERVAL = 0.5  # seconds between two syncs of the journal to disk
+JOURNAL_ATTRS = [attr for attr in TASK_CLONED_ATTRS if attr not in ('args', 'kwargs', 'result', 'id')]
+_STOP = object()
+
+
+class _KeyPickler(pickle.Pickler):
+    """ pickles the upstream tasks in the arguments of a task as their key """
+
+    def persistent_id(self, obj):
+        if isinstance(obj, Task):
+            key = getattr(obj, 'journal_key', None)
+            if key is None:
+                raise pickle.PicklingError('The upstream task {} has no key'.format(obj.id))
+            return key
+        return None
+
+
+def task_key(task):
+    """ returns the key identifying the work of a task, or None if its arguments cannot be hashed.
+    An upstream task in the arguments is hashed as its own key, which must be set as its journal_key.
+    """
+    caller = task.caller
+    if callable(caller):
+        name = '{}.{}'.format(getattr(caller, '__module__', None), _get_qualname(caller))
+    else:
+        name = caller
+    data = BytesIO()
+    try:
+        _KeyPickler(data, protocol=4).dump((type(task).__name__, name, task.args, task.kwargs))
+    except Exception:
+        return None
+    return hashlib.sha256(data.getvalue()).hexdigest()
+
+
+def _get_qualname(caller):
+    return getattr(caller, '__qualname__', None) or getattr(caller, '__name__', repr(caller))
+
+
+def _to_json(attr, value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, State):
+        return value.name
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _from_json(attr, value):
+    if value is None:
+        return None
+    if attr in ('start_time', 'end_time'):
+        return datetime.fromisoformat(value)
+    if attr == 'state':
+        return State[value]
+    return value
+
+
+class Journal(object):
+    """ An append-only journal of the tasks which succeeded, with their results stored by content """
+
+    def __init__(self, path):
+        """
+        :param path: the directory of the journal, it is created if it does not exist
+        """
+        self.path = path
+        self.results_path = os.path.join(path, 'results')
+        os.makedirs(self.results_path, exist_ok=True)
+        self.journal_path = os.path.join(path, 'journal.jsonl')
+        self._records = self._load()
+        self._file = open(self.journal_path, 'a')
+        self._queue = Queue()
+        self._unsynced = []  # result files written since the last sync
+        self._thread = Thread(target=self._run, name='bear-journal')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _load(self):
+        """ returns a dict key -> record of the tasks in the journal """
+        records = {}
+        if not os.path.exists(self.journal_path):
+            return records
+        with open(self.journal_path) as handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line that was not fully written when the pipeline stopped
+                records[record['key']] = record
+        return records
+
+    def _result_path(self, digest):
+        return os.path.join(self.results_path, digest[:2], digest[2:])
+
+    def restore(self, task, key):
+        """
+        :param task: a Task object which has not started
+        :param key: the key of the task, see task_key
+        :return: True if the task succeeded in a previous run, in which case its attributes
+            and its result are restored and it is done
+        """
+        record = self._records.get(key)
+        if record is None:
+            return False
+        try:
+            with open(self._result_path(record['result']), 'rb') as handle:
+                result = pickle.load(handle)
+        except Exception:
+            logger.warning('The result of task {} {} cannot be read, it runs again.'
+                           .format(record['id'], record['func_name']))
+            return False
+
+        for attr in JOURNAL_ATTRS:
+            setattr(task, attr, _from_json(attr, record.get(attr)))
+        task.result = result
+        logger.info('Task {} {} was restored from the journal.'.format(task.id, task.func_name))
+        task._finish()
+        return True
+
+    def record(self, task, key):
+        """ queues a finished task to be written to the journal if it succeeded """
+        if task.state == State.Succeeded:
+            self._queue.put((key, task, task.result))  # the result is kept even if the task drops it
+
+    def _write(self, key, task, result):
+        if isinstance(result, memoryview):
+            result = result.tobytes()  # e.g. a result received through shared memory
+        data = pickle.dumps(result, protocol=4)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._result_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'wb') as handle:
+                handle.write(data)
+            os.replace(temp_path, path)  # the file is either complete or absent
+            self._unsynced.append(path)
+
+        record = {attr: _to_json(attr, getattr(task, attr)) for attr in JOURNAL_ATTRS}
+        record['id'] = task.id  # the ids are only unique within a run, a restored task keeps its new one
+        record['key'] = key
+        record['result'] = digest
+        self._file.write(json.dumps(record) + '\n')
+
+    def _sync(self):
+        """ syncs the results before the journal lines pointing to them """
+        for path in self._unsynced:
+            with open(path, 'rb') as handle:
+                os.fsync(handle.fileno())
+        self._unsynced = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _run(self):
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            timeout = max(0.0, last_sync + SYNC_INTERVAL - time.monotonic()) if dirty else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = None
+            if item is _STOP:
+                break
+
+            if item is not None:
+                try:
+                    self._write(*item)
+                    dirty = True
+                except Exception:
+                    logger.error(traceback.format_exc())
+
+            if dirty and time.monotonic() - last_sync >= SYNC_INTERVAL:
+                self._sync()
+                dirty = False
+                last_sync = time.monotonic()
+
+        self._sync()
+        self._file.close()
+
+    def close(self):
+        """ writes the queued tasks and syncs the journal, it is called at exit """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
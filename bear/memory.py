@@ -0,0 +1,127 @@
+"""
+This module samples the memory and the other resources used by process trees
+"""
+import os
+import psutil
+
+MEMORY_MODES = ['rss', 'uss', 'pss']
+# the counters of a process tree returned by ProcessTreeSampler.sample_details
+DETAIL_COUNTERS = ['cpu_seconds', 'read_bytes', 'write_bytes', 'ctx_switches', 'threads']
+_PROC_CHILDREN = os.path.exists('/proc/self/task/{}/children'.format(os.getpid()))
+
+
+def _read_children(pid):
+    """ returns the pids of the direct children of a process from /proc (Linux) """
+    children = []
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+        with open('/proc/{}/task/{}/children'.format(pid, tid), 'rb') as handle:
+            children.extend(int(child) for child in handle.read().split())
+    return children
+
+
+class ProcessTreeSampler(object):
+    """ Samples the memory of process trees.
+    Each tree is walked once per sample and the psutil.Process handles are kept
+    between samples, so sampling a tree costs a few reads per process in it.
+    """
+
+    def __init__(self, mode='rss'):
+        """
+        :param mode: the memory counted for each process:
+            rss: resident memory, pages shared between the processes of a tree are counted in each of them
+            uss: memory unique to the process, which is what is freed when it exits
+            pss: resident memory with the shared pages divided between the processes sharing them (Linux only)
+            uss and pss are much more expensive to read than rss and can require more privileges
+        """
+        if mode not in MEMORY_MODES:
+            raise ValueError('mode must be one of {}'.format(MEMORY_MODES))
+        if mode == 'pss' and not psutil.LINUX:
+            raise ValueError('pss is only available on Linux')
+        self.mode = mode
+        self._procs = {}  # pid -> psutil.Process
+
+    def _process(self, pid):
+        proc = self._procs.get(pid)
+        if proc is None:
+            proc = self._procs[pid] = psutil.Process(pid)
+        return proc
+
+    def _children_map(self):
+        """ returns a dict pid -> list of child pids of all the processes """
+        children = {}
+        for proc in psutil.process_iter(['ppid']):
+            children.setdefault(proc.info['ppid'], []).append(proc.pid)
+        return children
+
+    def _memory(self, proc):
+        if self.mode == 'rss':
+            return proc.memory_info().rss
+        return getattr(proc.memory_full_info(), self.mode)
+
+    def _counters(self, proc):
+        """ returns the DETAIL_COUNTERS of a process """
+        with proc.oneshot():
+            cpu = proc.cpu_times()
+            try:
+                io = proc.io_counters()
+                read_bytes, write_bytes = io.read_bytes, io.write_bytes
+            except (psutil.AccessDenied, AttributeError):  # not permitted, or not available on the platform
+                read_bytes = write_bytes = 0
+            ctx = proc.num_ctx_switches()
+            return [cpu.user + cpu.system, read_bytes, write_bytes, ctx.voluntary + ctx.involuntary,
+                    proc.num_threads()]
+
+    def sample(self, pids, prune=True):
+        """
+        :param pids: list of the pids at the root of the trees
+        :param prune: if True, the handles of the processes outside these trees are dropped
+        :return: a dict root pid -> memory in bytes of the process and all its descendants.
+            The pids of processes that do not exist anymore are left out.
+        """
+        return self.sample_details(pids, (), prune)[0]
+
+    def sample_details(self, pids, detailed, prune=True):
+        """
+        :param pids: list of the pids at the root of the trees
+        :param detailed: the root pids for which the DETAIL_COUNTERS are also read, which costs more
+        :param prune: if True, the handles of the processes outside these trees are dropped
+        :return: a tuple of 2 dicts, root pid -> memory in bytes of the process and all its descendants,
+            and root pid -> list of the DETAIL_COUNTERS summed over the tree for the detailed pids
+        """
+        children_map = None if _PROC_CHILDREN else self._children_map()
+        seen = set()
+        res = {}
+        details = {}
+        for root in pids:
+            total = 0
+            found = False
+            counters = [0] * len(DETAIL_COUNTERS) if root in detailed else None
+            stack = [root]
+            while stack:
+                pid = stack.pop()
+                if pid in seen:
+                    continue
+                seen.add(pid)
+                try:
+                    proc = self._process(pid)
+                    total += self._memory(proc)
+                    if counters is not None:
+                        counters = [val + new for val, new in zip(counters, self._counters(proc))]
+                    if children_map is None:
+                        stack.extend(_read_children(pid))
+                    else:
+                        stack.extend(children_map.get(pid, []))
+                except (psutil.Error, OSError):
+                    continue  # the process exited or cannot be read
+                if pid == root:
+                    found = True
+            if found:
+                res[root] = total
+                if counters is not None:
+                    details[root] = counters
+
+        if prune:
+            for pid in list(self._procs):
+                if pid not in seen:
+                    del self._procs[pid]
+        return res, details
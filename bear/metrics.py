@@ -0,0 +1,201 @@
+"""
+This module keeps live metrics of the tasks of a pipeline and serves them over HTTP
+in the Prometheus text format, so a long run can be watched while it runs.
+
+The scheduler updates counters and histograms as tasks are queued, started and done,
+so a scrape only formats the current values, whatever the number of tasks.
+"""
+import time
+import bisect
+from threading import Lock, Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bear import State
+
+DURATION_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600]
+MEMORY_BUCKETS = [1024 ** 2 * 4 ** exp for exp in range(9)]  # from 1 MB to 64 GB
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    """ Counts observations in cumulative buckets, like a Prometheus histogram """
+
+    def __init__(self, buckets):
+        """
+        :param buckets: sorted list of the upper bounds of the buckets, a +Inf bucket is added
+        """
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def get(self):
+        """ returns a dict with the cumulative count of each bucket, the sum and the count """
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        bounds = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {'buckets': list(zip(bounds, cumulative)), 'sum': self.sum, 'count': self.count}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(name, _escape(value)) for name, value in sorted(labels.items())) + '}'
+
+
+class Metrics(object):
+    """ The live counts of the tasks per group_id and func_name, with histograms of their duration,
+    peak memory and queue wait time, and the last sample of a SystemMonitor
+    """
+
+    def __init__(self, system_monitor=None):
+        """
+        :param system_monitor: optional SystemMonitor whose last sample is reported
+        """
+        self.system_monitor = system_monitor
+        self.created_at = time.time()
+        self._lock = Lock()
+        self._queued = {}  # (group_id, func_name) -> count
+        self._running = {}
+        self._finished = {}  # (group_id, func_name, state name) -> count
+        self._started = set()  # the ids of the running tasks
+        self._durations = {}  # func_name -> Histogram
+        self._memory = {}
+        self._queue_wait = Histogram(DURATION_BUCKETS)
+        self._server = None
+
+    def on_queued(self, task):
+        """ called when the scheduler queues a task """
+        key = (task.group_id, task.func_name)
+        with self._lock:
+            self._queued[key] = self._queued.get(key, 0) + 1
+        task.add_done_callback(self.on_done)
+
+    def on_started(self, task, queue_wait):
+        """ called when the scheduler starts a task which waited queue_wait seconds """
+        key = (task.group_id, task.func_name)
+        with self._lock:
+            self._queued[key] -= 1
+            self._running[key] = self._running.get(key, 0) + 1
+            self._started.add(task.id)
+            self._queue_wait.observe(queue_wait)
+
+    def on_done(self, task):
+        key = (task.group_id, task.func_name)
+        duration = task.get_duration()
+        with self._lock:
+            if task.id in self._started:
+                self._started.discard(task.id)
+                self._running[key] -= 1
+            else:  # it did not start, e.g. it was cancelled or its upstream task failed
+                self._queued[key] -= 1
+            state_key = key + (task.state.name,)
+            self._finished[state_key] = self._finished.get(state_key, 0) + 1
+            if duration is not None and task.state != State.Cancelled:
+                if task.func_name not in self._durations:
+                    self._durations[task.func_name] = Histogram(DURATION_BUCKETS)
+                    self._memory[task.func_name] = Histogram(MEMORY_BUCKETS)
+                self._durations[task.func_name].observe(duration)
+                self._memory[task.func_name].observe(task.max_mem)
+
+    def get(self):
+        """ returns a dict with the current value of every metric """
+        with self._lock:
+            res = {'queued': dict(self._queued),
+                   'running': dict(self._running),
+                   'finished': dict(self._finished),
+                   'duration': {name: hist.get() for name, hist in self._durations.items()},
+                   'max_mem': {name: hist.get() for name, hist in self._memory.items()},
+                   'queue_wait': self._queue_wait.get()}
+        res['system'] = None
+        if self.system_monitor is not None:
+            res['system'] = self.system_monitor.series.recent.last()
+        return res
+
+    def render(self):
+        """ returns the metrics in the Prometheus text exposition format """
+        values = self.get()
+        lines = []
+
+        def add(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, labels, value))
+
+        add('bear_tasks_queued', 'gauge', 'Tasks waiting for a slot or for their upstream tasks.',
+            [('', _labels(group_id=group, func_name=func), count)
+             for (group, func), count in sorted(values['queued'].items(), key=str)])
+        add('bear_tasks_running', 'gauge', 'Tasks running.',
+            [('', _labels(group_id=group, func_name=func), count)
+             for (group, func), count in sorted(values['running'].items(), key=str)])
+        add('bear_tasks_finished', 'counter', 'Tasks done, by final state.',
+            [('_total', _labels(group_id=group, func_name=func, state=state), count)
+             for (group, func, state), count in sorted(values['finished'].items(), key=str)])
+
+        def histogram(hist, **labels):
+            samples = [('_bucket', _labels(le=bound, **labels), count) for bound, count in hist['buckets']]
+            samples.append(('_sum', _labels(**labels) if labels else '', hist['sum']))
+            samples.append(('_count', _labels(**labels) if labels else '', hist['count']))
+            return samples
+
+        add('bear_task_duration_seconds', 'histogram', 'Duration of the finished tasks.',
+            [sample for func, hist in sorted(values['duration'].items()) for sample in histogram(hist, func_name=func)])
+        add('bear_task_max_memory_bytes', 'histogram', 'Peak memory of the finished tasks.',
+            [sample for func, hist in sorted(values['max_mem'].items()) for sample in histogram(hist, func_name=func)])
+        add('bear_task_queue_wait_seconds', 'histogram', 'Time the started tasks waited in the queue.',
+            histogram(values['queue_wait']))
+
+        system = values['system']
+        if system is not None:
+            for column, value in system.items():
+                if column != 'timestamp':
+                    add('bear_system_{}'.format(column), 'gauge', 'Last sample of the system monitor.',
+                        [('', '', value)])
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """
+        :param port: the port of the HTTP server, 0 picks a free one
+        :param host: the interface to listen on
+        :return: the port the metrics are served on at /metrics, by a daemon thread
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # scrapes are not logged
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        thread = Thread(target=self._server.serve_forever, name='bear-metrics')
+        thread.daemon = True
+        thread.start()
+        return self._server.server_address[1]
+
+    def close(self):
+        """ stops the HTTP server """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
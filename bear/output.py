@@ -0,0 +1,210 @@
+"""
+This module consumes the stdout and stderr of the shell command tasks as the TaskMonitor reads them,
+so a command which writes gigabytes of logs does not have to be kept in the memory of the pipeline.
+
+The output option of a Task tells where the output goes:
+    None: it is kept in memory, the result and the error are bytes
+    a Spool: it is written to files which can be rotated, the result and the error are SpooledOutput,
+        with the tail of the output in memory and a memory map of the file
+    a callable: it is called as callback(task, name, line) for each line, with name stdout or stderr,
+        the result and the error are the tail of the output
+"""
+import os
+import mmap
+import logging
+import tempfile
+import traceback
+
+TAIL_SIZE = 65536  # the bytes of the end of the output which are kept in memory
+logger = logging.getLogger('bear')
+
+
+class _Tail(object):
+    """ keeps the last size bytes written """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+        if len(self.data) > 2 * self.size:
+            del self.data[:-self.size]
+
+    def getvalue(self):
+        return bytes(self.data[-self.size:]) if self.size else b''
+
+
+class MemoryOutput(object):
+    """ keeps the whole output in memory """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        """ returns the output as bytes """
+        return b''.join(self.chunks)
+
+
+class CallbackOutput(object):
+    """ calls a function with each line of the output """
+
+    def __init__(self, callback, task, name, tail_size=TAIL_SIZE):
+        self.callback = callback
+        self.task = task
+        self.name = name
+        self.tail = _Tail(tail_size)
+        self.pending = b''  # the start of a line which is not complete yet
+
+    def write(self, data):
+        self.tail.write(data)
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self._call(line)
+
+    def _call(self, line):
+        try:
+            self.callback(self.task, self.name, line)
+        except Exception:
+            logger.error(traceback.format_exc())
+
+    def close(self):
+        """ calls the function with the last line if it did not end with a new line, and returns the tail """
+        if self.pending:
+            self._call(self.pending)
+            self.pending = b''
+        return self.tail.getvalue()
+
+
+class Spool(object):
+    """ How the output of the commands is spooled to files """
+
+    def __init__(self, directory=None, max_bytes=None, backup_count=0, tail_size=TAIL_SIZE):
+        """
+        :param directory: optional, the directory of the files, defaults to the temporary directory
+        :param max_bytes: optional, the size at which a file is rotated: it is renamed with a .1 suffix,
+            the previous .1 becomes .2 and so on, and a new file is started
+        :param backup_count: the number of rotated files which are kept, the older ones are deleted
+        :param tail_size: the bytes of the end of the output which are kept in memory
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.tail_size = tail_size
+
+    def open(self, task, name):
+        """ returns a SpoolWriter for the stdout or the stderr of a task """
+        directory = self.directory or tempfile.gettempdir()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'bear-{}-{}-{}.log'.format(os.getpid(), task.id, name))
+        return SpoolWriter(path, self.max_bytes, self.backup_count, self.tail_size)
+
+
+class SpoolWriter(object):
+    """ writes an output to a file, which is rotated when it reaches max_bytes """
+
+    def __init__(self, path, max_bytes=None, backup_count=0, tail_size=TAIL_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.tail = _Tail(tail_size)
+        self.size = 0  # all the bytes written, including the rotated ones
+        self.file_size = 0
+        self.rotations = 0
+        self._file = open(path, 'wb')
+
+    def write(self, data):
+        self.tail.write(data)
+        self.size += len(data)
+        while self.max_bytes and self.file_size + len(data) > self.max_bytes:
+            room = self.max_bytes - self.file_size
+            self._file.write(data[:room])
+            data = data[room:]
+            self._rotate()
+        self._file.write(data)
+        self.file_size += len(data)
+
+    def _rotate(self):
+        self._file.close()
+        if self.backup_count:
+            for index in range(self.backup_count - 1, 0, -1):
+                source = '{}.{}'.format(self.path, index)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(self.path, index + 1))
+            os.replace(self.path, self.path + '.1')
+        self.rotations += 1
+        self._file = open(self.path, 'wb')
+        self.file_size = 0
+
+    def close(self):
+        """ returns a SpooledOutput """
+        self._file.close()
+        backups = min(self.rotations, self.backup_count)
+        paths = ['{}.{}'.format(self.path, index) for index in range(backups, 0, -1)] + [self.path]
+        return SpooledOutput(paths, self.size, self.tail.getvalue())
+
+
+class SpooledOutput(object):
+    """ The output of a command spooled to files """
+
+    def __init__(self, paths, size, tail):
+        """
+        :param paths: the files of the output from the oldest to the newest, which is the one that was written last
+        :param size: the number of bytes of the output, including the ones of the rotated files which were deleted
+        :param tail: bytes, the end of the output
+        """
+        self.paths = paths
+        self.path = paths[-1]
+        self.size = size
+        self.tail = tail
+
+    def __repr__(self):
+        return 'SpooledOutput({!r}, size={})'.format(self.path, self.size)
+
+    def mmap(self, path=None):
+        """ returns a read-only memory map of the newest file, or of path, which is b'' if the file is empty.
+        Without rotation it is the whole output
+        """
+        with open(path or self.path, 'rb') as handle:
+            if os.fstat(handle.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self):
+        """ returns the bytes of the output which are still in the files """
+        data = []
+        for path in self.paths:
+            with open(path, 'rb') as handle:
+                data.append(handle.read())
+        return b''.join(data)
+
+    def remove(self):
+        """ deletes the files """
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def check_output(output):
+    """ raises a ValueError if output is not an output option, see the module docstring """
+    if output is not None and not isinstance(output, Spool) and not callable(output):
+        raise ValueError('output must be None, a Spool or a callable, not {!r}'.format(output))
+
+
+def open_output(output, task, name):
+    """
+    :param output: the output option of a task, see the module docstring
+    :param task: the task
+    :param name: stdout or stderr
+    :return: an object with write(bytes) and close() which returns the result or the error of the task
+    """
+    if output is None:
+        return MemoryOutput()
+    if isinstance(output, Spool):
+        return output.open(task, name)
+    check_output(output)
+    return CallbackOutput(output, task, name)
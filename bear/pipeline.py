@@ -1,99 +1,472 @@
 import os
 import time
 import json
-from bear import Task, State, DELAY, SystemMonitor, plotting
+import asyncio
+from collections import deque
+from itertools import islice
+from queue import Queue
+from threading import Timer
+from bear import Task, ChunkTask, _get_sub_params, _check_chunksize, State, DELAY, SAMPLE_INTERVAL
+from bear import SystemMonitor, TaskMonitor, get_monitor
+from bear import preload as preload_modules
+from bear.scheduler import Scheduler
+from bear.aio import as_future, CompletionIterator
+from bear.journal import Journal, task_key
+from bear.metrics import Metrics
+from bear.stats import StatsWriter
+from bear.timeseries import percentile
+
+CHUNK_DURATION = 0.5  # seconds that a chunk of an adaptive chunksize aims to run
+PROBE_CHUNKS = 2  # the single item chunks an adaptive chunksize runs at once until it measured an item
 
 
 class Pipeline(object):
     """ orchestrates a pipeline """
 
-    def __init__(self, resume=False, resume_path=None, memory_monitor_interval=None):
+    def __init__(self, resume=False, resume_path=None, memory_monitor_interval=None, pool=None,
+                 concurrency=None, sample_interval=None, memory_mode=None, mem_limit=None,
+                 shm_threshold=None, timeout=None, deadline=None, cache=None, record_resources=False,
+                 metrics=False, metrics_port=None, stats_path=None, stats_format='jsonl', compact=True,
+                 executor=None, start_method=None, preload=None):
         """
-        :param resume: boolean, default=False, set to True to be able to save the state and resume if some tasks fail
-        :param resume_path: optional, where to save the pipeline state used to resume
-        :param memory_monitor_interval: optional, if set, the pipeline monitors system memory on this interval in seconds
+        :param resume: boolean, default=False, set to True to journal the tasks which succeed, a pipeline
+            which is run again with resume restores them with their results instead of running them again
+        :param resume_path: optional, the directory of the journal used to resume, defaults to ~/.bear
+        :param memory_monitor_interval: optional, if set, the pipeline records the memory, cpu, swap and load
+            of the system on this interval in seconds, see SystemMonitor
+        :param pool: optional WorkerPool, if set function tasks run on its persistent workers
+        :param concurrency: optional, the maximum number of tasks running at once across all parallel calls
+        :param sample_interval: optional, seconds between two memory samples of the running tasks.
+            If set, the pipeline gets its own TaskMonitor thread, otherwise it shares the default one
+        :param memory_mode: optional, rss, uss or pss, how the memory of the process tree of a task is counted.
+            uss and pss do not count the pages shared between processes more than once but are more expensive to read.
+            If set, the pipeline gets its own TaskMonitor thread
+        :param mem_limit: optional, the memory in bytes that the running tasks can use in total,
+            or a fraction of the total memory of the system if it is not more than 1.
+            Tasks are only started when their memory fits in it and in the memory available in the system,
+            see Scheduler
+        :param shm_threshold: optional int, bytes, bytearray and NumPy array results of at least that
+            many bytes are sent through shared memory instead of being copied through a pipe
+        :param timeout: optional, the default number of seconds a task can run before its process tree is killed
+        :param deadline: optional, the number of seconds from now after which the tasks which are
+            not finished are killed or dropped, they end in the TimedOut state
+        :param cache: optional, True or a ResultCache to memoize the results of the tasks, see bear.cache.
+            False opts out the functions decorated with bear.cached. get_stats tells which tasks got their
+            result from the cache and get_cache_stats counts them
+        :param record_resources: if True, the memory, cpu, io, context switches and threads of each task
+            are recorded at each sample, get_stats returns their percentiles and plot_tasks_resources plots them
+        :param metrics: if True, live counts and histograms of the tasks are kept, see get_metrics and bear.metrics
+        :param metrics_port: optional, the metrics are served at http://127.0.0.1:<metrics_port>/metrics
+            in the Prometheus text format, 0 picks a free port which is set as metrics_port
+        :param stats_path: optional, the stats of each task are appended to this file as soon as it is done,
+            see bear.stats and load_stats
+        :param stats_format: jsonl or columnar, the format of the stats_path file
+        :param compact: if True, each finished task is replaced in tasks by a TaskRecord with its stats and result,
+            so the process, the pipes and the arguments of the tasks are not kept for the life of the pipeline
+        :param executor: optional, the default executor of the tasks, process, thread or inline, see Task.
+            A parallel call can set its own, the tasks of all the executors share the concurrency of the pipeline
+        :param start_method: optional, fork, spawn or forkserver, how the processes of the function tasks start,
+            see Task. get_stats tells the start_latency of each task
+        :param preload: optional list of modules, the heavy imports of the tasks, they are imported once
+            by the forkserver which the task processes fork from, see bear.preload.
+            The start_method then defaults to forkserver
         """
         self.group_count = 0
         self.tasks = []
         self.resume = resume
+        self.pool = pool
+        self.shm_threshold = shm_threshold
+        self.timeout = timeout
+        self.cache = cache
+        self.record_resources = record_resources
+        self.compact = compact
+        self.executor = executor
+        if preload:
+            start_method = start_method or 'forkserver'
+            preload_modules(preload)
+        self.start_method = start_method
+        self.deadline = None
+        if deadline is not None:
+            self.deadline = time.monotonic() + deadline
+            self._deadline_timer = Timer(deadline, self.__on_deadline)
+            self._deadline_timer.daemon = True
+            self._deadline_timer.start()
+        self.metrics = None
+        if metrics or metrics_port is not None:
+            self.metrics = Metrics()
+        self.scheduler = Scheduler(concurrency, mem_limit, self.metrics)
+        self.monitor = None
+        if sample_interval is not None or memory_mode is not None:
+            self.monitor = TaskMonitor(sample_interval or SAMPLE_INTERVAL, memory_mode or 'rss')
         self.resume_path = os.path.join(os.path.expanduser("~"), '.bear')
         if resume_path:
             self.resume_path = resume_path
+        self.journal = Journal(self.resume_path) if resume else None
+        self.stats_writer = StatsWriter(stats_path, stats_format) if stats_path else None
 
         self.system_monitor = None
         if memory_monitor_interval is not None:
-            if memory_monitor_interval < 1:
-                raise Exception('memory_monitor_interval cannot be less than 1')
             self.system_monitor = SystemMonitor(memory_monitor_interval)
             self.system_monitor.start()
+        self.metrics_port = metrics_port
+        if self.metrics is not None:
+            self.metrics.system_monitor = self.system_monitor
+            if metrics_port is not None:
+                self.metrics_port = self.metrics.serve(metrics_port)
 
     def terminate(self):
-        self.system_monitor.terminate()
+        """ stops the system monitor, the deadline of the pipeline and the metrics server,
+        and writes the stats of the finished tasks
+        """
+        if self.system_monitor is not None:
+            self.system_monitor.stop()
+        if self.deadline is not None:
+            self._deadline_timer.cancel()
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.stats_writer is not None:
+            self.stats_writer.close()
+
+    def __on_deadline(self):
+        """ times out the tasks which are not finished when the deadline of the pipeline is reached """
+        for group_id in range(self.group_count):
+            self.scheduler.cancel_group(group_id, State.TimedOut)
+        for task in list(self.tasks):
+            task._stop(State.TimedOut)  # the tasks which were not submitted to the scheduler, a TaskRecord is done
+
+    def cancel_group(self, group_id):
+        """
+        :param group_id: the group_id of the tasks of a parallel call
+        :return: the number of tasks which were cancelled
+        drops the queued tasks of the group and kills its running ones, they end in the Cancelled state
+        and their slots are given to the tasks of the other groups
+        """
+        return self.scheduler.cancel_group(group_id)
 
-    def __create_tasks(self, func, arg_list, kwargs):
+    def __new_task(self, func, args, kwargs, group_id, chunk=False, keep_result=True, **options):
+        """ creates a Task, or a ChunkTask if chunk is True in which case args is a list of argument lists.
+        If keep_result is False, the TaskRecord of the task does not keep its result
+        """
+        if options.get('timeout') is None:
+            options['timeout'] = self.timeout
+        if options.get('executor') is None:
+            options['executor'] = self.executor
+        options['start_method'] = self.start_method
+        if chunk:
+            task = ChunkTask(func, args, [kwargs] * len(args), group_id=group_id, pool=self.pool,
+                             monitor=self.monitor, cache=self.cache,
+                             record_resources=self.record_resources, **options)
+        else:
+            task = Task(func, args, kwargs, group_id=group_id, pool=self.pool,
+                        monitor=self.monitor, shm_threshold=self.shm_threshold,
+                        cache=self.cache, record_resources=self.record_resources, **options)
+        index = len(self.tasks)
+        self.tasks.append(task)
+        if self.journal is not None:
+            key = task.journal_key = task_key(task)
+            if key is not None and not self.journal.restore(task, key):
+                task.add_done_callback(lambda task: self.journal.record(task, key))
+        if self.stats_writer is not None:
+            task.add_done_callback(self.stats_writer.add)
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            task._stop(State.TimedOut)  # the scheduler does not start it
+        if self.compact:
+            task.add_done_callback(lambda task: self.__compact(index, task, keep_result))
+        return task
+
+    def __compact(self, index, task, keep_result):
+        """ replaces a finished task by its TaskRecord, the caller keeps the Task it got """
+        record = task.compact()
+        if not keep_result:
+            record.result = None
+        self.tasks[index] = record
+
+    def __create_tasks(self, func, arg_list, kwargs, chunksize=None, priority=0, **options):
         """
         :param func: function signature
         :param arg_list: list of lists
         :param kwargs: dictionary
+        :param chunksize: optional int, if set each task runs up to chunksize argument lists
+        :param priority: int, or a list of int with one per argument list, a chunk gets the highest of its items
+        :param options: other arguments of the Task constructor
         :return: list of Task objects
         """
-        new_tasks = []
-        for args in arg_list:
-            task = Task(func, args, kwargs, group_id=self.group_count)
-            self.tasks.append(task)
-            new_tasks.append(task)
+        if not isinstance(priority, (list, tuple)):
+            priority = [priority] * len(arg_list)
+        elif len(priority) != len(arg_list):
+            raise ValueError('The length of args and priority must match')
+        _check_chunksize(chunksize)
+        if chunksize is not None and arg_list:
+            arg_list = _get_sub_params(arg_list, chunksize)
+            priority = [max(chunk, default=0) for chunk in _get_sub_params(priority, chunksize)]
 
+        new_tasks = [self.__new_task(func, args, kwargs, self.group_count, chunksize is not None, priority=prio,
+                                     **options)
+                     for args, prio in zip(arg_list, priority)]
         self.group_count += 1
         return new_tasks
 
-    def __has_bandwidth(self, tasks, concurrency):
-        active = sum(task.state == State.Started for task in tasks)
-        return active < concurrency
+    def __run_adaptive(self, func, arg_list, kwargs, concurrency, weight=1, **options):
+        """ runs the argument lists in chunks and waits for them to finish.
+        The first PROBE_CHUNKS chunks have a single item, the size of the next ones is set from the
+        measured duration of an item so that a chunk runs for about CHUNK_DURATION seconds.
+        No more chunks are in flight than the concurrency of the call and of the pipeline.
+        :return: list of ChunkTask objects in the order of the arguments
+        """
+        group_id = self.group_count
+        self.group_count += 1
+        done = Queue()
+        tasks = []
+        size = 1
+        measured = False
+        start = 0
+        pending = 0
+        limit = min(concurrency, self.scheduler.concurrency or concurrency)
+        while start < len(arg_list) or pending:
+            new_tasks = []
+            in_flight = limit if measured else min(limit, PROBE_CHUNKS)
+            while start < len(arg_list) and pending + len(new_tasks) < in_flight:
+                task = self.__new_task(func, arg_list[start:start + size], kwargs, group_id, True, **options)
+                task.add_done_callback(done.put)
+                new_tasks.append(task)
+                start += size
+            if new_tasks:
+                self.scheduler.submit(new_tasks, group_id, concurrency, weight)
+                tasks.extend(new_tasks)
+                pending += len(new_tasks)
 
-    def __start_tasks(self, tasks, concurrency=1000):
+            task = done.get()
+            pending -= 1
+            item_duration = task.get_item_duration()
+            if item_duration is not None:
+                measured = True
+                size = max(1, int(CHUNK_DURATION / max(item_duration, 1e-6)))
+        return tasks
+
+    def __start_tasks(self, tasks, concurrency=1000, weight=1):
         """
-        :param tasks: list of Task objects
+        :param tasks: list of Task objects of the same group
         :param concurrency: int
-        starts the tasks without waiting for them to finish
+        :param weight: the share of the slots of the group, see Scheduler.submit
+        starts the tasks without waiting for them to finish,
+        the ones that do not fit in the concurrency limit are started as running tasks finish
         """
-        while sum(task.state == State.Created for task in tasks):
-            for task in tasks:
-                if task.state == State.Created and self.__has_bandwidth(tasks, concurrency):
-                    task.start()
-
-            #time.sleep(DELAY)  # necessary to avoid deadlock
+        if tasks:
+            self.scheduler.submit(tasks, tasks[0].group_id, concurrency, weight)
 
-    def parallel_sync(self, func, args, kwargs={}, concurrency=1000):
+    def parallel_sync(self, func, args, kwargs={}, concurrency=1000, reserved_mem=None, chunksize=None,
+                      timeout=None, executor=None, priority=0, weight=1):
         """
         :param func: function signature
         :param args: list
         :param concurrency: int
         :param kwargs: dictionary
+        :param reserved_mem: optional, the memory in bytes each task needs to be started
+        :param chunksize: optional, if set each task runs the function on up to chunksize argument lists,
+            or 'auto' to pick the chunk size from the measured duration of the function
+        :param timeout: optional, the seconds each task can run before it is killed, defaults to the pipeline timeout
+        :param executor: optional, process, thread or inline, defaults to the executor of the pipeline
+        :param priority: int, queued tasks with a higher priority start first, across all the parallel calls.
+            It can be a list with a priority per argument list, but not with an adaptive chunksize
+        :param weight: the share of the slots this call gets against the calls whose tasks have the same priority,
+            a call with weight 3 starts 3 tasks for 1 of a call with weight 1
         :return: list of results
         runs tasks in parallel and waits for them to finish
         """
-        tasks = self.__create_tasks(func, args, kwargs)
-        self.__start_tasks(tasks, concurrency=concurrency)
+        if chunksize == 'auto':
+            if isinstance(priority, (list, tuple)):
+                raise ValueError('An adaptive chunksize needs a single priority')
+            tasks = self.__run_adaptive(func, args, kwargs, concurrency, weight, reserved_mem=reserved_mem,
+                                        timeout=timeout, executor=executor, priority=priority)
+        else:
+            tasks = self.__create_tasks(func, args, kwargs, chunksize, priority, reserved_mem=reserved_mem,
+                                        timeout=timeout, executor=executor)
+            self.__start_tasks(tasks, concurrency=concurrency, weight=weight)
         for task in tasks:
             task.wait()
 
-        return [task.result for task in tasks]
+        return _flatten(tasks)
 
-    def parallel_async(self, func, args, kwargs={}):
+    def parallel_async(self, func, args, kwargs={}, concurrency=1000, reserved_mem=None, chunksize=None,
+                       timeout=None, executor=None, priority=0, weight=1):
         """
         :param func: function signature
         :param args: list
         :param kwargs: dictionary
+        :param concurrency: int
+        :param reserved_mem: optional, the memory in bytes each task needs to be started
+        :param chunksize: optional int, if set each task runs the function on up to chunksize argument lists
+            and its result is the list of their results
+        :param timeout: optional, the seconds each task can run before it is killed, defaults to the pipeline timeout
+        :param executor: optional, process, thread or inline, defaults to the executor of the pipeline
+        :param priority: int, queued tasks with a higher priority start first, across all the parallel calls.
+            It can be a list with a priority per argument list
+        :param weight: the share of the slots this call gets against the calls whose tasks have the same priority,
+            a call with weight 3 starts 3 tasks for 1 of a call with weight 1
         :return: list of Task objects
         runs tasks in parallel but does not wait for them to  finish
         """
-        tasks = self.__create_tasks(func, args, kwargs)
-        self.__start_tasks(tasks)
+        if chunksize == 'auto':
+            raise ValueError('An adaptive chunksize is only supported by parallel_sync')
+        tasks = self.__create_tasks(func, args, kwargs, chunksize, priority, reserved_mem=reserved_mem,
+                                    timeout=timeout, executor=executor)
+        self.__start_tasks(tasks, concurrency=concurrency, weight=weight)
         return tasks
 
+    async def parallel(self, func, args, kwargs={}, concurrency=1000, reserved_mem=None, chunksize=None,
+                       timeout=None, executor=None, priority=0, weight=1):
+        """
+        :param func: function signature
+        :param args: list
+        :param kwargs: dictionary
+        :param concurrency: int
+        :param reserved_mem: optional, the memory in bytes each task needs to be started
+        :param chunksize: optional int, if set each task runs the function on up to chunksize argument lists
+        :param timeout: optional, the seconds each task can run before it is killed, defaults to the pipeline timeout
+        :param executor: optional, process, thread or inline, defaults to the executor of the pipeline
+        :param priority: int, queued tasks with a higher priority start first, across all the parallel calls.
+            It can be a list with a priority per argument list
+        :param weight: the share of the slots this call gets against the calls whose tasks have the same priority,
+            a call with weight 3 starts 3 tasks for 1 of a call with weight 1
+        :return: list of results
+        coroutine which runs tasks in parallel and returns their results once they finish,
+        without blocking the event loop
+        """
+        tasks = self.parallel_async(func, args, kwargs, concurrency, reserved_mem, chunksize, timeout, executor,
+                                    priority, weight)
+        await asyncio.gather(*[as_future(task) for task in tasks])
+        return _flatten(tasks)
+
+    def as_completed(self, tasks):
+        """
+        :param tasks: list of Task objects which were started or queued
+        :return: an iterator which yields the tasks as they finish,
+            use it with for, or with async for in a coroutine
+        """
+        return CompletionIterator(tasks)
+
+    def imap(self, func, params, kwargs={}, ordered=True, window=None, concurrency=1000, chunksize=None,
+             executor=None, priority=0, weight=1):
+        """
+        :param func: function signature
+        :param params: an iterable of argument lists, it can be a lazy iterator
+        :param kwargs: dictionary
+        :param ordered: if True, the results are yielded in the order of params, otherwise as the tasks finish
+        :param window: optional, the maximum number of tasks that are queued, running or finished but
+            not yielded yet, it defaults to the concurrency. Only that many argument lists are read ahead.
+        :param concurrency: int
+        :param chunksize: optional int, if set each task runs the function on up to chunksize argument lists
+        :param executor: optional, process, thread or inline, defaults to the executor of the pipeline
+        :param priority: int, queued tasks with a higher priority start first, across all the parallel calls
+        :param weight: the share of the slots this call gets against the calls whose tasks have the same priority
+        :return: a generator of results, it raises a TaskError when it reaches a task that failed
+        The tasks are kept in the pipeline stats but their result is released once it has been yielded,
+        so any number of params is processed in constant memory.
+        """
+        _check_chunksize(chunksize)
+        window = window or concurrency
+        params = iter(params)
+        group_id = self.group_count
+        self.group_count += 1
+        in_flight = deque() if ordered else set()
+        done = Queue()
+        end = object()
+
+        def fill():
+            new_tasks = []
+            while len(in_flight) < window:
+                if chunksize is None:
+                    args = next(params, end)
+                    if args is end:
+                        break
+                else:
+                    args = list(islice(params, chunksize))
+                    if not args:
+                        break
+                task = self.__new_task(func, args, kwargs, group_id, chunksize is not None, keep_result=False,
+                                       executor=executor, priority=priority)
+                if ordered:
+                    in_flight.append(task)
+                else:
+                    task.add_done_callback(done.put)
+                    in_flight.add(task)
+                new_tasks.append(task)
+            if new_tasks:
+                self.scheduler.submit(new_tasks, group_id, concurrency, weight)
+
+        fill()
+        while in_flight:
+            if ordered:
+                task = in_flight.popleft()
+            else:
+                task = done.get()
+                in_flight.remove(task)
+
+            result = task.wait()
+            task.result = None
+            fill()
+            if chunksize is None:
+                yield result
+            else:
+                for item in result:
+                    yield item
+
     def get_stats(self):
-        """ returns a list of dict with task stats """
-        return [task.get_stats() for task in self.tasks]
+        """ returns a list of dict with task stats, 'critical' tells which tasks are on the critical path """
+        stats = [task.get_stats() for task in self.tasks]
+        critical = set(task.id for task in self.get_critical_path())
+        for val in stats:
+            val['critical'] = val['id'] in critical
+        return stats
+
+    def get_cache_stats(self):
+        """ returns a dict with the hits, the tasks which got their result from the cache,
+        and the misses, the cached tasks which ran their function
+        """
+        hits = sum(1 for task in self.tasks if task.cached)
+        misses = sum(1 for task in self.tasks if task.cached is False)
+        return {'hits': hits, 'misses': misses}
+
+    def get_queue_stats(self):
+        """ returns a dict priority -> the count, mean, p50, p90, p99 and max of the seconds
+        the started tasks of that priority waited in the queue
+        """
+        waits = {}
+        for task in self.tasks:
+            if task.queue_wait is not None:
+                waits.setdefault(task.priority, []).append(task.queue_wait)
+        stats = {}
+        for priority, values in sorted(waits.items()):
+            values.sort()
+            stats[priority] = {'count': len(values), 'mean': sum(values) / len(values),
+                               'p50': percentile(values, 0.5), 'p90': percentile(values, 0.9),
+                               'p99': percentile(values, 0.99), 'max': values[-1]}
+        return stats
+
+    def get_critical_path(self):
+        """
+        :return: the list of the tasks which made the pipeline last as long as it did:
+            the task which ended last, preceded by its upstream task which ended last, and so on.
+            They are the TaskRecord of the tasks if the pipeline compacts them
+        """
+        tasks = {task.id: task for task in self.tasks if task.end_ns is not None}
+        if not tasks:
+            return []
+        path = [max(tasks.values(), key=lambda task: task.end_ns)]
+        while True:
+            upstream = [tasks[task_id] for task_id in path[-1].upstream_ids if task_id in tasks]
+            if not upstream:
+                break
+            path.append(max(upstream, key=lambda task: task.end_ns))
+        return path[::-1]
+
+    def get_metrics(self):
+        """ returns a dict with the live metrics of the pipeline, it must be created with metrics=True """
+        return self.metrics.get()
+
+    def get_monitor_stats(self):
+        """ returns a dict about the cost of monitoring the tasks """
+        return (self.monitor or get_monitor()).get_stats()
 
     def wait(self):
         """ waits for all the tasks to finish """
@@ -103,16 +476,32 @@ class Pipeline(object):
     def get_all_results(self):
         """ returns all results as a list """
         self.wait()
-        return [task.result for task in self.tasks]
+        return _flatten(self.tasks)
 
-    def save_stats(self, path):
-        json.dump(self.get_stats(), open(path, 'w'))
+    def save_stats(self, path, format='json'):
+        """
+        :param path: the file to save to
+        :param format: json for a list of all the stats at once, jsonl or columnar to append them
+            task by task in the order they finish, see bear.stats
+        it returns when all the tasks are done
+        """
+        if format == 'json':
+            with open(path, 'w') as handle:
+                json.dump(self.get_stats(), handle)
+            return
+        writer = StatsWriter(path, format)
+        for task in self.tasks:
+            task.add_done_callback(writer.add)
+        for task in self.tasks:
+            task._wait_done()  # unlike wait, it does not raise if a task failed
+        writer.close()
 
     def plot_tasks_duration(self, path):
         """
         :param path: absolute path of the image to save to
         plots the task durations and saves it to an image
         """
+        from bear import plotting  # matplotlib is only imported to plot
         plotting.plot_tasks_duration(self.tasks, path)
 
     def plot_tasks_memory(self, path):
@@ -120,18 +509,36 @@ class Pipeline(object):
         :param path: absolute path of the image to save to
         plots the task max memory and saves it to an image
         """
+        from bear import plotting  # matplotlib is only imported to plot
         plotting.plot_tasks_memory(self.tasks, path)
 
+    def plot_tasks_resources(self, path):
+        """
+        :param path: absolute path of the image to save to
+        plots the memory and the cpu percent of the tasks over time, they must be created with record_resources
+        """
+        from bear import plotting  # matplotlib is only imported to plot
+        plotting.plot_tasks_resources([task for task in self.tasks if task.resources is not None], path)
+
     def plot_system_memory(self, path):
         """
         :param path: absolute path of the image to save to
         plots the task memories and system memory. It saves the image to a file
         """
-        self.system_monitor.stop_recording = True
-        sys_mem = self.system_monitor.data
-        self.system_monitor.stop_recording = False
-
-        if len(sys_mem) < 1:
+        if self.system_monitor is None or len(self.system_monitor.series) < 1:
             raise Exception('There is no system memory usage data. ' \
                             'You need to turn it on when creating a Pipeline.')
+        sys_mem = self.system_monitor.series.get_column('mem_percent')
+        from bear import plotting  # matplotlib is only imported to plot
         plotting.plot_system_memory(path, self.tasks, sys_mem)
+
+
+def _flatten(tasks):
+    """ returns the results of the tasks with the results of chunks expanded """
+    results = []
+    for task in tasks:
+        if task.items is not None:  # a ChunkTask
+            results.extend(task.result)
+        else:
+            results.append(task.result)
+    return results
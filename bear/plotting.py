@@ -1,81 +1,133 @@
 """
 This module is used for plotting pipeline statistics and diagrams
+
+The tasks are drawn with one collection per function, from NumPy arrays, and above AGGREGATE_THRESHOLD tasks
+they are aggregated: the memory of the running tasks over time instead of a bar per task,
+and percentile bands instead of a bar per task for durations and memory.
+Each figure is closed once it is saved.
 """
 import matplotlib
-from collections import OrderedDict
+import numpy as np
+from contextlib import contextmanager
+from datetime import datetime
 
 matplotlib.use('agg')  # run headless
 # with python3, I get an error because matplotlib needs tkinter
 # but I'm not using it so I can run headless
 import matplotlib.pyplot as plt
 from matplotlib import dates as mdates
+from matplotlib.collections import PolyCollection, LineCollection
 
 BAR_WIDTH = 0.25  # the width of the bars
+AGGREGATE_THRESHOLD = 2000  # above that many tasks, the plots show aggregates instead of each task
+TIME_POINTS = 2000  # the number of points of the aggregated series over time
+PERCENTILES = [10, 50, 90]  # the band and the middle line of the aggregated durations and memory
 
 
-def __get_grouped_data(tasks, data_type):
-    """ Gets a specific data from tasks grouped together
-    :param tasks: list of Task objects
-    :para, data_type: string, can be either duration or memory
-    :return: a dict
+@contextmanager
+def _figure(path, *args, **kwargs):
+    """ yields a figure and its axes like plt.subplots, then saves the figure to path and closes it """
+    fig, axes = plt.subplots(*args, **kwargs)
+    try:
+        yield fig, axes
+        fig.savefig(path, bbox_inches='tight')
+    finally:
+        plt.close(fig)
+
+
+def _to_datenum(timestamps):
+    """ converts an array of seconds since the epoch to matplotlib dates in the local time,
+    like datetime.fromtimestamp
     """
-    assert data_type in ['duration', 'memory']
-    groups = {}
-    for task in tasks:
-        if task.group_id not in groups:
-            groups[task.group_id] = {}
+    timestamps = np.asarray(timestamps, dtype=float)
+    if not len(timestamps):
+        return timestamps
+    first = timestamps[0]
+    return mdates.date2num(datetime.fromtimestamp(first)) + (timestamps - first) / 86400.0
 
-        method = getattr(task, 'get_' + data_type)
-        if task.func_name in groups[task.group_id]:
-            groups[task.group_id][task.func_name].append(method())
 
-        else:
-            groups[task.group_id][task.func_name] = [method()]
-    return groups
+def _get_colors(names):
+    """ returns a dict name -> color, a color per distinct name """
+    return {name: plt.cm.tab10(index % 10) for index, name in enumerate(names)}
 
 
-def __plot_task_dist(ax, tasks):
+def __get_task_arrays(tasks):
+    """ Gets the stats of the tasks which ran as arrays
+    :param tasks: list of Task objects
+    :return: a dict of arrays start, end (seconds since the epoch), duration, memory,
+        group (index of the group_id) and func (index of the func_name), and the lists of group_ids and func_names
+    """
+    tasks = [task for task in tasks if task.start_time is not None and task.end_time is not None]
+    group_ids = list(dict.fromkeys(task.group_id for task in tasks))
+    func_names = list(dict.fromkeys(task.func_name for task in tasks))
+    group_index = {group_id: index for index, group_id in enumerate(group_ids)}
+    func_index = {func_name: index for index, func_name in enumerate(func_names)}
+    start = np.fromiter((task.start_time.timestamp() for task in tasks), float, len(tasks))
+    end = np.fromiter((task.end_time.timestamp() for task in tasks), float, len(tasks))
+    return {'start': start,
+            'end': end,
+            'duration': end - start,
+            'memory': np.fromiter((task.max_mem or 0 for task in tasks), float, len(tasks)),
+            'group': np.fromiter((group_index[task.group_id] for task in tasks), int, len(tasks)),
+            'func': np.fromiter((func_index[task.func_name] for task in tasks), int, len(tasks)),
+            'group_ids': group_ids,
+            'func_names': func_names}
+
+
+def _running_memory(start, end, memory, times):
+    """ returns the total memory of the tasks which run at each of the times """
+    order = np.argsort(start)
+    started = np.concatenate(([0], np.cumsum(memory[order])))[np.searchsorted(start[order], times, 'right')]
+    order = np.argsort(end)
+    ended = np.concatenate(([0], np.cumsum(memory[order])))[np.searchsorted(end[order], times, 'right')]
+    return started - ended
+
+
+def __plot_task_dist(ax, data):
     """ Adds the second subplot which displays memory usage and duration
     :param ax: matplotlib axis
-    :param tasks: list of Task objects
+    :param data: the task arrays, see __get_task_arrays
     :return: None
     """
-    tasks = sorted(tasks, key=lambda x: x.start_time)
     ax.xaxis_date()
     ax.grid(True)
-    colors = plt.cm.tab10(range(len(tasks)))
-    mem_level = 0
-    color_ind = 0
-    legend_colors = {}
-    for task in tasks:
-        m_start = mdates.date2num(task.start_time)
-        m_end = mdates.date2num(task.end_time)
-        color = None
-        if task.func_name in legend_colors:
-            color = legend_colors[task.func_name]
-        else:
-            color = colors[color_ind]
-            legend_colors[task.func_name] = color
-            color_ind += 1
-
-        ax.broken_barh([(m_start, m_end - m_start)], (mem_level, task.max_mem),
-                       facecolor=color, label=task.func_name, edgecolor='black')
-
-        mem_level += task.max_mem
-
-    ax.set_ylim([0, mem_level])
+    if not len(data['start']):
+        return
+    colors = _get_colors(data['func_names'])
+    start = _to_datenum(data['start'])
+    end = start + data['duration'] / 86400.0
+
+    if len(start) > AGGREGATE_THRESHOLD:
+        # the memory of the running tasks of each function, stacked
+        times = np.linspace(data['start'].min(), data['end'].max(), TIME_POINTS)
+        x = _to_datenum(times)
+        levels = [_running_memory(data['start'][data['func'] == func], data['end'][data['func'] == func],
+                                  data['memory'][data['func'] == func], times)
+                  for func in range(len(data['func_names']))]
+        ax.stackplot(x, levels, labels=data['func_names'], colors=[colors[name] for name in data['func_names']],
+                     step='post')
+        ax.set_ylim(bottom=0)
+    else:
+        # a rectangle per task, as wide as its duration and as high as its memory, stacked in the order they started
+        order = np.argsort(data['start'], kind='stable')
+        top = np.cumsum(data['memory'][order])
+        bottom = top - data['memory'][order]
+        verts = np.stack([np.column_stack([start[order], bottom]), np.column_stack([start[order], top]),
+                          np.column_stack([end[order], top]), np.column_stack([end[order], bottom])], axis=1)
+        funcs = data['func'][order]
+        for func, name in enumerate(data['func_names']):
+            ax.add_collection(PolyCollection(verts[funcs == func], facecolors=colors[name],
+                                             edgecolors='black', label=name))
+        ax.set_xlim(start.min(), end.max())
+        ax.set_ylim([0, max(top[-1], 1)])
     ax.legend(loc='upper left', bbox_to_anchor=(1.05, 1))
-    # make the legend labels unique:
-    handles, labels = ax.get_legend_handles_labels()
-    by_label = OrderedDict(zip(labels, handles))
-    ax.legend(by_label.values(), by_label.keys(), loc='upper left', bbox_to_anchor=(1.05, 1))
 
 
 def plot_system_memory(path, tasks, sys_mem, width=10, height=6):
     """ Plots system memory usage and individual tasks run and saves the plot to a file
     :param path: absolute path of the output file
     :param tasks: list of Task objects
-    :param sys_mem: list of tuples (datetime, memory as int)
+    :param sys_mem: tuple of 2 lists, the times in seconds since the epoch and the percent of used memory
     :param width: int width of the plot
     :param height: int height of the plot
     :return: None
@@ -83,21 +135,94 @@ def plot_system_memory(path, tasks, sys_mem, width=10, height=6):
     if len(tasks) < 1:
         return
 
-    x = [mdates.date2num(val.timestamp) for val in sys_mem]
-    y = [val.percent_mem_used for val in sys_mem]
-    fig, ax = plt.subplots(figsize=(width, height))
-    ax1 = plt.subplot(211)
-    plt.plot(x, y)
-    ax1.xaxis_date()
-    ax2 = plt.subplot(212)
-    __plot_task_dist(ax2, tasks)
+    timestamps, y = sys_mem
+    x = _to_datenum(timestamps)
+    with _figure(path, 2, 1, sharex=True, figsize=(width, height)) as (fig, (ax1, ax2)):
+        ax1.plot(x, y)
+        ax1.xaxis_date()
+        __plot_task_dist(ax2, __get_task_arrays(tasks))
 
-    plt.gcf().autofmt_xdate()
-    plt.xlim([x[0], x[-1]])
+        fig.autofmt_xdate()
+        ax2.set_xlim([x[0], x[-1]])
+        ax2.set_xlabel('Time')
+        ax1.set_ylabel('Percent used Memory')
 
-    plt.xlabel('Time')
-    ax1.set_ylabel('Percent used Memory')
-    plt.savefig(path, bbox_inches='tight')
+
+def plot_tasks_resources(tasks, path, width=10, height=6):
+    """ Plots the memory and the cpu percent of tasks over time and saves the plot to a file
+    :param tasks: list of Task objects which recorded their resources
+    :param path: path of the image to be saved
+    :param width: int width of the plot
+    :param height: int height of the plot
+    :return: None
+    """
+    lines = {}  # func_name -> lists of the memory and the cpu lines of its tasks
+    for task in tasks:
+        timestamps, mem = task.resources.get_column('mem')
+        _, cpu = task.resources.get_column('cpu_percent')
+        x = _to_datenum(timestamps)
+        mem_lines, cpu_lines = lines.setdefault(task.func_name, ([], []))
+        mem_lines.append(np.column_stack([x, np.asarray(mem) / 1024.0 ** 2]))
+        cpu_lines.append(np.column_stack([x, cpu]))
+
+    colors = _get_colors(lines)
+    with _figure(path, 2, 1, sharex=True, figsize=(width, height)) as (fig, (ax1, ax2)):
+        for func_name, (mem_lines, cpu_lines) in lines.items():
+            ax1.add_collection(LineCollection(mem_lines, colors=[colors[func_name]], label=func_name))
+            ax2.add_collection(LineCollection(cpu_lines, colors=[colors[func_name]], label=func_name))
+        ax1.autoscale()
+        ax2.autoscale()
+
+        ax1.set_ylabel('Memory in MB')
+        ax2.set_ylabel('CPU percent')
+        ax2.xaxis_date()
+        fig.autofmt_xdate()
+        ax2.set_xlabel('Time')
+        if lines:
+            ax1.legend(loc='upper left', bbox_to_anchor=(1.05, 1))
+
+
+def _add_bars(ax, x, bottom, height, color, label):
+    """ adds bars centered on x as a single collection, ax.bar creates a patch per bar """
+    left = x - BAR_WIDTH / 2
+    right = x + BAR_WIDTH / 2
+    top = bottom + height
+    verts = np.stack([np.column_stack([left, bottom]), np.column_stack([left, top]),
+                      np.column_stack([right, top]), np.column_stack([right, bottom])], axis=1)
+    ax.add_collection(PolyCollection(verts, facecolors=[color], edgecolors='none', label=label))
+
+
+def __plot_grouped(ax, data, values):
+    """ Plots a value of the tasks of each function of each group, as a bar per task,
+    or as a band from the 10th to the 90th percentile with the median above AGGREGATE_THRESHOLD tasks
+    :param ax: matplotlib axis
+    :param data: the task arrays, see __get_task_arrays
+    :param values: array of the value of each task
+    :return: None
+    """
+    colors = _get_colors(data['func_names'])
+    aggregate = len(values) > AGGREGATE_THRESHOLD
+    for func, name in enumerate(data['func_names']):
+        mask = data['func'] == func
+        groups = data['group'][mask]
+        if aggregate:
+            group_list = np.unique(groups)
+            x = group_list + func * BAR_WIDTH
+            low, mid, high = np.array([np.percentile(values[mask][groups == group], PERCENTILES)
+                                       for group in group_list]).T
+            _add_bars(ax, x, low, high - low, colors[name][:3] + (0.5,), name)
+            ax.hlines(mid, x - BAR_WIDTH / 2, x + BAR_WIDTH / 2, colors=[colors[name]])
+        else:
+            # the tasks of a group are next to each other, in the order they were created
+            order = np.argsort(groups, kind='stable')
+            groups = groups[order]
+            rank = np.arange(len(groups)) - np.searchsorted(groups, groups)
+            _add_bars(ax, groups + rank * BAR_WIDTH, np.zeros(len(groups)), values[mask][order], colors[name], name)
+    ax.autoscale()
+    ax.set_ylim(bottom=0)
+    ax.set_xticks([])
+    if data['func_names']:
+        ax.legend(loc='upper left', bbox_to_anchor=(1.05, 1))
 
 
 def plot_tasks_duration(tasks, path, width=10, height=6):
@@ -108,21 +233,11 @@ def plot_tasks_duration(tasks, path, width=10, height=6):
     :param height: int height of the plot
     :return: None
     """
-    groups = __get_grouped_data(tasks, 'duration')
-    fig, ax = plt.subplots(figsize=(width, height))
-
-    ind = 0
-    for group_id, task in groups.items():
-        for func_name, durations in task.items():
-            x = [ind + (BAR_WIDTH * multiplier) for multiplier, _ in enumerate(durations)]
-            ax.bar(x, durations, BAR_WIDTH, label=func_name)
-        ind += 1
-
-    ax.set_ylabel('Duration in seconds')
-    ax.set_title('Duration of Tasks')
-    ax.set_xticks([])
-    ax.legend(loc='upper left', bbox_to_anchor=(1.05, 1))
-    plt.savefig(path, bbox_inches='tight')
+    data = __get_task_arrays(tasks)
+    with _figure(path, figsize=(width, height)) as (fig, ax):
+        __plot_grouped(ax, data, data['duration'])
+        ax.set_ylabel('Duration in seconds')
+        ax.set_title('Duration of Tasks')
 
 
 def plot_tasks_memory(tasks, path, width=10, height=6):
@@ -133,18 +248,8 @@ def plot_tasks_memory(tasks, path, width=10, height=6):
     :param height: int height of the plot
     :return: None
     """
-    groups = __get_grouped_data(tasks, 'memory')
-    fig, ax = plt.subplots(figsize=(width, height))
-
-    ind = 0
-    for group_id, task in groups.items():
-        for func_name, memory in task.items():
-            x = [ind + (BAR_WIDTH * multiplier) for multiplier, _ in enumerate(memory)]
-            ax.bar(x, memory, BAR_WIDTH, label=func_name)
-        ind += 1
-
-    ax.set_ylabel('Memory')
-    ax.set_title('Max memory usage of tasks')
-    ax.set_xticks([])
-    ax.legend(loc='upper left', bbox_to_anchor=(1.05, 1))
-    plt.savefig(path, bbox_inches='tight')
+    data = __get_task_arrays(tasks)
+    with _figure(path, figsize=(width, height)) as (fig, ax):
+        __plot_grouped(ax, data, data['memory'])
+        ax.set_ylabel('Memory')
+        ax.set_title('Max memory usage of tasks')
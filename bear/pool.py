@@ -0,0 +1,209 @@
+"""
+A pool of persistent worker processes that Tasks can be dispatched onto
+so that short tasks do not pay the cost of starting a new process each.
+"""
+import os
+import time
+from collections import deque
+from multiprocessing import Process, Pipe
+from threading import Thread, Lock
+from bear import logger, State, _call, DELAY
+from bear import sharedmem
+from bear.sharedmem import pack_result
+
+
+def _work(conn):
+    """ the loop run by each worker process
+    it receives (func, args, kwargs, shm_threshold) tuples until it receives None
+    """
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            break
+
+        if job is None:
+            break
+
+        func, args, kwargs, shm_threshold = job
+        try:
+            conn.send(pack_result(_call(func, args, kwargs), shm_threshold))
+        except BrokenPipeError:
+            break
+
+    conn.close()
+
+
+class Worker(object):
+    """ A persistent worker process of a WorkerPool """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_work, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self.pid = self.process.pid
+        self.task_count = 0
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def send(self, task):
+        """ sends a task to the worker process """
+        self.conn.send((task.caller, list(task.args), task.kwargs, task.shm_threshold))
+        self.task_count += 1
+
+    def receive(self):
+        """ returns the result dict of the task that the worker was running """
+        if self.conn.poll():
+            try:
+                return self.conn.recv()
+            except EOFError:
+                pass
+        return {'error': 'Worker process {} exited unexpectedly with exit code {}'
+                .format(self.pid, self.process.exitcode),
+                'result': None}
+
+    def release(self):
+        """ hands the worker back to the pool once its task is done """
+        self.pool._release(self)
+
+    def stop(self):
+        """ asks the worker process to exit """
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(DELAY)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class WorkerPool(object):
+    """ A set of persistent worker processes for running function tasks """
+
+    def __init__(self, size=None, max_tasks_per_child=None):
+        """
+        :param size: number of worker processes, defaults to the number of cores
+        :param max_tasks_per_child: optional, a worker is replaced by a fresh process
+            after running this many tasks, which returns the memory it accumulated
+        Note that the function and its arguments are pickled to be sent to a worker,
+        so the function must be importable from the worker like with the spawn start method.
+        The max_mem of a task is the memory of the worker process while it runs the task.
+        """
+        self.size = size or os.cpu_count() or 1
+        self.max_tasks_per_child = max_tasks_per_child
+        self.closed = False
+        self._lock = Lock()
+        self._pending = deque()
+        sharedmem.prepare()  # in case tasks send results through shared memory
+        self._workers = [Worker(self) for _ in range(self.size)]
+        self._idle = list(self._workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, task):
+        """ runs the task on an idle worker or queues it until a worker is free """
+        with self._lock:
+            if self.closed:
+                raise Exception('The pool is closed.')
+            if not self._idle:
+                self._pending.append(task)
+                return
+            worker = self._idle.pop()
+
+        self._dispatch(worker, task)
+
+    def _dispatch(self, worker, task):
+        task.worker = worker
+        task.process = worker.process
+        task.start_ns = time.monotonic_ns()
+        try:
+            worker.send(task)
+        except Exception as ex:  # e.g. the function or arguments cannot be pickled
+            task.end_ns = time.monotonic_ns()
+            task.error = u'Could not send the task to worker {}: {}'.format(worker.pid, ex)
+            task.state = State.Failed
+            logger.error(task.error)
+            task._finish()
+            self._release(worker)
+            return
+
+        line = 'Task {} PID: {} is running {}{}, keywords:{}'
+        line = line.format(task.id, worker.pid, task.func_name, task.args, task.kwargs)
+        logger.info(line)
+        task._watch()
+
+    def _release(self, worker):
+        """ called once the task of the worker is done, on the TaskMonitor thread,
+        it gives the worker the next pending task if there is one.
+        A worker which exited or ran max_tasks_per_child tasks is replaced from a thread,
+        the monitor does not wait for the old process to exit and for the new one to start
+        """
+        if not worker.is_alive() or (self.max_tasks_per_child and
+                                     worker.task_count >= self.max_tasks_per_child):
+            Thread(target=self._replace, args=(worker,), name='bear-pool-{}'.format(worker.pid), daemon=True).start()
+            return
+
+        self._next(worker)
+
+    def _replace(self, worker):
+        """ stops a worker and starts a new one which takes the next pending task """
+        worker.stop()
+        with self._lock:
+            self._workers.remove(worker)
+            if self.closed:
+                return
+            worker = Worker(self)
+            self._workers.append(worker)
+        self._next(worker)
+
+    def _next(self, worker):
+        """ gives the worker the next pending task, or makes it idle """
+        with self._lock:
+            task = None
+            while self._pending and not self.closed:
+                task = self._pending.popleft()
+                if task.state == State.Started:
+                    break
+                task = None  # it was cancelled while pending
+            if task is None and not self.closed:
+                self._idle.append(worker)
+                return
+
+        if task is None:
+            worker.stop()
+        else:
+            self._dispatch(worker, task)
+
+    def close(self):
+        """ stops the workers, pending tasks that have not started are failed """
+        with self._lock:
+            self.closed = True
+            idle = self._idle
+            self._idle = []
+            pending = list(self._pending)
+            self._pending.clear()
+
+        for worker in idle:
+            worker.stop()
+
+        for task in pending:
+            task.end_ns = task.start_ns = time.monotonic_ns()
+            task.error = u'The pool was closed before the task started.'
+            task.state = State.Failed
+            task._finish()
+
+    def terminate(self):
+        """ kills the workers right away """
+        self.close()
+        for worker in list(self._workers):
+            if worker.is_alive():
+                worker.process.terminate()
@@ -0,0 +1,400 @@
+"""
+This module runs tasks on other hosts. A Coordinator listens on a TCP port and agents connect to it,
+each started with:
+    python -m bear worker --connect HOST:PORT --authkey KEY [--cores N]
+A Coordinator is used as the pool of a Pipeline or of a Task: the function tasks are sent to the agents,
+in batches, according to the free cores and the free memory each agent advertises. An agent runs each task
+in its own process, like a local task, and sends back its result, error, state, duration and peak memory.
+The tasks of an agent which is lost are queued again, and an agent reconnects when it loses its coordinator.
+
+The functions and their arguments are pickled, so they must be importable on the agents, and the
+coordinator and its agents must trust each other: they are authenticated by their shared authkey.
+"""
+import os
+import time
+import socket
+import traceback
+from collections import deque
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from queue import Queue, Empty
+from threading import Thread, Lock, Condition
+import psutil
+from bear import logger, State, Task, _done_lock
+
+STATUS_INTERVAL = 1.0  # seconds between two status messages of an idle agent
+RETRY_INTERVAL = 1.0  # seconds between two attempts of an agent to connect to its coordinator
+_STOP = object()
+
+
+def _get_authkey(authkey):
+    if authkey is None:
+        authkey = os.environ.get('BEAR_AUTHKEY')
+    if authkey is None:
+        return None
+    return authkey.encode('utf-8') if isinstance(authkey, str) else authkey
+
+
+class _Agent(object):
+    """ What the Coordinator keeps about a connected agent """
+
+    def __init__(self, conn, hello):
+        self.conn = conn
+        self.host = hello['host']
+        self.pid = hello['pid']
+        self.cores = hello['cores']
+        self.mem = hello['mem']  # the memory available on its host, as of its last status
+        self.running = {}  # task id -> Task
+        self.stopping = {}  # task id -> the State the task is being stopped in
+        self.task_count = 0
+        self.send_lock = Lock()
+
+    def get_free_mem(self):
+        return self.mem - sum(task.reserved_mem or 0 for task in self.running.values())
+
+    def get_stats(self):
+        return {'host': self.host, 'pid': self.pid, 'cores': self.cores, 'mem': self.mem,
+                'running': len(self.running), 'task_count': self.task_count}
+
+
+class Coordinator(object):
+    """ Dispatches tasks to the agents connected to it, it can be the pool of a Pipeline or a Task """
+    remote = True  # the scheduler of a pipeline does not check the local memory for its tasks
+
+    def __init__(self, address=('127.0.0.1', 0), authkey=None):
+        """
+        :param address: the (host, port) to listen on, port 0 picks a free port, see the address attribute
+        :param authkey: optional bytes or str shared with the agents, defaults to the BEAR_AUTHKEY environment
+            variable or to a random key, see the authkey attribute
+        """
+        self.authkey = _get_authkey(authkey) or os.urandom(16).hex().encode('ascii')
+        self._listener = Listener(address, authkey=self.authkey)
+        self.address = self._listener.address
+        self.closed = False
+        self._lock = Lock()
+        self._changed = Condition(self._lock)  # notified when an agent connects or is lost
+        self._agents = []
+        self._pending = deque()
+        thread = Thread(target=self._accept, name='bear-coordinator')
+        thread.daemon = True
+        thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _accept(self):
+        while not self.closed:
+            try:
+                conn = self._listener.accept()
+                kind, hello = conn.recv()
+            except (AuthenticationError, EOFError, ConnectionError) as ex:
+                logger.warning('An agent could not connect: {}'.format(ex))
+                continue
+            except OSError:
+                return  # the listener was closed
+
+            agent = _Agent(conn, hello)
+            with self._lock:
+                if self.closed:
+                    conn.close()
+                    return
+                self._agents.append(agent)
+                self._changed.notify_all()
+            logger.info('Agent {}:{} connected with {} cores and {} bytes of free memory.'
+                        .format(agent.host, agent.pid, agent.cores, agent.mem))
+            thread = Thread(target=self._read, args=(agent,), name='bear-agent-{}'.format(agent.pid))
+            thread.daemon = True
+            thread.start()
+            self._dispatch()
+
+    def wait_for_agents(self, count, timeout=None):
+        """ waits until count agents are connected, returns False if the timeout in seconds expired first """
+        with self._lock:
+            return self._changed.wait_for(lambda: len(self._agents) >= count, timeout)
+
+    def get_stats(self):
+        """ returns a list of dict about the connected agents """
+        with self._lock:
+            return [agent.get_stats() for agent in self._agents]
+
+    def submit(self, task):
+        """ queues a task which is sent to an agent once one has a free core and enough free memory """
+        with self._lock:
+            if self.closed:
+                raise Exception('The coordinator is closed.')
+            self._pending.append(task)
+        self._dispatch()
+
+    def _pick(self, task):
+        """ returns the agent with the most free cores that has the memory of the task, the lock must be held """
+        best = None
+        for agent in self._agents:
+            free = agent.cores - len(agent.running)
+            if free > 0 and agent.get_free_mem() >= (task.reserved_mem or 0):
+                if best is None or free > best.cores - len(best.running):
+                    best = agent
+        return best
+
+    def _dispatch(self):
+        """ sends the pending tasks which fit to the agents, one message per agent """
+        batches = {}
+        with self._lock:
+            while self._pending:
+                task = self._pending[0]
+                if task.state != State.Started:
+                    self._pending.popleft()  # it was cancelled while it was pending
+                    continue
+                agent = self._pick(task)
+                if agent is None:
+                    break
+                self._pending.popleft()
+                agent.running[task.id] = task
+                task.monitor = self
+                task.start_ns = time.monotonic_ns()
+                batches.setdefault(agent, []).append(task)
+
+        for agent, tasks in batches.items():
+            self._send(agent, tasks)
+
+    def _send(self, agent, tasks):
+        specs = [(task.id, task.caller, list(task.args), task.kwargs, task.timeout) for task in tasks]
+        try:
+            with agent.send_lock:
+                agent.conn.send(('run', specs))
+            agent.task_count += len(tasks)
+        except OSError:
+            pass  # the agent is lost, its reader requeues the tasks
+        except Exception:  # e.g. the function or the arguments of a task cannot be pickled
+            if len(tasks) > 1:
+                for task in tasks:
+                    self._send(agent, [task])
+                return
+            task = tasks[0]
+            with self._lock:
+                agent.running.pop(task.id, None)
+            error = u'Could not send the task to agent {}:{}: {}'.format(agent.host, agent.pid, traceback.format_exc())
+            self._finish(task, {'state': State.Failed.name, 'error': error, 'result': None,
+                                'duration': 0, 'max_mem': 0})
+            self._dispatch()
+
+    def _read(self, agent):
+        """ receives the results and the status of an agent until it is lost """
+        try:
+            while True:
+                kind, results, status = agent.conn.recv()
+                agent.mem = status['mem']
+                for res in results:
+                    with self._lock:
+                        task = agent.running.pop(res['id'], None)
+                        agent.stopping.pop(res['id'], None)
+                    if task is not None:
+                        self._finish(task, res)
+                if results:
+                    self._dispatch()
+        except (EOFError, OSError):
+            pass
+        except Exception:
+            logger.error(traceback.format_exc())
+        self._lose(agent)
+
+    def _finish(self, task, res):
+        """ sets the result of a task sent back by an agent """
+        with _done_lock:
+            if task.state != State.Started:
+                return  # it was stopped while it ran
+            task.end_ns = time.monotonic_ns()
+            if res['duration'] is not None:
+                task.start_ns = task.end_ns - int(res['duration'] * 1e9)  # the time it ran on its agent
+            task.max_mem = res['max_mem']
+            task.start_latency = res.get('start_latency')  # from the start on its agent
+            task._set_result(res['result'])
+            task.error = res['error']
+            task.state = State[res['state']]
+        logger.info('Task {} {} {} after {} seconds on an agent.'
+                    .format(task.id, task.func_name, task.state.name.lower(), task.get_duration()))
+        task.monitor = None
+        task._finish()
+
+    def _lose(self, agent):
+        """ queues the tasks of a lost agent again, or stops them if they were being stopped """
+        with self._lock:
+            if agent not in self._agents:
+                return
+            self._agents.remove(agent)
+            self._changed.notify_all()
+            tasks = list(agent.running.values())
+            stopping = dict(agent.stopping)
+            agent.running.clear()
+            requeued = [task for task in tasks if task.id not in stopping and not self.closed]
+            for task in reversed(requeued):
+                task.start_ns = None
+                self._pending.appendleft(task)
+        agent.conn.close()
+        if not self.closed:
+            logger.warning('Agent {}:{} was lost, its {} tasks are queued again.'
+                           .format(agent.host, agent.pid, len(requeued)))
+
+        for task in tasks:
+            if task in requeued:
+                continue
+            task.monitor = None
+            if task.id in stopping:
+                task._stop(stopping[task.id])
+            else:
+                self._finish(task, {'state': State.Failed.name, 'result': None, 'duration': None, 'max_mem': 0,
+                                    'error': u'The coordinator was closed while the task ran.'})
+        self._dispatch()
+
+    def stop(self, task, state):
+        """ asks the agent of a running task to kill it, it then ends in the given state
+        returns False if the task is not running on an agent
+        """
+        with self._lock:
+            agent = next((agent for agent in self._agents if task.id in agent.running), None)
+            if agent is None:
+                return False
+            if task.id in agent.stopping:
+                return True
+            agent.stopping[task.id] = state
+        try:
+            with agent.send_lock:
+                agent.conn.send(('stop', task.id, state.name))
+        except OSError:
+            pass  # the agent is lost, its reader stops the task
+        return True
+
+    def close(self):
+        """ stops the agents, the tasks which did not run fail """
+        with self._lock:
+            self.closed = True
+            agents = list(self._agents)
+            pending = list(self._pending)
+            self._pending.clear()
+        self._listener.close()
+        for agent in agents:
+            try:
+                with agent.send_lock:
+                    agent.conn.send(('close',))
+            except OSError:
+                pass
+
+        for task in pending:
+            task.end_ns = task.start_ns = time.monotonic_ns()
+            task.error = u'The coordinator was closed before the task started.'
+            task.state = State.Failed
+            task._finish()
+
+
+class Agent(object):
+    """ Connects to a Coordinator and runs the tasks it sends, see python -m bear worker """
+
+    def __init__(self, address, authkey=None, cores=None, retry_interval=RETRY_INTERVAL, max_retries=None):
+        """
+        :param address: the (host, port) of the coordinator
+        :param authkey: the authkey of the coordinator, defaults to the BEAR_AUTHKEY environment variable
+        :param cores: the number of tasks run at once, defaults to the number of cores
+        :param retry_interval: the seconds between two attempts to connect
+        :param max_retries: optional, the number of failed attempts in a row after which run returns
+        """
+        self.address = address
+        self.authkey = _get_authkey(authkey)
+        if self.authkey is None:
+            raise ValueError('An authkey is needed, pass it or set BEAR_AUTHKEY.')
+        self.cores = cores or os.cpu_count() or 1
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.closed = False
+        self._tasks = {}  # the id of the task on the coordinator -> the local Task
+
+    def run(self):
+        """ runs the tasks of the coordinator until it closes, it reconnects if the connection is lost """
+        retries = 0
+        while not self.closed:
+            try:
+                conn = Client(self.address, authkey=self.authkey)
+            except (OSError, EOFError, AuthenticationError) as ex:
+                retries += 1
+                if self.max_retries is not None and retries > self.max_retries:
+                    logger.error('Could not connect to {}: {}'.format(self.address, ex))
+                    return
+                time.sleep(self.retry_interval)
+                continue
+
+            retries = 0
+            try:
+                self._serve(conn)
+            except (EOFError, OSError):
+                logger.warning('The connection to {} was lost, reconnecting.'.format(self.address))
+            finally:
+                for task in list(self._tasks.values()):
+                    task.cancel()  # the coordinator runs them again elsewhere
+                self._tasks.clear()
+                conn.close()
+
+    def _serve(self, conn):
+        done = Queue()
+        conn.send(('hello', {'host': socket.gethostname(), 'pid': os.getpid(), 'cores': self.cores,
+                             'mem': psutil.virtual_memory().available}))
+        sender = Thread(target=self._send_results, args=(conn, done), name='bear-agent-sender')
+        sender.daemon = True
+        sender.start()
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'run':
+                    for remote_id, func, args, kwargs, timeout in message[1]:
+                        task = Task(func, args, kwargs, timeout=timeout)
+                        self._tasks[remote_id] = task
+                        task.add_done_callback(lambda task, remote_id=remote_id: done.put((remote_id, task)))
+                        task.start()
+                elif message[0] == 'stop':
+                    task = self._tasks.get(message[1])
+                    if task is not None:
+                        task._stop(State[message[2]])
+                elif message[0] == 'close':
+                    self.closed = True
+                    return
+        finally:
+            done.put(_STOP)
+            sender.join()
+
+    def _send_results(self, conn, done):
+        """ sends the results of the finished tasks in batches, and the status of the agent """
+        while True:
+            try:
+                items = [done.get(timeout=STATUS_INTERVAL)]
+            except Empty:
+                items = []
+            while not done.empty():
+                items.append(done.get())
+            stop = _STOP in items
+            results = []
+            for remote_id, task in [item for item in items if item is not _STOP]:
+                self._tasks.pop(remote_id, None)
+                results.append({'id': remote_id, 'state': task.state.name, 'result': task.result,
+                                'error': task.error, 'duration': task.get_duration(), 'max_mem': task.max_mem,
+                                'start_latency': task.start_latency})
+            try:
+                self._send(conn, results)
+            except (OSError, EOFError):
+                return
+            if stop:
+                return
+
+    def _send(self, conn, results):
+        status = {'mem': psutil.virtual_memory().available}
+        try:
+            conn.send(('results', results, status))
+        except (OSError, EOFError):
+            raise
+        except Exception:  # a result cannot be pickled
+            if len(results) > 1:
+                for res in results:
+                    self._send(conn, [res])
+                return
+            res = results[0]
+            res.update(state=State.Failed.name, result=None,
+                       error=u'Could not send the result: {}'.format(traceback.format_exc()))
+            conn.send(('results', [res], status))
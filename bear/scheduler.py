@@ -0,0 +1,322 @@
+"""
+Starts the queued tasks of a pipeline as soon as a concurrency slot is free
+"""
+import time
+import heapq
+import traceback
+import psutil
+from itertools import count
+from threading import Thread, Lock, local
+from bear import logger, State, DONE_STATES, FAILED_STATES
+
+
+class Group(object):
+    """ The queued tasks of a single parallel call, their concurrency limit and the weight of the group """
+
+    def __init__(self, group_id, concurrency, weight=1):
+        self.id = group_id
+        self.concurrency = concurrency
+        self.weight = weight
+        self.ready = []  # heap of (-priority, sequence, task), the most urgent task first then the oldest
+        self.running = set()
+        self.held = set()  # the tasks waiting for their upstream tasks
+        self.vtime = 0.0  # the tasks the group started divided by its weight
+        self.scheduled = False  # whether the group has a valid entry in the dispatch rotation
+        self.version = 0  # the entries of the group in the rotation with an older version are stale
+        self.key = None  # the key of its valid entry
+        self._sequence = count()
+
+    def push(self, task):
+        heapq.heappush(self.ready, (-task.priority, next(self._sequence), task))
+
+    def has_bandwidth(self):
+        return self.concurrency is None or len(self.running) < self.concurrency
+
+    def is_empty(self):
+        return not self.ready and not self.running and not self.held
+
+
+class Scheduler(object):
+    """ Keeps the queued tasks per group and a count of the running tasks.
+    Tasks are started when they are submitted if there is a free slot,
+    otherwise when a running task is done and notifies the scheduler.
+
+    A task is only started if its memory fits in the free memory: the memory available
+    in the operating system, and the mem_limit if set, minus what the running tasks reserved
+    and have not used yet. The memory of a task is its reserved_mem, or if it is not set,
+    the largest max_mem seen for a task of the same function.
+    A task that does not fit waits, with the tasks queued behind it, until a running task is done.
+    The tasks of a remote pool, see bear.remote, skip this check since they run on other hosts.
+    Queued tasks which are cancelled are skipped.
+
+    A task with upstream tasks, the tasks in its arguments, is held until they are done.
+    It is then queued if they all succeeded, or it fails without running.
+
+    The next task is the one with the highest priority, across all the groups. Between groups whose
+    next tasks have the same priority, the slots are shared by weight: each group has a virtual time,
+    the number of tasks it started divided by its weight, and the group that is behind goes first.
+    A group which has had nothing to run catches up to the virtual time of the last started task so
+    it cannot claim the slots it did not use. The groups and their tasks are kept in heaps, so
+    queuing and starting a task cost O(log n) whatever the number of queued tasks.
+    """
+
+    def __init__(self, concurrency=None, mem_limit=None, metrics=None):
+        """
+        :param concurrency: optional, the maximum number of tasks running at once across all groups
+        :param mem_limit: optional, the memory in bytes the running tasks can reserve in total,
+            or a fraction of the total memory of the system if it is not more than 1
+        :param metrics: optional Metrics object, told when tasks are queued and started
+        """
+        self.metrics = metrics
+        self.concurrency = concurrency
+        self.mem_limit = mem_limit
+        if mem_limit is not None and mem_limit <= 1:
+            self.mem_limit = int(psutil.virtual_memory().total * mem_limit)
+        self.running = 0
+        self.reserved = 0  # the memory estimated for the running tasks
+        self._reserving = {}  # running task -> its estimated memory
+        self._observed = {}  # func_name -> the largest max_mem seen
+        self._groups = {}
+        self._rotation = []  # heap of (-priority, vtime, sequence, version, group) of the groups that can start a task
+        self._sequence = count()
+        self._vtime = 0.0  # the vtime of the group of the last started task
+        self._lock = Lock()
+        self._local = local()
+
+    def submit(self, tasks, group_id, concurrency=None, weight=1):
+        """
+        :param tasks: list of Task objects, they start in the order of their priority
+        :param group_id: the group the tasks belong to
+        :param concurrency: optional, the maximum number of tasks of the group running at once
+        :param weight: the share of the slots the group gets against the other groups with tasks
+            of the same priority, a group with weight 3 starts 3 tasks for 1 of a group with weight 1
+        queues the tasks and starts as many as the limits allow without waiting for them
+        """
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                group = self._groups[group_id] = Group(group_id, concurrency, weight)
+            held = []
+            for task in tasks:
+                if task.state in DONE_STATES:
+                    continue  # cancelled or restored before it was submitted
+                task.state = State.Queued
+                if any(upstream.state not in DONE_STATES for upstream in task.upstream):
+                    group.held.add(task)
+                    held.append(task)
+                else:
+                    task.queued_at = time.monotonic()
+                    group.push(task)
+                if self.metrics is not None:
+                    self.metrics.on_queued(task)
+            self._schedule(group)
+
+        for task in held:
+            task._pending_upstream = len(task.upstream)
+            for upstream in task.upstream:
+                upstream.add_done_callback(lambda upstream, task=task: self._on_upstream_done(task))
+        self._dispatch(caller=True)
+
+    def _on_upstream_done(self, task):
+        """ queues a held task once all its upstream tasks are done """
+        with self._lock:
+            task._pending_upstream -= 1
+            if task._pending_upstream > 0:
+                return
+            group = self._groups.get(task.group_id)
+            if group is None:
+                return  # the group was cancelled
+            group.held.discard(task)
+            if task.state != State.Queued:  # cancelled while it was held
+                if group.is_empty():
+                    del self._groups[task.group_id]
+                return
+
+            failed = [upstream for upstream in task.upstream if upstream.state in FAILED_STATES]
+            if not failed:
+                task.queued_at = time.monotonic()
+                group.push(task)
+                self._schedule(group)
+            elif group.is_empty():
+                del self._groups[task.group_id]
+
+        if failed:
+            task.error = u'The upstream task {} {} did not succeed.'.format(failed[0].id, failed[0].func_name)
+            task.start_ns = task.end_ns = time.monotonic_ns()
+            task.state = State.Failed
+            logger.info('Task {} {} failed: {}'.format(task.id, task.func_name, task.error))
+            task._finish()
+        else:
+            self._dispatch()
+
+    def _schedule(self, group):
+        """ puts the group in the rotation if it can start a task, or moves it if its next task changed.
+        The lock must be held
+        """
+        if not group.ready or not group.has_bandwidth():
+            return
+        if not group.scheduled:
+            group.vtime = max(group.vtime, self._vtime)
+        key = (group.ready[0][0], group.vtime)
+        if group.scheduled and group.key == key:
+            return
+        group.version += 1
+        group.key = key
+        group.scheduled = True
+        heapq.heappush(self._rotation, key + (next(self._sequence), group.version, group))
+
+    def _unschedule(self, group):
+        """ drops the entry of the group from the rotation, the lock must be held """
+        group.scheduled = False
+        group.version += 1
+
+    def _has_bandwidth(self):
+        return self.concurrency is None or self.running < self.concurrency
+
+    def estimate_mem(self, task):
+        """ returns how much memory the task is expected to use """
+        if task.reserved_mem is not None:
+            return task.reserved_mem
+        return self._observed.get(task.func_name, 0)
+
+    def get_free_mem(self):
+        """ returns the memory that a new task can use """
+        # the running tasks that have not reached their estimate yet will use more
+        pending = sum(max(0, mem - task.max_mem) for task, mem in self._reserving.items())
+        free = psutil.virtual_memory().available - pending
+        if self.mem_limit is not None:
+            free = min(free, self.mem_limit - self.reserved)
+        return free
+
+    def _fits(self, task, mem):
+        if mem <= 0 or self.running == 0:
+            return True  # a task that is alone runs whatever its memory so the pipeline moves on
+        if getattr(task.pool, 'remote', False):
+            return True  # it runs on another host, its pool places it by the memory of that host
+        free = self.get_free_mem()
+        if mem <= free:
+            return True
+        if not getattr(task, '_waiting_for_mem', False):
+            task._waiting_for_mem = True
+            logger.info('Task {} {} waits for {} bytes of memory, {} bytes are free.'
+                        .format(task.id, task.func_name, mem, free))
+        return False
+
+    def _next(self):
+        """ returns the next task to start, the one with the highest priority and then of the group
+        which is the most behind its share, or None if there is none or there is no free slot.
+        The lock must be held.
+        """
+        while self._rotation:
+            version, group = self._rotation[0][-2:]
+            if version != group.version:
+                heapq.heappop(self._rotation)  # stale
+                continue
+            if group.ready[0][2].state == State.Queued:
+                break
+            heapq.heappop(group.ready)  # the task was cancelled while it was queued
+            self._unschedule(group)
+            if group.ready:
+                self._schedule(group)
+            elif group.is_empty():
+                del self._groups[group.id]
+
+        if not self._rotation or not self._has_bandwidth():
+            return None
+
+        task = group.ready[0][2]
+        mem = self.estimate_mem(task)
+        if not self._fits(task, mem):
+            return None
+
+        heapq.heappop(self._rotation)
+        self._unschedule(group)
+        heapq.heappop(group.ready)
+        group.running.add(task)
+        self.running += 1
+        if mem > 0:
+            self._reserving[task] = mem
+            self.reserved += mem
+        self._vtime = group.vtime
+        group.vtime += 1.0 / group.weight
+        self._schedule(group)
+        return task
+
+    def _dispatch(self, caller=False):
+        """ starts tasks until there is no free slot or no queued task left
+        :param caller: True if it runs on the thread which submitted tasks, the only one inline tasks run on.
+            Otherwise it runs in a done callback, e.g. on the TaskMonitor thread, and the inline tasks
+            get a thread of their own
+        """
+        if getattr(self._local, 'dispatching', False):
+            return  # a task finished while being started, the loop below picks up its slot
+
+        self._local.dispatching = True
+        try:
+            self._dispatch_loop(caller)
+        finally:
+            self._local.dispatching = False
+
+    def _dispatch_loop(self, caller):
+        while True:
+            with self._lock:
+                task = self._next()
+            if task is None:
+                return
+
+            task.queue_wait = time.monotonic() - task.queued_at
+            if self.metrics is not None:
+                self.metrics.on_started(task, task.queue_wait)
+            task.add_done_callback(self._on_done)
+            if task.executor == 'inline' and not caller:
+                Thread(target=self._start, args=(task,), name='bear-task-{}'.format(task.id), daemon=True).start()
+            else:
+                self._start(task)
+
+    def _start(self, task):
+        try:
+            task.start()
+        except Exception as ex:
+            logger.error(traceback.format_exc())
+            task.error = u'The task could not be started: {}'.format(ex)
+            task.start_ns = task.end_ns = time.monotonic_ns()
+            task.state = State.Failed
+            task._finish()
+
+    def _on_done(self, task):
+        """ frees the slot of a finished task and starts the next queued ones """
+        with self._lock:
+            group = self._groups[task.group_id]
+            group.running.discard(task)
+            self.running -= 1
+            self.reserved -= self._reserving.pop(task, 0)
+            if task.max_mem > self._observed.get(task.func_name, 0):
+                self._observed[task.func_name] = task.max_mem
+            if group.ready:
+                self._schedule(group)
+            elif group.is_empty():
+                del self._groups[task.group_id]
+
+        self._dispatch()
+
+    def cancel_group(self, group_id, state=State.Cancelled):
+        """
+        :param group_id: the group to cancel
+        :param state: State.Cancelled or State.TimedOut, the state the tasks end in
+        :return: the number of tasks which were cancelled
+        the queued tasks of the group are dropped and its running tasks are killed,
+        their slots are given to the tasks of the other groups
+        """
+        with self._lock:
+            group = self._groups.get(group_id)
+            if group is None:
+                return 0
+            queued = [entry[2] for entry in group.ready] + list(group.held)
+            group.ready.clear()
+            group.held.clear()
+            self._unschedule(group)
+            running = list(group.running)
+            if not running:
+                del self._groups[group_id]
+
+        return sum(1 for task in queued + running if task._stop(state))
@@ -0,0 +1,117 @@
+"""
+This module sends large task results through shared memory instead of the result pipe.
+The task process copies the buffers of the result into a shared memory segment once
+and the parent gets a view of the segment, without copying or unpickling the data.
+"""
+import os
+import mmap
+import pickle
+from multiprocessing import shared_memory, resource_tracker
+
+ALIGNMENT = 64  # byte alignment of each buffer in a segment
+
+
+def prepare():
+    """ starts the resource tracker of the parent process before task processes are started.
+    The tasks then register their segments with it, instead of starting their own tracker
+    which would remove the segments when the task process exits, before the parent gets them.
+    """
+    if os.name != 'nt':
+        resource_tracker.ensure_running()
+
+
+def _is_buffer(result):
+    """ whether the result is made of large buffers that can be sent out of band """
+    return isinstance(result, (bytes, bytearray, memoryview)) or hasattr(result, '__array_interface__')
+
+
+def pack_result(res, threshold):
+    """
+    :param res: a dict with the result and the error of a task
+    :param threshold: int, results with buffers of at least that many bytes go through shared memory
+    :return: the dict to send to the parent process, call unpack_result on it to get the result
+    bytes, bytearray and memoryview results are sent as a single buffer and NumPy arrays
+    with pickle protocol 5 out-of-band buffers, other results are sent as they are
+    """
+    result = res['result']
+    if threshold is None or not _is_buffer(result):
+        return res
+
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        data = None
+        try:
+            buffers = [memoryview(result).cast('B')]
+        except TypeError:  # not contiguous
+            return res
+    else:
+        pickle_buffers = []
+        data = pickle.dumps(result, protocol=5, buffer_callback=pickle_buffers.append)
+        buffers = [buf.raw() for buf in pickle_buffers]
+
+    if sum(buf.nbytes for buf in buffers) < threshold:
+        return res
+
+    offsets = []
+    size = 0
+    for buf in buffers:
+        offsets.append((size, buf.nbytes))
+        size += buf.nbytes + (-buf.nbytes) % ALIGNMENT
+
+    segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for buf, (offset, nbytes) in zip(buffers, offsets):
+        segment.buf[offset:offset + nbytes] = buf
+    segment.close()  # the parent unlinks it once it attached to it
+    return dict(res, result=None, shm={'name': segment.name, 'pickle': data, 'buffers': offsets})
+
+
+def _map(name):
+    """ maps a segment in an mmap object that is unmapped once it and all its views are gone,
+    unlike the mapping of a SharedMemory object which cannot be closed while there are views of it
+    """
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        if os.name == 'nt':
+            return mmap.mmap(-1, segment.size, tagname=name)
+        return mmap.mmap(segment._fd, segment.size)
+    finally:
+        segment.close()
+        if os.name != 'nt':
+            segment.unlink()  # the memory is freed once it is unmapped
+
+
+def unpack_result(res):
+    """
+    :param res: a dict returned by pack_result
+    :return: the dict with the result of the task.
+    The result is backed by the shared memory, which is freed once the result
+    and all the views of it are garbage collected. bytes-like results become a memoryview.
+    """
+    if res is None or res.get('shm') is None:
+        return res
+
+    info = res.pop('shm')
+    buf = memoryview(_map(info['name']))
+    views = [buf[offset:offset + nbytes] for offset, nbytes in info['buffers']]
+    if info['pickle'] is None:
+        res['result'] = views[0]
+    else:
+        res['result'] = pickle.loads(info['pickle'], buffers=views)
+    return res
+
+
+class ResultConnection(object):
+    """ Wraps the result pipe of a task process to send large results through shared memory """
+
+    def __init__(self, conn, threshold):
+        """
+        :param conn: the child end of the result pipe
+        :param threshold: int, results with buffers of at least that many bytes go through shared memory
+        """
+        self.conn = conn
+        self.threshold = threshold
+
+    def send(self, res):
+        self.conn.send(pack_result(res, self.threshold))
+
+    def close(self):
+        self.conn.close()
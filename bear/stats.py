@@ -0,0 +1,199 @@
+"""
+This module writes the stats of the tasks of a pipeline to a file as each task finishes,
+instead of all at once at the end, and reads them back for analysis and plotting.
+
+Two formats are supported:
+    jsonl: one JSON object per line with all the stats of a task
+    columnar: blocks of STATS_COLUMNS, each column stored contiguously as int64 or float64 values,
+        or as a dictionary of strings and uint32 indexes, which is compact and fast to load
+The times are in seconds since the epoch with their full precision.
+"""
+import json
+import time
+import struct
+import atexit
+import traceback
+from array import array
+from queue import Queue, Empty
+from threading import Thread
+from bear import logger
+
+FORMATS = ['jsonl', 'columnar']
+STATS_COLUMNS = [('id', 'i8'), ('func_name', 'str'), ('state', 'str'), ('group_id', 'f8'),
+                 ('start_ts', 'f8'), ('end_ts', 'f8'), ('duration', 'f8'), ('max_mem', 'f8'),
+                 ('priority', 'i8'), ('queue_wait', 'f8'), ('start_latency', 'f8')]
+MAGIC = b'BEARSTAT'
+BLOCK_ROWS = 8192  # the rows of a columnar block
+FLUSH_INTERVAL = 1.0  # seconds after which the pending rows are written even if a block is not full
+_HEADER = struct.Struct('<8sI')  # magic and the size of the JSON description of a block
+TYPECODES = {'i8': 'q', 'f8': 'd'}  # the array typecodes of the numeric columns
+_STOP = object()
+
+
+def _number(value):
+    return float('nan') if value is None else float(value)
+
+
+def encode_block(rows):
+    """
+    :param rows: list of dicts with the STATS_COLUMNS
+    :return: bytes of a block with the rows in the columnar format
+    """
+    parts = []
+    columns = []
+    for name, kind in STATS_COLUMNS:
+        if kind == 'i8':
+            data = array('q', [row.get(name) for row in rows]).tobytes()
+            columns.append({'name': name, 'type': kind, 'size': len(data)})
+        elif kind == 'f8':
+            data = array('d', [_number(row.get(name)) for row in rows]).tobytes()
+            columns.append({'name': name, 'type': kind, 'size': len(data)})
+        else:
+            values = {}
+            indexes = array('I', [values.setdefault(str(row.get(name)), len(values)) for row in rows])
+            data = indexes.tobytes()
+            columns.append({'name': name, 'type': kind, 'size': len(data), 'values': list(values)})
+        parts.append(data)
+    description = json.dumps({'rows': len(rows), 'columns': columns}).encode('utf-8')
+    return _HEADER.pack(MAGIC, len(description)) + description + b''.join(parts)
+
+
+def _load_columnar(data):
+    res = {name: ([] if kind == 'str' else array(TYPECODES[kind])) for name, kind in STATS_COLUMNS}
+    pos = 0
+    while pos + _HEADER.size <= len(data):
+        magic, size = _HEADER.unpack_from(data, pos)
+        if magic != MAGIC:
+            raise ValueError('Not a stats file, or a corrupted block at byte {}'.format(pos))
+        start = pos + _HEADER.size + size
+        try:
+            description = json.loads(data[pos + _HEADER.size:start].decode('utf-8'))
+        except ValueError:
+            break  # the last block was not fully written
+        end = start + sum(column['size'] for column in description['columns'])
+        if end > len(data):
+            break
+        for column in description['columns']:
+            chunk = data[start:start + column['size']]
+            start += column['size']
+            if column['name'] not in res:
+                continue
+            if column['type'] in TYPECODES:
+                res[column['name']].frombytes(chunk)
+            else:
+                indexes = array('I')
+                indexes.frombytes(chunk)
+                values = column['values']
+                res[column['name']].extend([values[index] for index in indexes])
+        pos = end
+    return res
+
+
+def _load_jsonl(handle):
+    res = {}
+    rows = 0
+    for line in handle:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # the last line was not fully written
+        for name, value in record.items():
+            if name not in res:
+                res[name] = [None] * rows
+            res[name].append(value)
+        rows += 1
+        for values in res.values():
+            if len(values) < rows:
+                values.append(None)
+    return res
+
+
+def load_stats(path):
+    """
+    :param path: a file written by a StatsWriter, in either format
+    :return: a dict column name -> list of values, or array of ints or floats for the numeric columns
+        of the columnar format, where a missing float is nan. Use them with numpy.asarray for analysis.
+    """
+    with open(path, 'rb') as handle:
+        start = handle.read(len(MAGIC))
+        handle.seek(0)
+        if start == MAGIC:
+            return _load_columnar(handle.read())
+        return _load_jsonl(handle)
+
+
+class StatsWriter(object):
+    """ Appends the stats of each task to a file once the task is done, from a thread """
+
+    def __init__(self, path, format='jsonl'):
+        """
+        :param path: the file to append to
+        :param format: jsonl or columnar
+        """
+        if format not in FORMATS:
+            raise ValueError('format must be one of {}'.format(FORMATS))
+        self.path = path
+        self.format = format
+        self._file = open(path, 'a' if format == 'jsonl' else 'ab')
+        self._queue = Queue()
+        self._rows = []  # the rows of the columnar block being filled
+        self._thread = Thread(target=self._run, name='bear-stats')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, task):
+        """ queues a finished task, its stats are written by the thread """
+        self._queue.put(task)
+
+    def _write(self, task):
+        record = task.get_stats()
+        if self.format == 'jsonl':
+            self._file.write(json.dumps(record, default=str) + '\n')
+        else:
+            self._rows.append(record)
+            if len(self._rows) >= BLOCK_ROWS:
+                self._write_block()
+
+    def _write_block(self):
+        if self._rows:
+            self._file.write(encode_block(self._rows))
+            self._rows = []
+
+    def _flush(self):
+        """ writes the rows of the block being filled, so a reader sees every finished task """
+        self._write_block()
+        self._file.flush()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        dirty = False
+        while True:
+            timeout = max(0.0, last_flush + FLUSH_INTERVAL - time.monotonic()) if dirty else None
+            try:
+                task = self._queue.get(timeout=timeout)
+            except Empty:
+                task = None
+            if task is _STOP:
+                break
+
+            if task is not None:
+                try:
+                    self._write(task)
+                    dirty = True
+                except Exception:
+                    logger.error(traceback.format_exc())
+
+            if dirty and time.monotonic() - last_flush >= FLUSH_INTERVAL:
+                self._flush()
+                dirty = False
+                last_flush = time.monotonic()
+
+        self._flush()
+        self._file.close()
+
+    def close(self):
+        """ writes the queued stats and closes the file, it is called at exit """
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
@@ -0,0 +1,141 @@
+"""
+This module keeps time series of samples in fixed size columns of floats, so their memory is bounded
+however long they are recorded. Each series has a single writer, and readers take snapshots
+without a lock: a snapshot is retried if a row was written while it was copied.
+"""
+import math
+import time
+from array import array
+
+AGGREGATES = ['min', 'max', 'avg']
+
+
+def percentile(values, fraction):
+    """ returns the value at the fraction of sorted values, with the nearest rank method """
+    if not values:
+        return None
+    rank = max(1, int(math.ceil(fraction * len(values))))
+    return values[rank - 1]
+
+
+class RingSeries(object):
+    """ A table of float columns with a fixed number of rows, the oldest row is overwritten when it is full """
+
+    def __init__(self, columns, capacity):
+        """
+        :param columns: list of the column names
+        :param capacity: the number of rows kept
+        """
+        self.columns = list(columns)
+        self.capacity = capacity
+        self._data = [array('d', bytes(8 * capacity)) for _ in self.columns]
+        self._count = 0  # the number of rows appended so far
+        self._seq = 0  # odd while a row is written
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, row):
+        """
+        :param row: a sequence of floats, one per column
+        :return: the row which was overwritten, or None if the series was not full
+        it must only be called by a single thread
+        """
+        pos = self._count % self.capacity
+        old = None
+        if self._count >= self.capacity:
+            old = [column[pos] for column in self._data]
+        self._seq += 1
+        for column, value in zip(self._data, row):
+            column[pos] = value
+        self._count += 1
+        self._seq += 1
+        return old
+
+    def snapshot(self):
+        """ returns a dict column name -> array of its values from the oldest to the newest,
+        it does not block the writer
+        """
+        while True:
+            seq = self._seq
+            if seq % 2 == 0:
+                count = self._count
+                pos = count % self.capacity
+                if count < self.capacity:
+                    res = {name: column[:count] for name, column in zip(self.columns, self._data)}
+                else:
+                    res = {name: column[pos:] + column[:pos] for name, column in zip(self.columns, self._data)}
+                if self._seq == seq:
+                    return res
+            time.sleep(0)  # a row is being written
+
+    def last(self):
+        """ returns a dict column name -> value of the newest row, or None if there is none """
+        while True:
+            seq = self._seq
+            if seq % 2 == 0:
+                count = self._count
+                if count == 0:
+                    return None
+                pos = (count - 1) % self.capacity
+                res = {name: column[pos] for name, column in zip(self.columns, self._data)}
+                if self._seq == seq:
+                    return res
+            time.sleep(0)
+
+
+class TimeSeries(object):
+    """ Keeps the most recent rows as they are and aggregates the older ones in buckets.
+    The first column is the time of the row, in seconds since the epoch.
+    """
+
+    def __init__(self, columns, capacity, bucket_size=None, bucket_capacity=None):
+        """
+        :param columns: list of the column names, the first one is the time
+        :param capacity: the number of recent rows kept as they are
+        :param bucket_size: optional, the rows which do not fit anymore are aggregated in buckets of that many rows,
+            with the min, max and avg of each column, for instance mem_used_min. Otherwise they are dropped.
+        :param bucket_capacity: the number of buckets kept, defaults to capacity
+        """
+        self.columns = list(columns)
+        self.recent = RingSeries(self.columns, capacity)
+        self.bucket_size = bucket_size
+        self.buckets = None
+        if bucket_size:
+            bucket_columns = [self.columns[0]] + ['{}_{}'.format(name, agg)
+                                                  for name in self.columns[1:] for agg in AGGREGATES]
+            self.buckets = RingSeries(bucket_columns, bucket_capacity or capacity)
+        self._bucket = []  # the rows of the bucket being filled
+
+    def __len__(self):
+        return len(self.recent)
+
+    def append(self, row):
+        """ appends a row, it must only be called by a single thread """
+        old = self.recent.append(row)
+        if old is None or self.buckets is None:
+            return
+        self._bucket.append(old)
+        if len(self._bucket) == self.bucket_size:
+            aggregated = [self._bucket[0][0]]
+            for values in list(zip(*self._bucket))[1:]:
+                aggregated.extend((min(values), max(values), sum(values) / len(values)))
+            self.buckets.append(aggregated)
+            self._bucket = []
+
+    def get_column(self, name, agg='avg'):
+        """
+        :param name: the name of a column
+        :param agg: min, max or avg, the value of the buckets which is returned
+        :return: a tuple of 2 lists, the times and the values of the column, from the oldest to the newest
+        """
+        times = []
+        values = []
+        if self.buckets is not None:
+            buckets = self.buckets.snapshot()
+            times.extend(buckets[self.columns[0]])
+            values.extend(buckets['{}_{}'.format(name, agg)])
+        recent = self.recent.snapshot()
+        times.extend(recent[self.columns[0]])
+        values.extend(recent[name])
+        return times, values
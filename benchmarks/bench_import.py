@@ -0,0 +1,52 @@
+"""
+Measures the time and the memory it takes to import bear in a new interpreter,
+which every command line run and every spawned task process pays,
+with matplotlib installed and as if it was not installed
+usage: python benchmarks/bench_import.py [runs]
+"""
+import os
+import sys
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+CODE = '''
+import sys, time, resource
+{block}
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+print(duration, rss, sys.modules.get('matplotlib') is not None)
+'''
+BLOCK = "sys.modules['matplotlib'] = None  # an import of matplotlib raises ImportError"
+
+
+def measure(module, runs, without_matplotlib=False):
+    """ returns the median import time, the median max rss and whether matplotlib was imported """
+    code = CODE.format(block=BLOCK if without_matplotlib else '', module=module)
+    results = []
+    for _ in range(runs):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+        duration, rss, imported = out.decode().split()
+        results.append((float(duration), int(rss), imported == 'True'))
+    results.sort()
+    median = results[len(results) // 2]
+    rss = sorted(val[1] for val in results)[len(results) // 2]
+    return median[0], rss, median[2]
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    print('{:<40} {:>10} {:>10} {:>12}'.format('', 'time', 'max rss', 'matplotlib'))
+    cases = [('import bear', 'bear', False),
+             ('import bear without matplotlib', 'bear', True),
+             ('import bear.pipeline', 'bear.pipeline', False),
+             ('import matplotlib.pyplot (reference)', 'matplotlib.pyplot', False)]
+    for name, module, without in cases:
+        try:
+            duration, rss, imported = measure(module, runs, without)
+        except subprocess.CalledProcessError:
+            print('{:<40} {:>10}'.format(name, 'failed'))
+            continue
+        print('{:<40} {:>8.1f}ms {:>8.1f}MB {:>12}'.format(
+            name, duration * 1000, rss / 1024.0 ** 2, 'loaded' if imported else '-'))
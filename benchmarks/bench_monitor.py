@@ -0,0 +1,26 @@
+"""
+Measures the cost of monitoring many concurrent tasks
+usage: python benchmarks/bench_monitor.py [task count] [sample interval] [resources]
+with resources, the resource series of each task are recorded too
+"""
+import sys
+import time
+import logging
+from bear import logger
+from bear.pipeline import Pipeline
+
+
+def nap(seconds):
+    time.sleep(seconds)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    interval = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+    record_resources = len(sys.argv) > 3 and sys.argv[3] == 'resources'
+    logger.setLevel(logging.WARNING)
+    pipe = Pipeline(sample_interval=interval, record_resources=record_resources)
+    start = time.time()
+    pipe.parallel_sync(nap, [[3] for _ in range(count)])
+    print('{} tasks in {:.2f} seconds'.format(count, time.time() - start))
+    print(pipe.get_monitor_stats())
@@ -0,0 +1,51 @@
+"""
+Measures the time and the memory it takes to plot the tasks of a pipeline with many tasks,
+the plots show aggregates above plotting.AGGREGATE_THRESHOLD tasks
+usage: python benchmarks/bench_plot.py [task counts...]
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import resource
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from bear import plotting
+
+FUNC_NAMES = ['download', 'parse', 'index']
+
+
+def make_tasks(count):
+    """ returns objects with the attributes of finished tasks that plotting reads """
+    start = datetime.now()
+    tasks = []
+    for index in range(count):
+        begin = start + timedelta(seconds=random.uniform(0, 3600))
+        tasks.append(SimpleNamespace(start_time=begin, end_time=begin + timedelta(seconds=random.expovariate(0.1)),
+                                     max_mem=random.randint(10, 500) * 1024 ** 2,
+                                     func_name=FUNC_NAMES[index % len(FUNC_NAMES)], group_id=index % 4))
+    return tasks
+
+
+def max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+if __name__ == '__main__':
+    counts = [int(arg) for arg in sys.argv[1:]] or [1000, 10000, 100000]
+    path = os.path.join(tempfile.mkdtemp(), 'plot.png')
+    sys_mem = None
+    print('{:>8} {:<20} {:>10} {:>12}'.format('tasks', 'plot', 'time', 'max rss'))
+    for count in counts:
+        tasks = make_tasks(count)
+        first = min(task.start_time for task in tasks).timestamp()
+        sys_mem = ([first + second for second in range(3600)], [random.uniform(20, 80) for _ in range(3600)])
+        plots = [('tasks_duration', lambda: plotting.plot_tasks_duration(tasks, path)),
+                 ('tasks_memory', lambda: plotting.plot_tasks_memory(tasks, path)),
+                 ('system_memory', lambda: plotting.plot_system_memory(path, tasks, sys_mem))]
+        for name, plot in plots:
+            start = time.perf_counter()
+            plot()
+            print('{:>8} {:<20} {:>8.2f}s {:>10.1f}MB'.format(
+                count, name, time.perf_counter() - start, max_rss() / 1024.0 ** 2))
@@ -0,0 +1,28 @@
+"""
+Compares the throughput of short tasks run with a new process per task
+and on a WorkerPool
+usage: python benchmarks/bench_pool.py [task count]
+"""
+import sys
+import time
+import logging
+from bear import WorkerPool, logger
+from bear.pipeline import Pipeline
+
+
+def noop(num):
+    return num
+
+
+def run(pipe, count):
+    start = time.time()
+    pipe.parallel_sync(noop, [[num] for num in range(count)])
+    return count / (time.time() - start)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    logger.setLevel(logging.WARNING)
+    print('process per task: {:.1f} tasks/second'.format(run(Pipeline(), count)))
+    with WorkerPool() as pool:
+        print('worker pool:      {:.1f} tasks/second'.format(run(Pipeline(pool=pool), count)))
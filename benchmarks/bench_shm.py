@@ -0,0 +1,38 @@
+"""
+Compares the time to get a large result back from a task through the result pipe
+and through shared memory, for result sizes from 1 KB to 1 GB
+usage: python benchmarks/bench_shm.py [largest size in MB]
+"""
+import sys
+import time
+import logging
+from bear import Task, logger
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def make_result(size):
+    if numpy is not None:
+        return numpy.ones(size, dtype=numpy.uint8)
+    return bytes(size)
+
+
+def run(size, shm_threshold):
+    task = Task(make_result, [size], shm_threshold=shm_threshold)
+    start = time.time()
+    task.start()
+    task.wait()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    largest = int(sys.argv[1]) * 1024 ** 2 if len(sys.argv) > 1 else 1024 ** 3
+    logger.setLevel(logging.WARNING)
+    print('{:>12} {:>10} {:>10}'.format('size', 'pipe', 'shm'))
+    size = 1024
+    while size <= largest:
+        print('{:>12} {:>9.3f}s {:>9.3f}s'.format(size, run(size, None), run(size, 1024)))
+        size *= 16
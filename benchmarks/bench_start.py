@@ -0,0 +1,52 @@
+"""
+Measures the start latency of a function task, from Task.start() to the first line of its function,
+when its process starts with fork, spawn, or forkserver with and without preloading the heavy modules
+that the module of the task functions imports. Each case runs in its own interpreter so it gets a new forkserver
+usage: python benchmarks/bench_start.py [task count]
+"""
+import sys
+import time
+import logging
+import importlib
+import subprocess
+from bear import Task, preload, logger
+
+HEAVY_MODULES = ['numpy', 'matplotlib.pyplot']  # the imports of the module of the tasks
+for name in HEAVY_MODULES:
+    importlib.import_module(name)
+CASES = {'fork': 'fork', 'spawn': 'spawn', 'forkserver': 'forkserver', 'preloaded forkserver': 'forkserver'}
+
+
+def first_line():
+    return None
+
+
+def measure(start_method, count):
+    """ returns the sorted start latencies of count tasks run one after the other """
+    latencies = []
+    for _ in range(count):
+        task = Task(first_line, start_method=start_method)
+        task.start()
+        task.wait()
+        latencies.append(task.start_latency)
+    return sorted(latencies)
+
+
+def run_case(label, count):
+    if label == 'preloaded forkserver':
+        preload(HEAVY_MODULES)
+    start = time.perf_counter()
+    latencies = measure(CASES[label], count)
+    print('{:<22} p50: {:>7.1f}ms  p90: {:>7.1f}ms  max: {:>7.1f}ms  total: {:.2f}s'.format(
+        label, latencies[len(latencies) // 2] * 1e3, latencies[int(len(latencies) * 0.9)] * 1e3,
+        latencies[-1] * 1e3, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    logger.setLevel(logging.WARNING)
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    if len(sys.argv) > 2:
+        run_case(sys.argv[2], count)
+    else:
+        for label in CASES:
+            subprocess.run([sys.executable, __file__, str(count), label], check=True)
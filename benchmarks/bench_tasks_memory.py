@@ -0,0 +1,53 @@
+"""
+Measures the memory that a pipeline keeps per million finished tasks, as live Task objects
+and once they are compacted into TaskRecord objects, and the time it takes to create a Task
+usage: python benchmarks/bench_tasks_memory.py [task count]
+"""
+import sys
+import time
+import tracemalloc
+from bear import Task, State
+
+
+def square(num):
+    return num * num
+
+
+def make_tasks(count):
+    """ returns finished tasks, as the monitor leaves them """
+    tasks = []
+    for num in range(count):
+        task = Task(square, [num])
+        task.start_ns = time.monotonic_ns()
+        task.end_ns = task.start_ns + 1000
+        task.result = num * num
+        task.state = State.Succeeded
+        task._done.set()
+        tasks.append(task)
+    return tasks
+
+
+def measure(build):
+    """ returns the bytes allocated by build that are still alive, and the object it returned """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    res = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, res
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    scale = 1000000.0 / count
+
+    start = time.perf_counter()
+    make_tasks(count)
+    duration = time.perf_counter() - start
+    print('creating a Task: {:.2f}us'.format(duration / count * 1e6))
+
+    size, tasks = measure(lambda: make_tasks(count))
+    print('live tasks:      {:>8.1f}MB per million tasks'.format(size * scale / 1024.0 ** 2))
+    size, records = measure(lambda: [task.compact() for task in tasks])
+    del tasks
+    print('compacted tasks: {:>8.1f}MB per million tasks'.format(size * scale / 1024.0 ** 2))
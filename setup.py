@@ -22,7 +22,8 @@ setup(
     description='asynchronous parallelization pipeline',
     long_description=__doc__,
     packages=find_packages(),
-    install_requires = ['psutil', 'matplotlib'],
+    install_requires = ['psutil'],
+    extras_require = {'plot': ['matplotlib', 'numpy']},
     include_package_data=True,
     package_data = {'bear': []},
     zip_safe=False,
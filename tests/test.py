@@ -6,15 +6,26 @@ import os
 import sys
 import time
 import json
+import operator
 import unittest
 import tempfile
+import asyncio
+import threading
+import subprocess
+import psutil
+from urllib.request import urlopen
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 ROOT = os.path.realpath("{}/..".format(BASE_DIR))
 sys.path.append(ROOT)
 
-from bear import Task, TaskError, _get_sub_params
+from bear import State, Task, TaskRecord, TaskMonitor, TaskError, SystemMonitor, WorkerPool, ResultCache, cached
+from bear import parallel, wait_for, get_total_mem, preload, _get_sub_params
+from bear.memory import ProcessTreeSampler
 from bear.pipeline import Pipeline
+from bear.stats import load_stats
+from bear.output import Spool, TAIL_SIZE
+from bear.remote import Coordinator
 
 
 def add(a, b):
@@ -45,6 +56,39 @@ def download(url, extract=False):
     print('downloading %s' % url)
 
 
+def square(num):
+    return num * num
+
+
+def make_bytes(size):
+    return b'x' * size
+
+
+def get_pid():
+    return os.getpid()
+
+
+def get_thread(*args):
+    return threading.current_thread()
+
+
+def is_loaded(name):
+    return name in sys.modules
+
+
+def spin(seconds):
+    """ keeps a core busy """
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+@cached(cache=ResultCache())
+def cube(num):
+    time.sleep(1)
+    return num ** 3
+
+
 def get_big_data():
     _, temp_file = tempfile.mkstemp()
     with open(temp_file, 'wb') as f:
@@ -66,6 +110,130 @@ class TestMem(unittest.TestCase):
             assert val['max_mem'] > 50 * 1024 * 1024, f"Unexpected max_mem: {val}"
 
 
+class TestSystemMonitor(unittest.TestCase):
+    """ tests recording the usage of the system """
+
+    def test_bounded(self):
+        monitor = SystemMonitor(0.01, capacity=10, bucket_size=5, bucket_capacity=3)
+        monitor.start()
+        time.sleep(0.6)
+        monitor.stop()
+        monitor.join()
+        samples = monitor.series.recent.snapshot()
+        assert len(samples['timestamp']) == 10
+        assert list(samples['timestamp']) == sorted(samples['timestamp'])
+        assert all(0 < val <= 100 for val in samples['mem_percent'])
+        buckets = monitor.series.buckets.snapshot()
+        assert len(buckets['timestamp']) == 3
+        assert all(low <= avg <= high for low, avg, high in
+                   zip(buckets['mem_used_min'], buckets['mem_used_avg'], buckets['mem_used_max']))
+        times, values = monitor.series.get_column('cpu_percent')
+        assert len(times) == len(values) == 13 and times[-1] == samples['timestamp'][-1]
+        assert len(monitor.data) == 10
+
+        pipe = Pipeline(memory_monitor_interval=0.1)
+        pipe.terminate()
+
+
+class TestResources(unittest.TestCase):
+    """ tests recording the resources of each task """
+
+    def test_resources(self):
+        pipe = Pipeline(record_resources=True, sample_interval=0.05)
+        pipe.parallel_sync(spin, [[1]])
+        stats = pipe.get_stats()[0]['resources']
+        assert stats['cpu_percent']['p90'] > 50, stats
+        assert stats['mem']['p50'] <= stats['mem']['max'] == pipe.tasks[0].max_mem, stats
+        assert stats['threads']['max'] >= 1 and stats['ctx_switches'] > 0, stats
+        assert 'read_bytes' in stats and 'write_bytes' in stats
+
+        with WorkerPool(size=1) as pool:
+            pipe = Pipeline(pool=pool, record_resources=True)
+            pipe.parallel_sync(spin, [[0.5]])
+            assert pipe.get_stats()[0]['resources']['cpu_percent']['max'] > 50
+            _, path = tempfile.mkstemp(suffix='.png')
+            pipe.plot_tasks_resources(path)
+            assert os.path.getsize(path) > 0
+
+
+class TestPlotting(unittest.TestCase):
+    """ tests the plots of each task and their aggregates """
+
+    def test_plots(self):
+        from bear import plotting
+        pipe = Pipeline(memory_monitor_interval=0.05)
+        pipe.parallel_sync(go, [[1], [0]])
+        pipe.parallel_sync(square, [[2], [3], [4]])
+        pipe.terminate()
+        threshold = plotting.AGGREGATE_THRESHOLD
+        try:
+            for plotting.AGGREGATE_THRESHOLD in (threshold, 1):
+                for plot in (pipe.plot_tasks_duration, pipe.plot_tasks_memory, pipe.plot_system_memory):
+                    _, path = tempfile.mkstemp(suffix='.png')
+                    plot(path)
+                    assert os.path.getsize(path) > 0, plot
+        finally:
+            plotting.AGGREGATE_THRESHOLD = threshold
+        assert plotting.plt.get_fignums() == [], 'Expected the figures to be closed'
+
+
+class TestMetrics(unittest.TestCase):
+    """ tests the live metrics of a pipeline """
+
+    def test_metrics(self):
+        pipe = Pipeline(concurrency=1, metrics_port=0, memory_monitor_interval=0.1)
+        tasks = pipe.parallel_async(go, [[2], [1]])
+        time.sleep(0.3)
+        metrics = pipe.get_metrics()
+        assert metrics['running'] == {(0, 'go'): 1} and metrics['queued'] == {(0, 'go'): 1}, metrics
+        with self.assertRaises(TaskError):
+            pipe.parallel_sync(subtract, [[1, 'x']])
+        wait_for(tasks)
+        time.sleep(0.1)  # the metrics are updated right after the tasks are done
+
+        url = 'http://127.0.0.1:{}/metrics'.format(pipe.metrics_port)
+        body = urlopen(url).read().decode('utf-8')
+        pipe.terminate()
+        assert 'bear_tasks_finished_total{func_name="go",group_id="0",state="Succeeded"} 2' in body, body
+        assert 'bear_tasks_finished_total{func_name="subtract",group_id="1",state="Failed"} 1' in body
+        assert 'bear_tasks_running{func_name="go",group_id="0"} 0' in body
+        assert 'bear_task_duration_seconds_count{func_name="go"} 2' in body
+        assert 'bear_task_queue_wait_seconds_count 3' in body
+        assert 'bear_system_mem_percent' in body
+
+
+class TestStats(unittest.TestCase):
+    """ tests the stats written as the tasks finish """
+
+    def test_stats_sink(self):
+        folder = tempfile.mkdtemp()
+        paths = {fmt: os.path.join(folder, 'stats.' + fmt) for fmt in ('jsonl', 'columnar')}
+        before = time.time()
+        pipe = Pipeline(stats_path=paths['columnar'], stats_format='columnar')
+        pipe.parallel_sync(add, [[1, 2], [3, 4]])
+        with self.assertRaises(TaskError):
+            pipe.parallel_sync(subtract, [[1, 'x']])
+        pipe.save_stats(paths['jsonl'], format='jsonl')
+        pipe.terminate()
+
+        for fmt, path in paths.items():
+            stats = load_stats(path)
+            assert sorted(stats['func_name']) == ['add', 'add', 'subtract'], (fmt, stats)
+            assert sorted(stats['state']) == ['Failed', 'Succeeded', 'Succeeded'], (fmt, stats)
+            for start, end in zip(stats['start_ts'], stats['end_ts']):
+                assert before <= start <= end <= time.time(), (fmt, start, end)
+        assert load_stats(paths['columnar'])['start_ts'][0] % 1 != 0, 'Expected sub-second timestamps'
+
+
+class TestImport(unittest.TestCase):
+    """ tests what importing bear costs """
+
+    def test_lazy_plotting(self):
+        code = "import sys, bear, bear.pipeline; print('matplotlib' in sys.modules)"
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=ROOT)
+        assert out.strip() == b'False', 'Expected matplotlib to be imported only to plot'
+
+
 class TestBear(unittest.TestCase):
     """ general functional test """
 
@@ -128,10 +296,550 @@ class TestBear(unittest.TestCase):
         pipe.parallel_sync(subtract, [[1, 2], [1, 1], [1, 3]], concurrency=2)
         assert pipe.get_all_results() == [-1, 0, -2]
 
+    def test_compact(self):
+        """ the pipeline keeps a TaskRecord of each finished task """
+        pipe = Pipeline()
+        tasks = pipe.parallel_async(add, [(1, 1), (2, 2)])
+        with self.assertRaises(TaskError):
+            pipe.parallel_sync(subtract, [[1, 'x']])
+        wait_for(tasks)
+        time.sleep(0.1)  # the tasks are compacted right after they are done
+        assert all(isinstance(task, TaskRecord) and not isinstance(task, Task) for task in pipe.tasks)
+        assert tasks[0].process is None and tasks[0].parent_conn is None, 'Expected the handles to be released'
+        assert [task.id for task in pipe.tasks] == [task.id for task in tasks] + [tasks[1].id + 1]
+        assert pipe.tasks[0].get_duration() == tasks[0].get_duration() > 0
+        assert pipe.tasks[0].start_time == tasks[0].start_time and pipe.tasks[0].args is None
+        assert pipe.tasks[1].get_stats() == tasks[1].get_stats()
+        with self.assertRaises(TaskError):
+            pipe.tasks[2].wait()
+        assert [task.get_result() for task in pipe.tasks[:2]] == [2, 4]
+
+    def test_async_concurrency(self):
+        """ parallel_async returns right away and honors the concurrency limit """
+        pipe = Pipeline()
+        start = time.time()
+        tasks = pipe.parallel_async(add, [(1, 1), (2, 2), (3, 3)], concurrency=1)
+        assert time.time() - start < 1, 'parallel_async blocked the caller'
+        pipe.wait()
+        assert [task.result for task in tasks] == [2, 4, 6]
+        for prev, task in zip(tasks, tasks[1:]):
+            assert task.start_time >= prev.end_time, 'More than one task ran at once'
+
+    def test_mem_limit(self):
+        """ tasks whose reserved memory does not fit in mem_limit wait for the running ones """
+        pipe = Pipeline(mem_limit=3 * 1024 ** 3)
+        tasks = pipe.parallel_async(add, [(1, 1), (2, 2), (3, 3)], reserved_mem=2 * 1024 ** 3)
+        pipe.wait()
+        for prev, task in zip(tasks, tasks[1:]):
+            assert task.start_time >= prev.end_time, 'Tasks ran at once above the memory limit'
+
+        # without a reservation, the observed memory of the function is used
+        pipe = Pipeline(mem_limit=1)
+        pipe.parallel_sync(add, [(1, 1)])
+        assert pipe.scheduler.estimate_mem(Task(add)) > 0
+
     def test8(self):
         assert _get_sub_params([['a', 1], ['b', 1], ['c', 1]], 3) == [[['a', 1], ['b', 1], ['c', 1]]]
         assert _get_sub_params([['a', 1], ['b', 1], ['c', 1]], 2) == [[['a', 1], ['b', 1]], [['c', 1]]]
 
 
+class TestMonitor(unittest.TestCase):
+    """ tests the shared TaskMonitor """
+
+    def test_single_thread(self):
+        pipe = Pipeline(sample_interval=0.05)
+        threads = threading.active_count()
+        pipe.parallel_async(go, [[2] for _ in range(10)])
+        assert threading.active_count() <= threads + 1, 'Expected a single monitor thread'
+        pipe.wait()
+        stats = pipe.get_monitor_stats()
+        assert stats['samples'] > 0 and stats['watched'] == 0, stats
+        assert stats['duty'] < 0.5, stats
+        assert all(val['max_mem'] > 0 for val in pipe.get_stats())
+
+    def test_large_output(self):
+        """ the output of a command is read while it runs so a full pipe does not block it """
+        task = Task('head -c 1000000 /dev/zero')
+        task.start()
+        assert len(task.wait()) == 1000000
+
+
+class TestTreeMemory(unittest.TestCase):
+    """ tests the memory accounting of process trees """
+
+    def test_deep_tree(self):
+        """ every process of the tree is counted once """
+        proc = subprocess.Popen(['sh', '-c', "sh -c 'sh -c \"sleep 3\"; :'; :"])
+        try:
+            time.sleep(0.5)
+            procs = [psutil.Process(proc.pid)] + psutil.Process(proc.pid).children(recursive=True)
+            assert len(procs) == 4, procs
+            expected = sum(p.memory_info().rss for p in procs)
+            assert abs(get_total_mem(proc.pid) - expected) < expected / 10
+            sampler = ProcessTreeSampler('uss')
+            uss = sampler.sample([proc.pid])[proc.pid]
+            assert 0 < uss < expected
+        finally:
+            proc.wait()
+
+
+class TestChunks(unittest.TestCase):
+    """ tests running parameters in chunks """
+
+    def test_chunksize(self):
+        pipe = Pipeline()
+        res = pipe.parallel_sync(square, [[num] for num in range(10)], chunksize=4)
+        assert res == [num * num for num in range(10)], res
+        stats = pipe.get_stats()
+        assert [val['items'] for val in stats] == [4, 4, 2], stats
+        assert all(len(val['item_durations']) == val['items'] for val in stats)
+
+        tasks = parallel(add, [(1, 1), (2, 2), (3, 3)], chunksize=2, kwargs=[{}, {}, {'b': 4}])
+        with self.assertRaises(TaskError):
+            wait_for(tasks)
+        assert tasks[0].result == [2, 4]
+
+    def test_empty_and_invalid(self):
+        pipe = Pipeline()
+        assert pipe.parallel_sync(square, [], chunksize=4) == [] and pipe.tasks == []
+        assert pipe.parallel_sync(square, [], chunksize='auto') == [] and parallel(square, [], chunksize=4) == []
+        for chunksize in (0, -1):
+            with self.assertRaises(ValueError):
+                pipe.parallel_async(square, [[1]], chunksize=chunksize)
+            with self.assertRaises(ValueError):
+                parallel(square, [[1]], chunksize=chunksize)
+            with self.assertRaises(ValueError):
+                list(pipe.imap(square, [[1]], chunksize=chunksize))
+
+    def test_adaptive(self):
+        pipe = Pipeline()
+        res = pipe.parallel_sync(square, [[num] for num in range(200)], chunksize='auto', concurrency=2)
+        assert res == [num * num for num in range(200)]
+        assert len(pipe.tasks) < 20, 'Expected the chunks to grow, got {}'.format(len(pipe.tasks))
+
+        pipe = Pipeline(concurrency=4)
+        res = pipe.parallel_sync(square, [[num] for num in range(3000)], chunksize='auto')
+        assert res == [num * num for num in range(3000)]
+        assert len(pipe.tasks) < 10, 'Expected a few probes, got {}'.format(len(pipe.tasks))
+
+
+class TestStreaming(unittest.TestCase):
+    """ tests yielding results as tasks finish """
+
+    def test_imap(self):
+        pipe = Pipeline()
+        params = ([num] for num in range(12))
+        res = list(pipe.imap(square, params, window=3))
+        assert res == [num * num for num in range(12)], res
+        res = pipe.imap(square, ([num] for num in range(12)), ordered=False, chunksize=5)
+        assert sorted(res) == [num * num for num in range(12)]
+        assert len(pipe.tasks) == 15
+
+    def test_as_completed(self):
+        pipe = Pipeline()
+        tasks = pipe.parallel_async(go, [[4], [1]])
+        finished = [task for task in pipe.as_completed(tasks)]
+        assert finished == [tasks[1], tasks[0]]
+
+    def test_command_output(self):
+        folder = tempfile.mkdtemp()
+        expected = b''.join(b'%d\n' % num for num in range(1, 100001))
+        task = Task('seq 1 100000', output=Spool(folder, max_bytes=200000, backup_count=2, tail_size=100))
+        task.start()
+        output = task.wait()
+        assert output.size == len(expected) and output.tail == expected[-100:], output
+        assert len(output.paths) == 3 and output.read() == expected[-len(output.read()):]
+        assert output.mmap()[-7:] == b'100000\n'
+        output.remove()
+
+        lines = []
+        task = Task('seq 1 100000; echo -n end >&2', output=lambda task, name, line: lines.append((name, line)))
+        task.start()
+        assert task.wait() == expected[-TAIL_SIZE:] and task.error == b'end'
+        assert len(lines) == 100001 and lines[-2] == ('stdout', b'100000') and lines[-1] == ('stderr', b'end')
+
+        with self.assertRaises(ValueError):
+            Task('echo hi', output='out.log')
+
+
+class TestSharedMemory(unittest.TestCase):
+    """ tests sending large results through shared memory """
+
+    def test_large_result(self):
+        task = Task(make_bytes, [10 * 1024 * 1024], shm_threshold=1024 * 1024)
+        task.start()
+        res = task.wait()
+        assert isinstance(res, memoryview) and len(res) == 10 * 1024 * 1024
+        assert res[:3].tobytes() == b'xxx'
+
+        with WorkerPool(size=1) as pool:
+            pipe = Pipeline(pool=pool, shm_threshold=1024)
+            res = pipe.parallel_sync(make_bytes, [[10], [4096]])
+            assert res[0] == b'x' * 10 and isinstance(res[0], bytes)
+            assert isinstance(res[1], memoryview) and res[1].tobytes() == b'x' * 4096
+
+
+class TestAsync(unittest.TestCase):
+    """ tests awaiting tasks from an event loop """
+
+    def test_await(self):
+        async def main():
+            assert await Task(add, [1, 2]) == 3
+            with self.assertRaises(TaskError):
+                await Task(subtract, [1, 'x'])
+
+            pipe = Pipeline()
+            ticks = []
+
+            async def tick():
+                while True:
+                    ticks.append(1)
+                    await asyncio.sleep(0.1)
+
+            ticker = asyncio.ensure_future(tick())
+            res = await pipe.parallel(add, [(1, 1), (2, 2)])
+            ticker.cancel()
+            assert res == [2, 4]
+            assert len(ticks) > 5, 'The event loop was blocked'
+
+            tasks = pipe.parallel_async(go, [[4], [1]])
+            finished = [task async for task in pipe.as_completed(tasks)]
+            assert finished == [tasks[1], tasks[0]]
+
+        asyncio.run(main())
+
+
+class TestTimeout(unittest.TestCase):
+    """ tests timeouts and cancellation """
+
+    def test_timeout(self):
+        """ the whole process tree of a task is killed """
+        task = Task('sleep 30 & sleep 30', timeout=1)
+        task.start()
+        time.sleep(0.5)
+        children = psutil.Process(task.process.pid).children(recursive=True)
+        assert children
+        with self.assertRaises(TaskError):
+            task.wait()
+        time.sleep(0.1)
+        for child in children:
+            assert not child.is_running() or child.status() == psutil.STATUS_ZOMBIE, child
+        assert task.get_stats()['state'] == 'TimedOut'
+
+    def test_slot_freed(self):
+        """ a task which times out gives its slot to the next one """
+        pipe = Pipeline(concurrency=1, timeout=2)
+        start = time.time()
+        tasks = pipe.parallel_async(go, [[60], [1]])
+        assert tasks[1].wait() is None
+        assert time.time() - start < 10
+        assert [val['state'] for val in pipe.get_stats()] == ['TimedOut', 'Succeeded']
+
+    def test_cancel(self):
+        with WorkerPool(size=1) as pool:
+            pipe = Pipeline(pool=pool, concurrency=2)
+            tasks = pipe.parallel_async(go, [[60], [60], [60]])
+            other = pipe.parallel_async(square, [[3]])
+            time.sleep(0.5)
+            assert tasks[2].cancel()
+            assert pipe.cancel_group(tasks[0].group_id) == 2
+            assert other[0].wait() == 9
+            assert [task.get_stats()['state'] for task in tasks] == ['Cancelled'] * 3
+            assert not tasks[0].cancel()
+
+    def test_cancel_before_start(self):
+        """ a task cancelled while a scheduler starts it is not started """
+        task = Task(go, [60])
+        assert task.cancel()
+        task.start()
+        assert task.state == State.Cancelled and task.process is None
+
+    def test_cancel_process(self):
+        """ the pipe of a killed process is closed without errors """
+        for _ in range(3):
+            task = Task(go, [60])
+            task.start()
+            time.sleep(0.3)
+            with self.assertNoLogs('bear', level='ERROR'):
+                assert task.cancel()
+                with self.assertRaises(TaskError):
+                    task.wait()
+                time.sleep(0.1)
+            assert task.state == State.Cancelled
+
+    def test_deadline(self):
+        pipe = Pipeline(deadline=1, concurrency=1)
+        tasks = pipe.parallel_async(go, [[60], [60]])
+        with self.assertRaises(TaskError):
+            tasks[0].wait()
+        assert [task.get_stats()['state'] for task in tasks] == ['TimedOut'] * 2
+        assert pipe.parallel_async(square, [[2]])[0].state.name == 'TimedOut'
+
+
+class TestResume(unittest.TestCase):
+    """ tests restoring the tasks journaled by a previous run """
+
+    def test_resume(self):
+        path = tempfile.mkdtemp()
+        pipe = Pipeline(resume=True, resume_path=path)
+        assert pipe.parallel_sync(add, [(1, 1), (1, 2)]) == [2, 3]
+        with self.assertRaises(TaskError):
+            pipe.parallel_sync(subtract, [[1, 'x']])
+        pipe.journal.close()
+        with open(os.path.join(path, 'journal.jsonl'), 'a') as handle:
+            handle.write('{"key": "trunc')  # a line cut short by a crash
+
+        pipe = Pipeline(resume=True, resume_path=path)
+        start = time.time()
+        assert pipe.parallel_sync(add, [(1, 1), (1, 2)]) == [2, 3]
+        assert time.time() - start < 0.5, 'Expected the tasks to be restored'
+        assert all(val['duration'] >= 1 and val['state'] == 'Succeeded' for val in pipe.get_stats())
+        assert pipe.parallel_sync(add, [(2, 2)]) == [4]
+
+
+class TestCache(unittest.TestCase):
+    """ tests memoizing results """
+
+    def test_cache(self):
+        path = tempfile.mkdtemp()
+        pipe = Pipeline(cache=ResultCache(path=path))
+        assert pipe.parallel_sync(add, [(1, 1), (1, 1), (1, 2)]) == [2, 2, 3]
+        assert [val['cached'] for val in pipe.get_stats()] == [False, True, False]
+        assert pipe.get_cache_stats() == {'hits': 1, 'misses': 2}
+        assert pipe.cache.get_stats()['hits'] == 1 and pipe.cache.get_stats()['misses'] == 2
+        pipe.cache.flush()
+
+        pipe = Pipeline(cache=ResultCache(path=path))  # from the disk
+        start = time.time()
+        assert pipe.parallel_sync(add, [(1, 2)]) == [3]
+        assert time.time() - start < 0.5
+        assert pipe.get_stats()[0]['cached']
+
+        tasks = parallel(cube, [[2], [2]])
+        assert [task.wait() for task in tasks] == [8, 8]
+        assert [task.cached for task in tasks] == [False, True]
+        task = Task(cube, [2], cache=False)
+        task.start()
+        assert task.wait() == 8 and task.cached is None
+        pipe = Pipeline(cache=False)
+        assert pipe.parallel_sync(cube, [[2]]) == [8] and pipe.get_cache_stats() == {'hits': 0, 'misses': 0}
+
+    def test_cancel_waiting(self):
+        cache = ResultCache()
+        running, waiting = Task(add, [3, 3], cache=cache), Task(add, [3, 3], cache=cache)
+        running.start()
+        waiting.start()
+        done = []
+        waiting.add_done_callback(done.append)
+        assert waiting.cancel() and running.wait() == 6
+        assert waiting.state == State.Cancelled and not waiting.cached and done == [waiting]
+
+    def test_eviction(self):
+        cache = ResultCache(max_entries=2, path=tempfile.mkdtemp(), max_bytes=1000, ttl=0.5)
+        for num in range(10):
+            cache.put(str(num), b'x' * 200)
+        cache.flush()
+        stats = cache.get_stats()
+        assert stats['entries'] == 2 and stats['disk_bytes'] <= 1000, stats
+        assert cache.get('0') == (False, None)
+        assert cache.get('9') == (True, b'x' * 200)
+        time.sleep(0.6)
+        assert cache.get('9') == (False, None)
+
+    def test_overwrite(self):
+        cache = ResultCache(path=tempfile.mkdtemp())
+        cache.put('key', b'x' * 200)
+        cache.put('key', b'x' * 200)
+        cache.flush()
+        assert cache.get_stats()['disk_bytes'] == os.path.getsize(os.path.join(cache.path, 'key'))
+
+
+class TestDag(unittest.TestCase):
+    """ tests tasks which take the results of upstream tasks """
+
+    def test_dag(self):
+        pipe = Pipeline(concurrency=4)
+        stage1 = pipe.parallel_async(add, [(1, 1)]) + pipe.parallel_async(subtract, [(5, 1)])
+        stage2 = pipe.parallel_async(add, [(task, 10) for task in stage1])
+        final = pipe.parallel_async(add, [[stage2[0]]], kwargs={'b': stage2[1]})
+        assert final[0].wait() == 26
+        assert stage2[0].start_time < stage1[1].end_time, 'Expected the branches to run at once'
+        assert [task.id for task in pipe.get_critical_path()] == [stage1[1].id, stage2[1].id, final[0].id]
+        stats = pipe.get_stats()
+        assert [val['critical'] for val in stats] == [False, True, False, True, True]
+        assert stats[4]['upstream'] == [stage2[0].id, stage2[1].id]
+
+    def test_large_args(self):
+        nested = []
+        for _ in range(10000):
+            nested = [nested]
+        start = time.time()
+        tasks = [Task(len, [list(range(1000000))]), Task(len, [nested])]
+        assert time.time() - start < 0.5 and not any(task.upstream for task in tasks)
+
+    def test_start_args(self):
+        upstream = Task(square, [2])
+        upstream.start()
+        assert parallel(square, [[upstream]])[0].wait() == 16
+        task = Task(add)
+        task.start(args=[upstream], kwargs={'b': upstream})
+        assert task.wait() == 8 and task.upstream_ids == (upstream.id,)
+
+    def test_upstream_failed(self):
+        pipe = Pipeline()
+        failed = pipe.parallel_async(subtract, [[1, 'x']])
+        downstream = pipe.parallel_async(square, [failed])
+        with self.assertRaises(TaskError):
+            downstream[0].wait()
+        assert 'upstream' in downstream[0].error
+
+
+class TestPriorities(unittest.TestCase):
+    """ tests the priorities and the weighted fair share of the scheduler """
+
+    def test_priorities(self):
+        pipe = Pipeline(concurrency=1, executor='thread')
+        blocker = pipe.parallel_async(go, [[1]])
+        backfill = pipe.parallel_async(square, [[num] for num in range(1000)])
+        urgent = pipe.parallel_async(square, [[2], [3]], priority=[5, 10])
+        heavy = pipe.parallel_async(square, [[num] for num in range(8)], priority=1, weight=3)
+        light = pipe.parallel_async(square, [[num] for num in range(8)], priority=1)
+        wait_for(backfill + urgent + heavy + light)
+        assert urgent[1].start_ns < urgent[0].start_ns < min(task.start_ns for task in heavy + light + backfill)
+        assert blocker[0].end_ns <= urgent[1].start_ns
+        order = sorted(heavy + light, key=lambda task: task.start_ns)
+        assert sum(1 for task in order[:8] if task in heavy) == 6, [task in heavy for task in order]
+        assert max(task.start_ns for task in heavy + light) < min(task.start_ns for task in backfill)
+
+        stats = pipe.get_queue_stats()
+        assert sorted(stats) == [0, 1, 5, 10] and stats[0]['count'] == 1001, stats
+        assert stats[10]['max'] < stats[0]['max'], stats
+        assert pipe.get_stats()[-1]['priority'] == 1
+
+
+class TestExecutors(unittest.TestCase):
+    """ tests running tasks in threads and inline """
+
+    def test_executors(self):
+        pipe = Pipeline(concurrency=2, executor='thread')
+        threads = pipe.parallel_async(go, [[1], [1]])
+        processes = pipe.parallel_async(get_pid, [[]], executor='process')
+        inline = pipe.parallel_sync(square, [[2], [3]], executor='inline')
+        assert inline == [4, 9]
+        assert processes[0].wait() != os.getpid()
+        assert processes[0].start_time >= min(task.end_time for task in threads), 'Expected a shared concurrency'
+        stats = pipe.get_stats()
+        assert all(val['duration'] >= 0.5 for val in stats[:2]), stats
+        assert [val['state'] for val in stats] == ['Succeeded'] * 5
+        assert parallel(get_pid, [[], []], executor='thread')[1].wait() == os.getpid()
+
+        task = Task(go, [2], executor='thread', timeout=0.2)
+        task.start()
+        with self.assertRaises(TaskError):
+            task.wait()
+        assert task.state == State.TimedOut and task.get_duration() < 1
+        with self.assertRaises(TaskError):
+            parallel(subtract, [[1, 'x']], executor='inline')[0].wait()
+
+    def test_inline_callbacks(self):
+        pipe = Pipeline(concurrency=1)
+        upstream = pipe.parallel_async(go, [[1]])
+        queued = pipe.parallel_async(get_thread, [[]], executor='inline')
+        downstream = pipe.parallel_async(get_thread, [[upstream[0]]], executor='inline')
+        for task in queued + downstream:
+            assert not isinstance(task.wait(), TaskMonitor), task.result
+        assert pipe.parallel_sync(get_thread, [[]], executor='inline') == [threading.current_thread()]
+
+    def test_start_methods(self):
+        path = tempfile.mkdtemp()
+        with open(os.path.join(path, 'bear_preloaded.py'), 'w') as handle:
+            handle.write('LOADED = True\n')
+        sys.path.append(path)  # the forkserver finds it with the sys.path of this process
+        try:
+            pipe = Pipeline(preload=['json', 'bear_preloaded'])
+            assert pipe.parallel_sync(is_loaded, [['bear_preloaded']]) == [True]
+        finally:
+            sys.path.remove(path)
+        assert 'PYTHONPATH' not in os.environ or path not in os.environ['PYTHONPATH']
+        with self.assertNoLogs('bear', level='WARNING'):
+            preload(['json', 'bear_preloaded'])
+        with self.assertLogs('bear', level='WARNING'):
+            preload(['os'])
+        for start_method in ['fork', 'spawn']:
+            task = Task(get_pid, start_method=start_method)
+            task.start()
+            assert task.wait() != os.getpid()
+            assert 0 < task.start_latency < task.get_duration(), task.get_stats()
+        stats = pipe.get_stats()
+        assert stats[0]['start_latency'] > 0, stats
+        with self.assertRaises(ValueError):
+            Task(get_pid, start_method='vfork')
+
+
+class TestPool(unittest.TestCase):
+    """ tests running tasks on a WorkerPool """
+
+    def test_pipeline(self):
+        with WorkerPool(size=2) as pool:
+            pipe = Pipeline(pool=pool)
+            res = pipe.parallel_sync(add, [(1, 1), (1, 2), (2, 2)])
+            assert res == [2, 3, 4], f"unexpected result: {res}"
+            for val in pipe.get_stats():
+                assert val['duration'] >= 1, f"Unexpected duration: {val}"
+                assert val['max_mem'] > 0, f"Unexpected max_mem: {val}"
+
+            with self.assertRaises(TaskError):
+                pipe.parallel_sync(subtract, [[1, 'x']])
+
+    def test_recycle(self):
+        with WorkerPool(size=1, max_tasks_per_child=2) as pool:
+            tasks = parallel(get_pid, [[] for _ in range(4)], pool=pool)
+            wait_for(tasks)
+            pids = [task.result for task in tasks]
+            assert pids[0] == pids[1] and pids[2] == pids[3] and pids[1] != pids[2], pids
+
+
+class TestRemote(unittest.TestCase):
+    """ tests running tasks on agents connected to a Coordinator
+    the functions are from the standard library so that the agents can import them
+    """
+
+    def start_agent(self, coordinator):
+        cmd = [sys.executable, '-m', 'bear', 'worker', '--connect', '{}:{}'.format(*coordinator.address),
+               '--authkey', coordinator.authkey.decode(), '--cores', '2']
+        return subprocess.Popen(cmd, cwd=ROOT, stderr=subprocess.DEVNULL)
+
+    def test_agents(self):
+        with Coordinator() as coordinator:
+            agents = [self.start_agent(coordinator) for _ in range(2)]
+            try:
+                assert coordinator.wait_for_agents(2, timeout=30)
+                pipe = Pipeline(pool=coordinator)
+                assert pipe.parallel_sync(operator.add, [(1, 1), (1, 2)]) == [2, 3]
+                pids = pipe.parallel_sync(os.getpid, [[] for _ in range(4)])
+                assert os.getpid() not in pids, pids
+                stats = pipe.get_stats()
+                assert all(val['state'] == 'Succeeded' and val['duration'] > 0 for val in stats), stats
+                with self.assertRaises(TaskError):
+                    pipe.parallel_sync(operator.truediv, [(1, 0)])
+
+                task = Task(time.sleep, [5], pool=coordinator, timeout=0.5)
+                task.start()
+                with self.assertRaises(TaskError):
+                    task.wait()
+                assert task.state == State.TimedOut and task.get_duration() < 4, task.get_stats()
+
+                tasks = parallel(time.sleep, [[1] for _ in range(4)], pool=coordinator)
+                time.sleep(0.5)
+                agents[0].kill()
+                wait_for(tasks)
+                assert all(task.state == State.Succeeded for task in tasks), [task.error for task in tasks]
+                assert len(coordinator.get_stats()) == 1
+            finally:
+                for agent in agents:
+                    agent.kill()
+                    agent.wait()
+
+
 if __name__ == '__main__':
     unittest.main()